@@ -1,10 +1,5 @@
 from __future__ import unicode_literals,print_function
 
-import numpy as np
-import matplotlib.pylab as plt
-import matplotlib as mpl
-
-
 import math
 import time
 import sys
@@ -28,7 +23,7 @@ def get_dict(i):
     return OrderedDict([('i',i),('i2',2*i),('ihd',0.5*i),('iri',int(1.0*i**(0.5)))])
 
 def yield_items(N):
-    for ii in xrange(N):
+    for ii in range(N):
         yield get_dict(ii)
 
 ######################
@@ -185,14 +180,14 @@ def compute_averages(arr,name=''):
 
 def test(N=10):
     results = OrderedDict()
-    results['pandas'] = compute_averages([time_pandas() for _ in xrange(N)],name='Pandas')
-    results['ldtable'] = compute_averages([time_ldtable() for _ in xrange(N)],name='ldtable')
-    results['TinyDB_mem'] = compute_averages([time_tinyDBmem() for _ in xrange(N)],name='tinyDB in memory')
-    results['dataset_mem'] = compute_averages([time_dataset_mem() for _ in xrange(N)],name='dataset_mem')
-    results['dataset_mem_index'] = compute_averages([time_dataset_mem(index=True) for _ in xrange(N)],name='dataset_mem_index')
-    results['loop_copy'] = compute_averages([time_loop_copy() for _ in xrange(N)],name='loop_copy')
-    results['sqlite'] = compute_averages([time_sqlitemem(False) for _ in xrange(N)],name='sqlite')
-    results['sqlite_indx'] = compute_averages([time_sqlitemem(True) for _ in xrange(N)],name='sqlite_index')
+    results['pandas'] = compute_averages([time_pandas() for _ in range(N)],name='Pandas')
+    results['ldtable'] = compute_averages([time_ldtable() for _ in range(N)],name='ldtable')
+    results['TinyDB_mem'] = compute_averages([time_tinyDBmem() for _ in range(N)],name='tinyDB in memory')
+    results['dataset_mem'] = compute_averages([time_dataset_mem() for _ in range(N)],name='dataset_mem')
+    results['dataset_mem_index'] = compute_averages([time_dataset_mem(index=True) for _ in range(N)],name='dataset_mem_index')
+    results['loop_copy'] = compute_averages([time_loop_copy() for _ in range(N)],name='loop_copy')
+    results['sqlite'] = compute_averages([time_sqlitemem(False) for _ in range(N)],name='sqlite')
+    results['sqlite_indx'] = compute_averages([time_sqlitemem(True) for _ in range(N)],name='sqlite_index')
     
     return results
 
@@ -220,6 +215,11 @@ if run:
     sys.exit()
     #############################
 
+# Plotting only. See suite.py for the maintained, operation-level benchmarks
+import numpy as np
+import matplotlib.pylab as plt
+import matplotlib as mpl
+
 with open('results.json') as FF:
     all_res = json.load(FF,object_pairs_hook=OrderedDict)
 
@@ -239,7 +239,7 @@ shapes = itertools.cycle(['-o', '-s', '-D', '-<', '-H'])
 mpl.rcParams['font.size'] = 14
 mpl.rcParams['lines.linewidth'] = 2
 
-methods = all_res[0].keys()
+methods = list(all_res[0].keys())
 for it,tool in enumerate(methods):
     shape = next(shapes)
     axes[0].plot(Nds,[R[tool]['TQ'] for R in all_res],shape)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Operation-level benchmark suite for ldtable.
+
+Unlike benchmark.py (which produced the figure in the readme and times only
+construction and a single equality query against other tools), this suite
+times every major ldtable operation across table sizes and writes the
+results as JSON so that two versions can be compared.
+
+It only needs the standard library. Optional competitors (pandas) are timed
+if they happen to be installed and skipped otherwise.
+
+Usage
+-----
+
+    python suite.py                             # All sizes (1e3 to 1e7)
+    python suite.py --sizes 1000 10000          # Quick run
+    python suite.py --ops eq range --output a.json
+    python suite.py --compare old.json new.json # Ratio of new/old
+
+Note that 1e7 rows needs a lot of memory (well over 10 GB).
+
+Operations that the ldtable being timed doesn't have (e.g. update_many in
+older versions) are skipped so any two revisions can be compared.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    from time import perf_counter as timer
+except ImportError: # Python 2
+    timer = time.time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import ldtable as ldtable_mod
+ldtable = ldtable_mod.ldtable
+
+DEFAULT_SIZES = [10**3,10**4,10**5,10**6,10**7]
+
+STATUSES = ['new','open','closed','held']
+TAGS = ['t{}'.format(i) for i in range(10)]
+
+def make_row(i):
+    return OrderedDict([('i',i),
+                        ('i2',2*i),
+                        ('ihd',0.5*i),
+                        ('iri',int(i**0.5)),
+                        ('grp',i % 100), # Each value is 1% of the rows
+                        ('status',STATUSES[i % 4]),
+                        ('tags',[TAGS[i % 5],TAGS[5 + (i//5) % 5]])])
+
+def make_rows(N):
+    return [make_row(i) for i in range(N)]
+
+def best_of(func,repeat):
+    """
+    Call func(r) for r in range(repeat) and return timing summary.
+    func may return a value that is recorded (e.g. a count) as a sanity
+    check between versions
+    """
+    times = []
+    result = None
+    for r in range(repeat):
+        gc.collect()
+        t0 = timer()
+        result = func(r)
+        times.append(timer() - t0)
+    return OrderedDict([('best',min(times)),
+                        ('mean',sum(times)/len(times)),
+                        ('repeat',repeat),
+                        ('result',result)])
+
+######################
+## Operations
+##
+## Each operation is func(N,rows,DB,repeat) and returns a timing summary.
+## Read-only operations come first. Mutating operations are run after and
+## each repeat touches a different slice (via `grp`) so repeats stay
+## comparable.
+######################
+
+def op_add(N,rows,DB,repeat):
+    def run(r):
+        D = ldtable()
+        for row in rows:
+            D.add(row)
+        return len(D)
+    return best_of(run,repeat)
+
+def op_bulk(N,rows,DB,repeat):
+    return best_of(lambda r: len(ldtable(rows)),repeat)
+
+def op_eq(N,rows,DB,repeat):
+    iri = int((N//2)**0.5)
+    return best_of(lambda r: DB.count(iri=iri),repeat)
+
+def op_multikey(N,rows,DB,repeat):
+    return best_of(lambda r: DB.count(status='open',grp=1,tags='t1'),repeat)
+
+def op_range(N,rows,DB,repeat):
+    return best_of(lambda r: DB.count(DB.Q.i < N//10),repeat)
+
+def op_mixed(N,rows,DB,repeat):
+    return best_of(lambda r: DB.count( (DB.Q.grp == 3) & (DB.Q.i < N//2) ),repeat)
+
+def op_filter(N,rows,DB,repeat):
+    filt = lambda item: item['i'] % 7 == 0
+    return best_of(lambda r: DB.count(DB.Q._filter(filt)),repeat)
+
+def op_negation(N,rows,DB,repeat):
+    return best_of(lambda r: DB.count(DB.Q.status != 'open'),repeat)
+
+def op_invert(N,rows,DB,repeat):
+    return best_of(lambda r: DB.count( ~((DB.Q.grp == 1) | (DB.Q.grp == 2)) ),repeat)
+
+def op_update(N,rows,DB,repeat):
+    def run(r):
+        DB.update({'status':'done{}'.format(r)},grp=10 + r)
+        return DB.count(status='done{}'.format(r))
+    return best_of(run,repeat)
+
+def op_update_many(N,rows,DB,repeat):
+    def run(r):
+        DB.update_many({'status':'bulk{}'.format(r)},grp=10 + r)
+        return DB.count(status='bulk{}'.format(r))
+    return best_of(run,repeat)
+
+def op_remove(N,rows,DB,repeat):
+    def run(r):
+        DB.remove(grp=60 + r)
+        return len(DB)
+    return best_of(run,repeat)
+
+def op_reindex(N,rows,DB,repeat):
+    def run(r):
+        DB.reindex('iri')
+        return len(DB)
+    return best_of(run,repeat)
+
+OPERATIONS = OrderedDict([
+    ('add',op_add),
+    ('bulk',op_bulk),
+    ('eq',op_eq),
+    ('multikey',op_multikey),
+    ('range',op_range),
+    ('mixed',op_mixed),
+    ('filter',op_filter),
+    ('negation',op_negation),
+    ('invert',op_invert),
+    ('update',op_update),
+    ('update_many',op_update_many),
+    ('remove',op_remove),
+    ('reindex',op_reindex),
+])
+
+# Methods an operation needs that older versions of ldtable may not have.
+# Those operations are skipped so earlier revisions can still be compared
+REQUIRES = {
+    'update_many':['update_many'],
+}
+
+######################
+## Memory
+######################
+
+def measure_memory(rows):
+    """
+    Return the bytes allocated by the table beyond the input rows as
+    measured by tracemalloc
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        DB = ldtable(rows)
+        current,peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del DB
+    return OrderedDict([('index_bytes',current),('peak_bytes',peak),
+                        ('bytes_per_row',current/max(len(rows),1))])
+
+######################
+## Competitors (optional)
+######################
+
+def competitor_loop(N,rows,repeat):
+    iri = int((N//2)**0.5)
+    return best_of(lambda r: len([row for row in rows if row['iri'] == iri]),repeat)
+
+def competitor_sqlite(N,rows,repeat):
+    import sqlite3
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE tab (i int,i2 int,ihd real,iri int,grp int,status text)')
+    conn.executemany('INSERT INTO tab VALUES (?,?,?,?,?,?)',
+                     ((r['i'],r['i2'],r['ihd'],r['iri'],r['grp'],r['status']) for r in rows))
+    conn.execute('CREATE INDEX index_iri ON tab (iri)')
+    iri = int((N//2)**0.5)
+    res = best_of(lambda r: len(conn.execute('SELECT * FROM tab WHERE iri=?',(iri,)).fetchall()),repeat)
+    conn.close()
+    return res
+
+def competitor_pandas(N,rows,repeat):
+    import pandas as pd
+    DF = pd.DataFrame(rows)
+    iri = int((N//2)**0.5)
+    return best_of(lambda r: len(DF[DF.iri == iri]),repeat)
+
+COMPETITORS = OrderedDict([
+    ('loop',competitor_loop),
+    ('sqlite',competitor_sqlite),
+    ('pandas',competitor_pandas),
+])
+
+######################
+## Driver
+######################
+
+def run_size(N,ops,repeat,memory=True,competitors=True):
+    print('N = {:d}'.format(N))
+    rows = make_rows(N)
+    DB = ldtable(rows)
+
+    res = OrderedDict([('N',N),('ops',OrderedDict())])
+    for name in ops:
+        missing = [m for m in REQUIRES.get(name,[]) if not hasattr(DB,m)]
+        if missing:
+            print('  {:12s} skipped (no {})'.format(name,', '.join(missing)))
+            continue
+        # add and bulk build their own table. Do not repeat the slow ones
+        # on very large sizes
+        rep = repeat if name not in ('add','bulk') or N <= 10**5 else 1
+        res['ops'][name] = OPERATIONS[name](N,rows,DB,rep)
+        print('  {:12s} {:0.5e} s'.format(name,res['ops'][name]['best']))
+
+    del DB
+    if memory:
+        res['memory'] = measure_memory(rows)
+
+    if competitors:
+        res['competitors'] = OrderedDict()
+        for name,func in COMPETITORS.items():
+            try:
+                res['competitors'][name] = func(N,rows,repeat)
+            except ImportError:
+                res['competitors'][name] = None # Not installed
+    return res
+
+def run(sizes,ops,repeat,memory=True,competitors=True):
+    meta = OrderedDict([
+        ('ldtable_version',getattr(ldtable_mod,'__version__',None)),
+        ('python',sys.version),
+        ('implementation',platform.python_implementation()),
+        ('platform',platform.platform()),
+        ('timestamp',time.time()),
+        ('repeat',repeat),
+    ])
+    results = [run_size(N,ops,repeat,memory=memory,competitors=competitors)
+               for N in sizes]
+    return OrderedDict([('meta',meta),('results',results)])
+
+def compare(old_path,new_path):
+    """
+    Print the ratio of new to old best times for every common (N,op). Values
+    above 1 are slower in the new results.
+    """
+    with open(old_path) as F:
+        old = json.load(F)
+    with open(new_path) as F:
+        new = json.load(F)
+
+    old = {r['N']:r for r in old['results']}
+    print('{:>10s} {:12s} {:>12s} {:>12s} {:>8s}'.format('N','op','old','new','ratio'))
+    for rnew in new['results']:
+        N = rnew['N']
+        if N not in old:
+            continue
+        for op,tnew in rnew['ops'].items():
+            told = old[N]['ops'].get(op)
+            if told is None:
+                continue
+            ratio = tnew['best']/told['best'] if told['best'] > 0 else float('inf')
+            print('{:10d} {:12s} {:12.5e} {:12.5e} {:8.2f}'.format(
+                    N,op,told['best'],tnew['best'],ratio))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes',nargs='+',type=int,default=DEFAULT_SIZES,
+                        help='Table sizes. Default: %(default)s')
+    parser.add_argument('--ops',nargs='+',choices=list(OPERATIONS),
+                        default=list(OPERATIONS),help='Operations to time')
+    parser.add_argument('--repeat',type=int,default=5,
+                        help='Repeats per operation (best is reported). Max 40. Default: %(default)s')
+    parser.add_argument('--no-memory',action='store_true',help='Skip memory measurement')
+    parser.add_argument('--no-competitors',action='store_true',help='Skip competitors')
+    parser.add_argument('--output',default='suite_results.json',
+                        help='JSON output path. Default: %(default)s')
+    parser.add_argument('--compare',nargs=2,metavar=('OLD','NEW'),
+                        help='Compare two result files rather than run')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if not 1 <= args.repeat <= 40:
+        parser.error('--repeat must be between 1 and 40')
+
+    results = run(args.sizes,args.ops,args.repeat,
+                  memory=not args.no_memory,
+                  competitors=not args.no_competitors)
+    with open(args.output,'w') as F:
+        json.dump(results,F,indent=1)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,96 @@ from __future__ import unicode_literals
 __version__ = "20180628"
 __author__ = "Justin Winokur"
 
+from array import array
+from bisect import bisect_left, bisect_right, insort
 import copy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import csv
+import functools
+import gc
+import heapq
+import io
+import json
+import multiprocessing
+import operator
+import sys
+import threading
 import time
 import types
+import weakref
 
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+    shared_memory = None
+
+try:
+    import cPickle as pickle
+except ImportError: # Python 3
+    import pickle
+
+try:
+    import sqlite3
+except ImportError: # Built without sqlite
+    sqlite3 = None
+
+try:
+    _INT_TYPECODE = str('q')
+    array(_INT_TYPECODE)
+except ValueError: # Python 2. A long is 64 bits on most platforms
+    _INT_TYPECODE = str('l')
+
+
+def _reading(method):
+    """
+    Decorator to hold the DB's read lock (if threadsafe) while calling method.
+    Works for ldtable and Qobj methods
+    """
+    @functools.wraps(method)
+    def wrapped(self,*A,**K):
+        DB = self._DB if isinstance(self,Qobj) else self
+        if DB._lock is None:
+            return method(self,*A,**K)
+        with DB._lock.reading():
+            return method(self,*A,**K)
+    return wrapped
+
+def _indexing(method):
+    """
+    Decorator to hold the DB's index lock (if threadsafe) while calling 
+    method. For reads that also change the index (e.g. lazy builds) since
+    readers share the read lock
+    """
+    @functools.wraps(method)
+    def wrapped(self,*A,**K):
+        if self._index_lock is None:
+            return method(self,*A,**K)
+        with self._index_lock:
+            return method(self,*A,**K)
+    return wrapped
+
+def _writing(method):
+    """
+    Decorator to hold the DB's write lock (if threadsafe) while calling method.
+    Whether anything is still shared with snapshots (or clones) is decided 
+    here, once per write, so it doesn't change in the middle of one
+    """
+    @functools.wraps(method)
+    def wrapped(self,*A,**K):
+        if self._lock is None:
+            self._release_cow()
+            return method(self,*A,**K)
+        with self._lock.writing():
+            self._release_cow()
+            return method(self,*A,**K)
+    return wrapped
 
 class ldtable(object):
     def __init__(self, items=None, attributes=None, default_attribute=None,
-                 exclude_attributes=None, indexObjects=False):
+                 exclude_attributes=None, indexObjects=False, lazy=False,
+                 lazy_evict=None, partial=None, threadsafe=False,
+                 primary_key=None, sorted_attributes=None, len_attributes=None,
+                 index_budget=None, storage=None, storage_cache=1024):
         """
         ldtable:
         Create an in-memeory single table DB from a list of dictionaries that 
@@ -56,6 +137,76 @@ class ldtable(object):
             Note
                 * Changing to False after adding an object will cause issues.
                 * Does not support __slots__ since they are immutable
+                * Objects that inherit from TrackedObject update the index
+                  when their attributes are set (no reindex() needed)
+        
+        lazy: [False]
+            If True, items are stored (and missing attributes set to the
+            default) but an attribute is not indexed until it is first
+            queried. Useful with `attributes=None` when only a few of the
+            attributes are ever queried
+        
+        lazy_evict: [None]
+            Only used with lazy=True. If set, an attribute's index that has
+            not been queried in `lazy_evict` seconds is dropped and will be
+            rebuilt the next time it is queried
+        
+        index_budget: [None]
+            Only used with lazy=True. If set, the approximate number of bytes
+            the indexes may use. When building an index goes over, the least
+            valuable indexes (used least often and recently for their size)
+            are dropped until it is under. An index that cannot fit by itself
+            is only used for that query (like checking every item). See 
+            index_stats()
+        
+        partial: [None]
+            Dictionary of {attribute:rule} for attributes that should only be
+            partially indexed. The rule is either a list (or set) of values
+            to *not* index or a function that returns True if a value
+            should be indexed. For example
+            
+                partial={'error_code':[None]}
+                partial={'error_code':lambda val: val is not None}
+            
+            Queries for values that are not indexed still work but are O(N)
+        
+        threadsafe: [False]
+            If True, guard the DB with a reader-writer lock. Any number of 
+            threads may query (query, count, isin, Qobj comparisons, etc) at 
+            the same time while add/update/remove/reindex wait for exclusive
+            access. query() and items() collect their results while holding 
+            the lock so they are consistent even if iterated later.
+            Qobj expressions are evaluated with the lock held so they are 
+            not out of date if other threads change the DB. Building lazy
+            indexes is done by one thread at a time.
+        
+        primary_key: [None]
+            Attribute that uniquely identifies each item. It is indexed as
+            a single {value:index} map rather than lists and adding an item 
+            with an existing (or missing) key raises an error. Enables get(), 
+            upsert(), and delete(). Values may not be lists.
+        
+        sorted_attributes: [None]
+            Attributes that also keep their (distinct) values sorted so that
+            <, <=, >, and >= use the index rather than checking every item. 
+            The values must be comparable with each other
+        
+        len_attributes: [None]
+            (List) attributes that also index the number of values so that
+            queries like `DB.Q.tags.len() >= 2` use the index
+        
+        storage: [None]
+            Path of a (sqlite) file to store the items in rather than memory.
+            Only the index is kept in memory and items are read from the file
+            when needed. Any existing table in the file is replaced. Items 
+            must be picklable and may not be objects (indexObjects)
+            
+            Note: Items returned are new copies loaded from the file so 
+                  changing them directly does nothing. Use update() or 
+                  update_many()
+        
+        storage_cache: [1024]
+            Number of recently used items to keep in memory with storage
             
         Multiple Values per attribute
         -----------------------------
@@ -90,7 +241,32 @@ class ldtable(object):
         if exclude_attributes is None:
             exclude_attributes = list()
         self.indexObjects = indexObjects
+        self.lazy = lazy
+        self.lazy_evict = lazy_evict
+        self._last_used = {} # attribute: last query time (lazy only)
+        self.index_budget = index_budget
+        self._index_use = {} # attribute: use of the index. See index_stats()
+        self._inflation = 0.0 # Priority of the last evicted index
+        
+        if partial is None:
+            partial = dict()
+        self.partial = {}
+        for attrib,rule in partial.items():
+            if not hasattr(rule,'__call__'):
+                rule = set(_makelist(rule) if not isinstance(rule,(set,tuple)) else rule)
+            self.partial[attrib] = rule
+        
+        self.primary_key = primary_key
+        self._pk = {} # primary key value: ix
+        if primary_key is not None:
+            if primary_key in exclude_attributes or primary_key in self.partial:
+                raise ValueError('The primary key cannot be excluded or partially indexed')
+            if attributes is not None and primary_key not in attributes:
+                attributes = list(attributes) + [primary_key]
 
+        self.sorted_attributes = set(sorted_attributes or [])
+        self._sorted = {} # attrib: (lookup,sorted keys)
+        self.len_attributes = set(len_attributes or [])
 
         self.attributes = attributes # Will be reset in first add
         self._is_attr_None = attributes is None
@@ -98,10 +274,29 @@ class ldtable(object):
         self.exclude_attributes = exclude_attributes
 
         self.N = 0 # Will keep track
-        self._list = []
+        self.storage = storage
+        if storage is not None:
+            if indexObjects:
+                raise ValueError('storage cannot be used with indexObjects')
+            self._list = _StoredList(storage,storage_cache)
+        else:
+            self._list = []
 
         self._empty = _emptyList()
         self._ix = set()
+        
+        self._frozen = False
+        self._shm = None
+        self._lock = _RWLock() if threadsafe else None
+        self._index_lock = threading.RLock() if threadsafe else None
+        
+        # Copy-on-write state for snapshots. _cow is None when nothing is
+        # shared, otherwise {attrib: True if its lookup is owned or a set of
+        # the values whose lists are owned}
+        self._snapshots = weakref.WeakSet()
+        self._cow = None
+        self._dirty = {} # ix: {attrib:value} from mark_dirty()
+        self._stats = {} # attrib: statistics from analyze()
 
         # Add the items
         for item in items:
@@ -115,10 +310,12 @@ class ldtable(object):
         if self.attributes is None:
             self.attributes = []
         
+    @_writing
     def add(self,item):
         """
         Add an item or items to the DB
         """
+        self._check_frozen()
         if isinstance(item,(list,tuple,types.GeneratorType)):
             for it in item:
                 self.add(it)
@@ -128,6 +325,11 @@ class ldtable(object):
         item0 = item
         item = self._convert2dict(item)
         
+        if self.primary_key is not None: # Check before anything is changed
+            if self.primary_key not in item:
+                raise KeyError("Item is missing primary key '{}'".format(self.primary_key))
+            self._check_key(item[self.primary_key])
+        
         if self.N == 0:
             attributes = self.attributes
             if attributes is None:
@@ -137,8 +339,16 @@ class ldtable(object):
                                 if attrib not in self.exclude_attributes] # Make a copy
             
 
-            # Set up the lookup
-            self._lookup = {attribute:defaultdict(list) for attribute in self.attributes}
+            # Set up the lookup. If lazy, they are built on first query
+            if self.lazy:
+                self._lookup = {}
+            else:
+                self._lookup = {attribute:defaultdict(list) for attribute in self.attributes
+                                if attribute != self.primary_key}
+                for attribute in self.len_attributes.intersection(self.attributes):
+                    self._lookup[_len_key(attribute)] = defaultdict(list)
+            if self._cow is not None:
+                self._cow = dict.fromkeys(self._lookup,True)
         
         ix = len(self._list) # The length will be 1+ the last ix so do not change this
 
@@ -163,11 +373,14 @@ class ldtable(object):
         self._list.append(item0)
         self.N += 1
         self._ix.add(ix)
+        if self.indexObjects and isinstance(item0,TrackedObject):
+            _track(item0,self,ix)
 
     def query(self,*A,**K):
         """
         Query the value for attribute. Will always an iterator. Use
-        `list(DB.query())` to return a list
+        `list(DB.query())` to return a list. Items are returned in the order 
+        they were added
         
         Usage
         -----
@@ -187,12 +400,60 @@ class ldtable(object):
         >>> DB.query(DB.Q.attrib == val)
         >>> DB.query( (DB.Q.attrib1 == val1) &  (DB.Q.attrib1 == val2) )  # Parentheses are important!
         >>> DB.query( (DB.Q.attrib1 == val1) &  (DB.Q.attrib1 != val2))
+        
+        Pages: Only items after index `_after` and at most `_limit` of them.
+        See query_page()
+        
+        >>> DB.query(DB.Q.attrib == val,_after=ix,_limit=100)
                                    
         """
+        if self._lock is not None: # Get them all while holding the lock
+            for item in self._query_list(*A,**K):
+                yield item
+            return
+        
         ixs = self._ixs(*A,**K)
         for ix in ixs:
             yield self._list[ix]
     
+    @_reading
+    def _query_list(self,*A,**K):
+        return [self._list[ix] for ix in self._ixs(*A,**K)]
+    
+    @_reading
+    def query_page(self,*A,**K):
+        """
+        Return a page of the results of a query and a cursor for the next 
+        page. See "query" for details on query construction.
+        
+        Returns (items,cursor) where cursor is the index of the last item or
+        None if there are no more. Items are in the order they were added so
+        the cursor stays valid when items are added or removed (but not after
+        compact()). Each page only lists the matches after the cursor.
+        
+        Usage
+        -----
+        
+        >>> items,cursor = DB.query_page(DB.Q.role == 'guitar',_limit=100)
+        >>> while cursor is not None:
+        ...     items,cursor = DB.query_page(DB.Q.role == 'guitar',
+        ...                                  _after=cursor,_limit=100)
+        
+        _limit defaults to 100
+        """
+        limit = K.setdefault('_limit',100)
+        if limit is not None and limit < 0:
+            raise ValueError('_limit must be non-negative')
+        if limit is not None:
+            K['_limit'] = limit + 1 # One more to know if there are more
+        ixs = self._ixs(*A,**K)
+        cursor = None
+        if limit is not None and len(ixs) > limit:
+            ixs = ixs[:limit]
+            cursor = ixs[-1] if ixs else None
+        return [self._list[ix] for ix in ixs],cursor
+    
+    @_reading
     def query_one(self,*A,**K):
         """
         Return a single item from a query. See "query" for more details.
@@ -204,13 +465,17 @@ class ldtable(object):
         except StopIteration:
             return None
 
+    @_reading
     def count(self,*A,**K):
         """
         Return the number of matched rows for a given query. See "query" for
-        details on query construction
+        details on query construction (including `_after` and `_limit`)
         """
-        return len(self._ixs(*A,**K))
+        if '_after' in K or '_limit' in K:
+            return len(self._ixs(*A,**K))
+        return len(self._matches(*A,**K))
     
+    @_reading
     def isin(self,*A,**K):
         """
         Check if there is at least one item that matches the given query
@@ -218,9 +483,161 @@ class ldtable(object):
         see query() for usage
         """
 
-        return len(self._ixs(*A,**K))>0
+        return len(self._matches(*A,**K))>0
+    
+    @_writing
+    def analyze(self,*attributes,**kwargs):
+        """
+        Compute statistics of the values of attributes (all if not 
+        specified) that are then kept up to date as items are added, 
+        updated, and removed. They are used to estimate how many items a 
+        query matches (see selectivity()) and to choose the order conditions 
+        are evaluated.
+        
+        Inputs:
+        -------
+        *attributes
+            Attributes to analyze. Defaults to all
+        
+        bins [10] (keyword)
+            Number of (equal count) bins of the histogram of values
+        
+        mcv [10] (keyword)
+            Number of most common values to track
+        
+        Returns:
+        --------
+        stats() of the attributes
+        
+        Note: Statistics of a lazy attribute are dropped if its index is.
+              Partial attributes only count the indexed values.
+        """
+        bins = kwargs.pop('bins',10)
+        mcv = kwargs.pop('mcv',10)
+        if kwargs:
+            raise TypeError('Unexpected keyword(s): {}'.format(', '.join(kwargs)))
+        if bins < 1:
+            raise ValueError('bins must be at least 1')
+        
+        if len(attributes) == 0:
+            attributes = list(self.attributes)
+        for attrib in attributes:
+            if attrib not in self.attributes:
+                raise KeyError("'{}' is not an attribute".format(attrib))
+        
+        for attrib in attributes:
+            self._stats[attrib] = self._analyze(attrib,bins,mcv)
+        return self.stats(*attributes)
+    
+    @_reading
+    def stats(self,*attributes):
+        """
+        Return the current statistics of analyzed attributes (all if not
+        specified) as {attribute:stats} where stats has:
+        
+            'values'     : Number of indexed values (for lists, each value)
+            'distinct'   : Number of distinct values
+            'null_frac'  : Fraction of values that are None or empty lists
+            'mcv'        : [(value,count),...] of the most common (non-null) 
+                           values
+            'histogram'  : Bin edges (len(bins)+1) with about the same number 
+                           of values in each bin or None if the values 
+                           cannot be sorted
+            'bin_counts' : Number of values in each bin
+        
+        See analyze()
+        """
+        if len(attributes) == 0:
+            attributes = list(self._stats)
+        res = OrderedDict()
+        for attrib in attributes:
+            st = self._stats.get(attrib)
+            if st is None:
+                raise KeyError("'{}' has not been analyzed".format(attrib))
+            mcv = [(val,self._value_count(attrib,val) or 0) for val in st['mcv']]
+            mcv = sorted((item for item in mcv if item[1] > 0),key=lambda item:-item[1])
+            res[attrib] = OrderedDict([
+                ('values',st['values']),
+                ('distinct',st['distinct']),
+                ('null_frac',float(st['nulls'])/st['values'] if st['values'] else 0.0),
+                ('mcv',mcv),
+                ('histogram',list(st['bounds']) if st['bounds'] is not None else None),
+                ('bin_counts',list(st['depths']) if st['bounds'] is not None else None)])
+        return res
+    
+    @_reading
+    def selectivity(self,*A,**K):
+        """
+        Return the estimated fraction of items that match a query (without
+        running it). See "query" for details on query construction.
+        
+        Equality uses the index and is exact. Ranges use the histograms from
+        analyze() if available. Otherwise 1/3 of items are assumed to match
+        a range and 1/2 a filter. Conditions are assumed independent.
+        """
+        if not hasattr(self,'_lookup') or self.N==0:
+            return 0.0
+        Q = self._build_query(*A,**K)
+        if Q._node is None:
+            return 0.0
+        return Q._estimate(Q._node)
+    
+    @_reading
+    def index_stats(self):
+        """
+        Return the use of the indexes as a dictionary with:
+        
+            'budget'     : index_budget
+            'bytes'      : Approximate size of all current indexes
+            'evictions'  : Number of times an index was dropped
+            'attributes' : {attribute:{'indexed','bytes','queries','builds',
+                                       'evictions','last_used'}}
+        
+        The length indexes are listed as ('len',attribute). Queries, builds, 
+        and evictions are only counted for lazy DBs
+        """
+        lookups = getattr(self,'_lookup',{})
+        keys = list(self.attributes or [])
+        keys += [key for key in list(lookups) + list(self._index_use) if key not in keys]
+        attributes = OrderedDict()
+        for key in keys:
+            if key == self.primary_key:
+                continue
+            use = self._index_use.get(key,{})
+            attributes[key] = OrderedDict([
+                ('indexed',key in lookups),
+                ('bytes',self._index_bytes(key)),
+                ('queries',use.get('queries',0)),
+                ('builds',use.get('builds',0)),
+                ('evictions',use.get('evictions',0)),
+                ('last_used',use.get('last_used'))])
+        return OrderedDict([
+            ('budget',self.index_budget),
+            ('bytes',sum(att['bytes'] for att in attributes.values())),
+            ('evictions',sum(att['evictions'] for att in attributes.values())),
+            ('attributes',attributes)])
+    
+    @_reading
+    def get(self,key,default=None):
+        """
+        Return the item with primary key `key` (or `default` if there isn't 
+        one). This is a single dictionary lookup.
+        
+        Usage
+        -----
+        
+        >>> DB = ldtable(items,primary_key='id')
+        >>> DB.get(1234)
+        """
+        if self.primary_key is None:
+            raise ValueError('get() requires a primary_key')
+        ix = self._pk.get(key)
+        if ix is None:
+            return default
+        return self._list[ix]
 
-    def reindex(self,*args):
+    @_writing
+    def reindex(self,*args,**kwargs):
         """
         Reindex the dictionary for specified attributes (or all)
         
@@ -231,10 +648,19 @@ class ldtable(object):
         >>> DB.reindex('attrib')        # Reindex 'attrib'
         >>> DB.reindex('attrib1','attrib2') # Multiple
         
+        >>> DB.mark_dirty(item)
+        >>> item['attrib'] = 'new'
+        >>> DB.reindex(dirty_only=True) # Only items given to mark_dirty()
+        
         See Also
         --------
             update() method which does not require reindexing
+            mark_dirty()
         """
+        self._check_frozen()
+        dirty_only = kwargs.pop('dirty_only',False)
+        if kwargs:
+            raise TypeError('Unexpected keyword argument(s) {}'.format(', '.join(kwargs)))
         if len(args) == 0:
             attributes = self.attributes
             
@@ -245,9 +671,37 @@ class ldtable(object):
             attributes = args
             if any(a in self.exclude_attributes for a in args):
                 raise ValueError('Cannot reindex an excluded attribute')
-
+        
+        if dirty_only:
+            self._reindex_dirty(attributes)
+            return
+        self._clear_dirty(attributes)
+        
+        # Statistics are recomputed (or dropped if lazy) from the new index
+        stats = [(attr,self._stats.pop(attr)) for attr in attributes if attr in self._stats]
+        
+        if self.primary_key in attributes: # Never lazy
+            attributes = [attr for attr in attributes if attr != self.primary_key]
+            self._build_pk()
+        
+        if self.lazy: # Just drop them. They will be rebuilt when next queried
+            for attribute in attributes:
+                self._lookup.pop(attribute,None)
+                self._lookup.pop(_len_key(attribute),None)
+            self._time = time.time()
+            stats = [(attr,st) for attr,st in stats if attr == self.primary_key]
+            for attr,st in stats:
+                self._stats[attr] = self._analyze(attr,st['bins'],st['mcv_size'])
+            return
+        
         for attribute in attributes:
-            self._lookup[attribute] = defaultdict(list) # Reset
+            keys = [attribute]
+            if attribute in self.len_attributes:
+                keys.append(_len_key(attribute))
+            for key in keys:
+                self._lookup[key] = defaultdict(list) # Reset
+                if self._cow is not None:
+                    self._cow[key] = True
         
         for ix,item in enumerate(self._list):
             if item is None: continue
@@ -255,7 +709,39 @@ class ldtable(object):
             for attrib in attributes:
                 value = item[attrib]
                 self._append(attrib,value,ix)
+        
+        for attr,st in stats:
+            self._stats[attr] = self._analyze(attr,st['bins'],st['mcv_size'])
+    
+    @_writing
+    def mark_dirty(self,*items):
+        """
+        Mark items (or their indices) that will be changed directly so that 
+        reindex(dirty_only=True) only updates the index for them.
+        
+        Usage
+        -----
+        
+        >>> item = DB.query_one(name='a')
+        >>> DB.mark_dirty(item)     # Records the indexed values
+        >>> item['status'] = 'done'
+        >>> DB.reindex(dirty_only=True)
+        
+        Call this *before* changing the item since its current values are 
+        recorded and compared to the new ones. If called after, changed
+        values are still found (by searching the index for the item) except
+        for values removed from a list.
+        """
+        self._check_frozen()
+        for item in items:
+            ix = self._find_ix(item)
+            if ix in self._dirty:
+                continue # Keep the first recorded values
+            row = self._convert2dict(self._list[ix])
+            self._dirty[ix] = {attrib:copy.copy(row[attrib]) for attrib in self.attributes
+                               if self._is_indexed(attrib)}
     
+    @_writing
     def update(self,*args,**queryKWs):
         """
         Update an entry without needing to reindex the DB (or a specific
@@ -290,6 +776,7 @@ class ldtable(object):
               need to query them in between, it *may* be faster to directly
               update the item and reindex
         """
+        self._check_frozen()
         
         if len(args) == 1:
             updated_dict = args[0]
@@ -315,33 +802,174 @@ class ldtable(object):
         if len(ixs) == 0:
             raise ValueError('Query did not match any results')
         
+        if self.primary_key in updated_dict:
+            if len(ixs) > 1:
+                raise ValueError('Cannot set the same primary key on multiple items')
+            self._check_key(updated_dict[self.primary_key],ixs)
+        
         for ix in ixs:
-            # Get original item
-            item = self._list[ix]
-            item = self._convert2dict(item)
+            self._update_row(ix,updated_dict)
+        
+        return
+    
+    def _update_row(self,ix,updated_dict):
+        """
+        Update item ix and the index for the changed attributes
+        """
+        self._preserve_row(ix)
+        
+        # Get original item
+        item0 = self._list[ix]
+        item = self._convert2dict(item0)
+        
+        # Allow the update to also include non DB attributes.
+        # The intersection will eliminate any exclude_attributes
+        attributes = set(updated_dict.keys()).intersection(self.attributes)
+        
+        for attrib in attributes: # Only loop over the updated attribs
+            # get old value
+            value = item[attrib]
             
-            # Allow the update to also include non DB attributes.
-            # The intersection will eliminate any exclude_attributes
-            attributes = set(updated_dict.keys()).intersection(self.attributes)
+            # Remove any ix matching it
+            self._remove(attrib,value,ix)
             
-            for attrib in attributes: # Only loop over the updated attribs
-                # get old value
-                value = item[attrib]
-                
-                # Remove any ix matching it
-                self._remove(attrib,value,ix)
-                
-                # Get new value
-                value = updated_dict[attrib]
-                
-                # Add ix to any new value
-                self._append(attrib,value,ix)
-                
-            # Update the item
-            item.update(updated_dict)
+            # Get new value
+            value = updated_dict[attrib]
+            
+            # Add ix to any new value
+            self._append(attrib,value,ix)
+            
+        # Update the item
+        item.update(updated_dict)
+        self._list[ix] = item0 # Store it again if not in memory
+    
+    def _tracked_check(self,ix,attrib,value):
+        """
+        Raise an error if TrackedObject ix can't set attrib to value
+        """
+        self._check_frozen()
+        if attrib == self.primary_key:
+            self._check_key(value,[ix])
+    
+    @_writing
+    def _tracked_set(self,ix,attrib,value):
+        """
+        Update the index for TrackedObject ix before attrib is set to value.
+        Same as update() for that item but without the query
+        """
+        self._tracked_check(ix,attrib,value)
+        item = self._convert2dict(self._list[ix])
+        if attrib not in self.attributes:
+            if not self._is_attr_None or attrib in self.exclude_attributes:
+                return # Not indexed
+            self.add_attribute(attrib,self.default_attribute)
         
-        return
+        self._preserve_row(ix)
+        self._remove(attrib,item[attrib],ix)
+        self._append(attrib,value,ix)
+    
+    @_writing
+    def update_many(self,*args,**queryKWs):
+        """
+        Update many entries at once. Rather than change the index one item
+        at a time like update(), the changes are grouped by attribute and 
+        value and each affected list in the index is rewritten once.
         
+        Usage:
+        ------
+        
+        Same as update() for one change applied to every match:
+        
+        >>> DB.update_many({'status':'done'},DB.Q.status=='running')
+        >>> DB.update_many({'status':'done'},status='running')
+        
+        Or a dictionary of {index: updated_dict} for different changes:
+        
+        >>> DB.update_many({0:{'status':'done'},5:{'status':'failed'}})
+        
+        Returns the number of updated items
+        """
+        self._check_frozen()
+        if len(args) == 1 and not queryKWs and _is_change_map(args[0]):
+            changes = []
+            for ix,updated_dict in args[0].items():
+                if not self._index(ix):
+                    raise ValueError('Index {} is not in the DB'.format(ix))
+                changes.append((ix,self._convert2dict(updated_dict)))
+        else:
+            if len(args) == 1:
+                updated_dict,query = args[0],{}
+            elif len(args) == 2:
+                updated_dict,query = args
+            else:
+                raise ValueError('Incorrect number of inputs. See documentation')
+            
+            updated_dict = self._convert2dict(updated_dict)
+            query = self._convert2dict(query)
+            if isinstance(query,Qobj):
+                ixs = self._ixs(query,**queryKWs)
+            elif isinstance(query,dict):
+                queryKWs.update(query)
+                ixs = self._ixs(**queryKWs)
+            else:
+                raise ValueError('Unrecognized query {}. Must be a dict or Qobj'.format(type(query)))
+            if len(ixs) == 0:
+                raise ValueError('Query did not match any results')
+            changes = [(ix,updated_dict) for ix in ixs]
+        
+        for ix,updated_dict in changes:
+            if not isinstance(updated_dict,dict):
+                raise ValueError('Must specify updated values as a dictionary')
+        
+        # Group the index changes: {attrib:{val:[ix,...]}}
+        removed = defaultdict(lambda:defaultdict(list))
+        added = defaultdict(lambda:defaultdict(list))
+        for ix,updated_dict in changes:
+            item = self._convert2dict(self._list[ix])
+            
+            for attrib in updated_dict:
+                if attrib in self.exclude_attributes or not self._is_indexed(attrib):
+                    continue # Not indexed (or not yet if lazy)
+                old,new = item[attrib],updated_dict[attrib]
+                if old == new and type(old) == type(new):
+                    continue
+                self._group_values(removed,attrib,old,ix)
+                self._group_values(added,attrib,new,ix)
+        
+        # Change the index (which checks everything first) then the items
+        self._apply_index_changes(removed,added)
+        for ix,updated_dict in changes:
+            self._preserve_row(ix)
+            item = self._list[ix]
+            self._convert2dict(item).update(updated_dict)
+            self._list[ix] = item # Store it again if not in memory
+        return len(changes)
+    
+    @_writing
+    def upsert(self,item):
+        """
+        Add item or, if an item with the same primary key exists, update that
+        item with its values (like update())
+        
+        Usage
+        -----
+        
+        >>> DB = ldtable(items,primary_key='id')
+        >>> DB.upsert({'id':1234,'status':'done'})
+        """
+        self._check_frozen()
+        if self.primary_key is None:
+            raise ValueError('upsert() requires a primary_key')
+        updated_dict = self._convert2dict(item)
+        ix = self._pk.get(updated_dict.get(self.primary_key))
+        if ix is None:
+            self.add(item)
+            return
+        if updated_dict is self._convert2dict(self._list[ix]):
+            raise ValueError('Item is already in the DB. Use reindex() after changing it directly')
+        self._update_row(ix,updated_dict)
+        
+    @_writing
     def add_attribute(self,attribute,*default):
         """
         Add an attribute to the index attributes.
@@ -357,27 +985,38 @@ class ldtable(object):
         to add an empty list)
         
         """
+        self._check_frozen()
         if attribute in self.exclude_attributes:
             raise ValueError("Can't add exclude_attributes")
         
         attrib = attribute
         if not hasattr(self,'_lookup'):
             self._lookup = {}
-        self._lookup[attribute] = defaultdict(list)
+        if not self.lazy: # Otherwise, _append() will skip it until queried
+            keys = [attribute]
+            if attribute in self.len_attributes:
+                keys.append(_len_key(attribute))
+            for key in keys:
+                self._lookup[key] = defaultdict(list)
+                if self._cow is not None:
+                    self._cow[key] = True
 
         set_default = False
         if len(default) >0:
             set_default = True
             default = default[0]
 
-        for ix,item in enumerate(self._list):
-            if item is None: continue
-            item = self._convert2dict(item)
+        for ix,item0 in enumerate(self._list):
+            if item0 is None: continue
+            item = self._convert2dict(item0)
             try:
                 value = item[attribute]
                 self._append(attrib,value,ix)
             except KeyError as KE:
                 if set_default:
+                    self._preserve_row(ix)
+                    item0 = self._list[ix]
+                    item = self._convert2dict(item0)
                     if hasattr(default, '__call__'):
                         item[attribute] = default()
                     else:
@@ -387,125 +1026,645 @@ class ldtable(object):
 
                 value = item[attribute]
                 self._append(attrib,value,ix)
+                self._list[ix] = item0 # Store it again if not in memory
 
         self.attributes.append(attribute)
 
+    @_writing
     def remove(self,*A,**K):
         """
         Remove item that matches a given attribute or dict. See query() for
         input specification
-
-
-        DB Options:
-        This is set at instantiation but can be changed directly
-        -----------
         
+        All matching items are removed together so that each affected index
+        list is rewritten once. Removed items leave a placeholder (so the
+        index of other items doesn't change). Use compact() to drop them
+        after removing many items.
         """
+        self._check_frozen()
         ixs = list(self._ixs(*A,**K))
 
         if len(ixs) == 0:
             raise ValueError('No matching items')
-
-        items = []
-
-        for ix in ixs[:]: # Must remove it from everything.
-            # not sure what is happening, but it seems that I need to make a copy
-            # since Python is doing something strange here...
-
+        self._remove_ixs(ixs)
+    
+    @_writing
+    def delete(self,key):
+        """
+        Remove the item with primary key `key`. Raises a KeyError if there
+        isn't one
+        """
+        self._check_frozen()
+        if self.primary_key is None:
+            raise ValueError('delete() requires a primary_key')
+        if key not in self._pk:
+            raise KeyError(key)
+        self._remove_ixs([self._pk[key]])
+    
+    def _remove_ixs(self,ixs):
+        """
+        Remove the items at ixs from the index and the list
+        """
+        # Group what needs to be removed from the index so that each list
+        # is only rewritten once no matter how many items are removed
+        removed = defaultdict(lambda:defaultdict(list))
+        for ix in ixs:
             item = self._list[ix]
             item = self._convert2dict(item)
 
             for attrib in self.attributes:
                 value = item[attrib]
-                self._remove(attrib,value,ix)
-                
-            # Remove it from the list by setting to None. Do not reshuffle
-            # the indices. A None check will be performed elsewhere
+                if self._is_indexed(attrib): # Unless lazy and not yet built
+                    self._group_values(removed,attrib,value,ix)
+        
+        self._apply_index_changes(removed,{})
+        
+        # Remove it from the list by setting to None. Do not reshuffle
+        # the indices. A None check will be performed elsewhere
+        for ix in ixs:
+            self._preserve_row(ix,copy_row=False)
+            if isinstance(self._list[ix],TrackedObject):
+                _untrack(self._list[ix],self,ix)
+            self._dirty.pop(ix,None)
             self._list[ix] = None
-            self._ix.difference_update([ix])
-            self.N -= 1
+        self._ix.difference_update(ixs)
+        self.N -= len(ixs)
+    
+    @_writing
+    def compact(self):
+        """
+        Drop the placeholders left by removed items and renumber the rest.
+        This frees memory after removing many items. 
+        
+        Note: This changes the index of items (e.g. DB[ix] and `_index` 
+              queries) and cannot be done while a snapshot is open
+        """
+        self._check_frozen()
+        if self._snapshots:
+            raise ValueError('Cannot compact while a snapshot (or clone) is open')
+        if len(self._list) == self.N:
+            return
+        
+        newix = {ix:i for i,ix in enumerate(sorted(self._ix))}
+        
+        for attrib,lookup in list(self._lookup.items()):
+            new_lookup = defaultdict(list)
+            for val,ixs in lookup.items():
+                if len(ixs) > 0:
+                    new_lookup[val] = [newix[ix] for ix in ixs]
+            self._lookup[attrib] = new_lookup
+        self._pk = {key:newix[ix] for key,ix in self._pk.items()}
+        self._dirty = {newix[ix]:recorded for ix,recorded in self._dirty.items()}
+        if self.indexObjects:
+            for ix,item in enumerate(self._list):
+                if isinstance(item,TrackedObject):
+                    _untrack(item,self,ix)
+                    _track(item,self,newix[ix])
+        
+        if self.storage is not None:
+            self._list.renumber(newix)
+        else:
+            self._list = [self._list[ix] for ix in sorted(newix)]
+        self._ix = set(range(len(newix)))
+        self._cow = None
+        self._time = time.time()
     
     def items(self):
         """
         Return a list of items.
         """
-        for item in self._list:
+        items = self._list
+        if self._lock is not None:
+            with self._lock.reading():
+                items = list(items)
+        for item in items:
             if item is None:
                 continue
             yield item
-            
-    @property
-    def Qobj(self):
+    
+    @classmethod
+    def from_jsonl(cls,path,chunksize=10000,**kwargs):
         """
-        Query object already loaded with the DB
+        Create a DB from a JSON Lines file (one item per line) without 
+        reading the whole file into memory first.
         
-            DB.Qobj <==> DB.Q <==> Qobj(DB)
+        Usage
+        -----
+        
+        >>> DB = ldtable.from_jsonl('DB.jsonl')
+        >>> DB = ldtable.from_jsonl('DB.jsonl',primary_key='id')
+        
+        Inputs:
+        -------
+        path
+            Path or an open file
+        
+        chunksize [10000]
+            Number of items read before they are added
+        
+        **kwargs
+            Passed to ldtable()
         """
-        return Qobj(self)
-    Q = Qobj
+        DB = cls(**kwargs)
+        with _open(path,'r') as F:
+            items = (json.loads(line) for line in F if line.strip())
+            _add_chunks(DB,items,chunksize)
+        return DB
     
-    def _convert2dict(self,obj):
+    @classmethod
+    def from_csv(cls,path,types=None,chunksize=10000,**kwargs):
         """
-        Convert objects to a regular dictionary for the sake of indexing
+        Create a DB from a CSV file with a header row without reading the 
+        whole file into memory first.
         
-        Also return Qobjs untouched since they may be used in queries too
+        Usage
+        -----
         
-        If it not an Qobj or dict, it will try to get it's __dict__ and if
-        that doesn't work, will just return it
-        """
-        if isinstance(obj,Qobj):
-            return obj
+        >>> DB = ldtable.from_csv('DB.csv',types={'born':int})
+        >>> DB = ldtable.from_csv('DB.csv',types={'role':json.loads}) # Lists
         
-        if isinstance(obj,dict): # Also accounts for OrderedDicts or ...
-            return obj           # ... anything that inherits dict
+        Inputs:
+        -------
+        path
+            Path or an open file
         
-        if self.indexObjects and hasattr(obj,'__dict__'):
-            return obj.__dict__
-            
-        return obj
+        types [None]
+            Dictionary of {column:function} to convert the values. Otherwise 
+            everything is a string
+        
+        chunksize [10000]
+            Number of items read before they are added
         
+        **kwargs
+            Passed to ldtable()
+        """
+        if types is None:
+            types = dict()
+        DB = cls(**kwargs)
+        with _open(path,'r',newline='') as F:
+            items = _typed_rows(csv.DictReader(F),types)
+            _add_chunks(DB,items,chunksize)
+        return DB
     
-    def _ixs(self,*args,**kwords):
+    def to_jsonl(self,path,*A,**K):
+        """
+        Write the items (or those matching a query) as JSON Lines. Items are
+        written one at a time.
+        
+        Usage
+        -----
+        
+        >>> DB.to_jsonl('DB.jsonl')
+        >>> DB.to_jsonl('guitar.jsonl',role='guitar') # See query()
+        
+        Returns the number of items written
         """
-        Get the inde(x/ies) of matching information
+        items = self.query(*A,**K) if (A or K) else self.items()
+        n = 0
+        with _open(path,'w') as F:
+            for item in items:
+                F.write(_text(json.dumps(self._convert2dict(item))) + '\n')
+                n += 1
+        return n
+    
+    def to_csv(self,path,*A,**K):
         """
-        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
-            return []
- 
-        # Make the entire kwords be lists with default of []. Edge case of
-        # multiple items
-        for key,val in kwords.items():
-            if not isinstance(val,list):
-                kwords[key] = [val]
-        kwords = defaultdict(list,kwords)
+        Write the indexed attributes of the items (or those matching a query)
+        as CSV. Items are written one at a time.
         
-        Q = Qobj(self) # Empty object
-        for arg in args:
-            arg = self._convert2dict(arg) # handle other object types
-            if isinstance(arg,Qobj):
-                Q = Q & arg # Will add these conditions. If Q is empty, will just be arg
-                continue
-            if isinstance(arg,dict):
-                for key,val in arg.items(): # Add it rather than update in case it is already specified
-                    kwords[key].append(val)
-            else:
-                raise ValueError('unrecognized input of type {:s}'.format(str(type(arg))))
+        Usage
+        -----
         
-        # Construct a query for kwords
-        for key,value in kwords.items():
-            if isinstance(value,list) and len(value) == 0:
-                value = [self._empty]
-            for val in _makelist(value):
-                Qtmp = Qobj(self)
-                Qtmp._attr = key
-                Q = Q & (Qtmp == val)
-
+        >>> DB.to_csv('DB.csv')
+        >>> DB.to_csv('guitar.csv',role='guitar') # See query()
+        
+        List values are written as JSON so they may be read back with
+        `from_csv(...,types={'attribute':json.loads})`. Attributes that are
+        not indexed are not written.
+        
+        Returns the number of items written
+        """
+        items = self.query(*A,**K) if (A or K) else self.items()
+        n = 0
+        with _open(path,'w',newline='') as F:
+            writer = csv.writer(F)
+            writer.writerow(self.attributes)
+            for item in items:
+                item = self._convert2dict(item)
+                writer.writerow([json.dumps(item[attrib]) if isinstance(item[attrib],list) 
+                                 else item[attrib] for attrib in self.attributes])
+                n += 1
+        return n
+    
+    @_reading
+    def to_columns(self,query=None,attrs=None,format='dict'):
+        """
+        Return the attributes of the items (or those matching a query) as 
+        columns rather than a list of items.
+        
+        Usage
+        -----
+        
+        >>> DB.to_columns(DB.Q.born < 1941,attrs=['first','born'],format='pandas')
+        >>> DB.to_columns({'role':'guitar'},format='numpy')
+        
+        Inputs:
+        -------
+        query [None]
+            A dict or Qobj (see query()). Default is all items
+        
+        attrs [None]
+            Attributes to return. Default is all indexed attributes
+        
+        format ['dict']
+            'dict'   : OrderedDict of {attribute:column}
+            'numpy'  : OrderedDict of {attribute:numpy array}
+            'pandas' : pandas DataFrame
+            'arrow'  : pyarrow Table
+        
+        Columns are in the order the items were added. If every value of an 
+        attribute is an int (or every one is a float), the column is built 
+        directly as an array.array that numpy, pandas, and pyarrow then use 
+        without a copy. Otherwise it is a list (and an object column).
+        """
+        if format not in ('dict','numpy','pandas','arrow'):
+            raise ValueError("format must be 'dict', 'numpy', 'pandas', or 'arrow'")
+        
+        if query is None:
+            ixs = sorted(self._ix)
+        else:
+            ixs = self._ixs(query)
+        if attrs is None:
+            attrs = self.attributes
+        
+        rows = [self._convert2dict(self._list[ix]) for ix in ixs]
+        columns = OrderedDict((attr,_column(rows,attr)) for attr in attrs)
+        if format == 'dict':
+            return columns
+        
+        if format == 'arrow':
+            try:
+                import pyarrow as pa
+            except ImportError:
+                raise ImportError("format='arrow' requires pyarrow")
+            arrays = []
+            for col in columns.values():
+                if isinstance(col,array):
+                    if col.typecode == 'd':
+                        dtype = pa.float64()
+                    else:
+                        dtype = pa.int64() if col.itemsize == 8 else pa.int32()
+                    arrays.append(pa.Array.from_buffers(dtype,len(col),[None,pa.py_buffer(col)]))
+                else:
+                    arrays.append(pa.array(col))
+            return pa.Table.from_arrays(arrays,names=list(columns))
+        
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("format='{}' requires numpy".format(format))
+        for attr,col in columns.items():
+            if isinstance(col,array):
+                columns[attr] = np.frombuffer(col,dtype=col.typecode)
+            else:
+                arr = np.empty(len(col),dtype=object)
+                arr[:] = col
+                columns[attr] = arr
+        if format == 'numpy':
+            return columns
+        
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("format='pandas' requires pandas")
+        return pd.DataFrame(columns,copy=False)
+            
+    @_reading
+    def snapshot(self):
+        """
+        Return a read-only, point-in-time view of the DB. It may be queried
+        like the DB (and its Qobjs never go out of date) while the DB keeps 
+        changing.
+        
+        Usage
+        -----
+        
+        >>> with DB.snapshot() as snap:
+        ...     rows = list(snap.query(snap.Q.born < 1941))
+        
+        Nothing is copied up front. The DB and snapshot share the items and
+        index and the DB copies an attribute's lookup (and the list of a
+        value) the first time it changes it. Changed or removed items are 
+        given to the snapshot before they are modified so a write is only 
+        slower by that one copy. Reading a snapshot never waits on the lock.
+        
+        Close it (or use as a context manager) when done so the DB can stop 
+        copying.
+        """
+        return _Snapshot(self)
+    
+    @_reading
+    def clone(self):
+        """
+        Return a copy of the DB that may be changed without changing this one
+        (and vice versa).
+        
+        Usage
+        -----
+        
+        >>> whatif = DB.clone()
+        >>> whatif.update({'status':'done'},status='open')
+        >>> whatif.count(status='done')
+        
+        Nothing is copied up front. Like snapshot(), the clone shares the 
+        items and index and each side copies an attribute's lookup (and the 
+        list of a value) the first time it changes it. Items are copied the 
+        first time either side changes (or removes) them so a change costs 
+        about the same as it would otherwise. The clone's set of item indices
+        is copied the first time it adds or removes (or negates in a query).
+        
+        Change a clone's items with update(), update_many(), etc. Items 
+        changed directly (or TrackedObject attributes set) may be shared with
+        this DB. Delete the clone when done so this DB can stop copying.
+        
+        Note: This DB cannot be compacted while the clone exists. A clone of 
+              a DB with `storage` reads unchanged items from the file and 
+              keeps its changes in memory
+        """
+        if self._frozen:
+            raise ValueError('Cannot clone a frozen DB')
+        return _Clone(self)
+    
+    @_writing
+    def freeze(self,gc_freeze=False,shared=False):
+        """
+        Convert the DB into a read-only form meant to be shared with forked
+        worker processes. Any further add/update/remove/reindex will raise a
+        ValueError.
+        
+        The index lists for every attribute are packed into a single flat
+        array of row indices (with each value being a view into it) so they 
+        are not many separate Python objects.
+        
+        Inputs:
+        -------
+        gc_freeze [False]
+            If True, call gc.freeze() (Python 3.7+) so that the garbage 
+            collector doesn't touch (and therefore copy) the existing objects 
+            in forked processes. Do this right before forking
+        
+        shared [False]
+            If True (Python 3.8+), the flat array lives in a 
+            multiprocessing.shared_memory block. The DB may then be pickled to 
+            spawned processes and they will attach to the block rather than 
+            get a copy. Call unlink() when done.
+        
+        Note: Items themselves are still Python objects and reading them
+              updates their reference counts.
+        """
+        if self._frozen:
+            return
+        if shared and shared_memory is None:
+            raise ValueError('shared=True requires Python 3.8+')
+        if self.storage is not None:
+            raise ValueError('Cannot freeze with storage')
+        
+        self.lazy = False # Build everything and never evict
+        if not hasattr(self,'_lookup'):
+            self._lookup = {}
+        attributes = [attrib for attrib in self.attributes if attrib != self.primary_key]
+        attributes += [_len_key(attrib) for attrib in self.attributes 
+                       if attrib in self.len_attributes]
+        for attrib in attributes:
+            if attrib not in self._lookup:
+                self._build_lookup(attrib)
+        
+        layout = [(attrib,[(val,sorted(ixs)) for val,ixs in self._lookup[attrib].items()])
+                  for attrib in attributes]
+        flat = array(_INT_TYPECODE)
+        for _,vals in layout:
+            for _,ixs in vals:
+                flat.extend(ixs)
+        
+        if shared:
+            self._shm = _SharedBuffer(len(flat))
+            buf = self._shm.view
+            buf[:] = flat
+        else:
+            buf = _flat_view(flat)
+        
+        self._set_frozen_lookup(buf,[(attrib,[(val,len(ixs)) for val,ixs in vals])
+                                     for attrib,vals in layout])
+        
+        self._list = tuple(self._list)
+        self._ix = frozenset(self._ix)
+        self._frozen = True
+        
+        if gc_freeze and hasattr(gc,'freeze'):
+            gc.collect()
+            gc.freeze()
+    
+    @_writing
+    def unlink(self):
+        """
+        Free the shared memory of a DB frozen with shared=True. This DB (and
+        any other process attached to it) may no longer be queried.
+        """
+        if self._shm is None:
+            return
+        self._lookup = {}
+        self._frozen_buf = None
+        self._shm.close(unlink=True)
+        self._shm = None
+    
+    def _set_frozen_lookup(self,buf,layout):
+        """
+        Set _lookup to read-only views into buf where layout is
+        [(attrib,[(val,length),...]),...] in buffer order
+        """
+        self._frozen_buf = buf
+        self._frozen_layout = layout
+        self._lookup = {}
+        start = 0
+        for attrib,vals in layout:
+            lookup = {}
+            for val,n in vals:
+                lookup[val] = buf[start:start+n]
+                start += n
+            self._lookup[attrib] = lookup
+        if self._shm is not None:
+            self._shm.lookup = self._lookup
+    
+    def _check_frozen(self):
+        if self._frozen:
+            raise ValueError('Cannot modify a frozen DB')
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = self._lock is not None # Locks cannot be pickled
+        state['_index_lock'] = None
+        state['_snapshots'] = None # Snapshots are not pickled with it
+        state['_cow'] = None
+        state['_sorted'] = {} # Rebuilt when needed
+        if not self._frozen:
+            return state
+        # memoryviews cannot be pickled. Send the flat array or the name of
+        # the shared block and rebuild the views
+        del state['_lookup']
+        state['_frozen_buf'] = None
+        if self._shm is not None:
+            state['_shm'] = (self._shm.size,self._shm.name)
+        else:
+            state['_frozen_flat'] = getattr(self._frozen_buf,'obj',self._frozen_buf)
+        return state
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = _RWLock() if self._lock else None
+        self._index_lock = threading.RLock() if self._lock else None
+        self._snapshots = weakref.WeakSet()
+        if self.indexObjects:
+            for ix,item in enumerate(self._list):
+                if isinstance(item,TrackedObject):
+                    _track(item,self,ix)
+        if not self._frozen:
+            return
+        if self._shm is not None:
+            self._shm = _SharedBuffer(*self._shm)
+            buf = self._shm.view
+        else:
+            buf = _flat_view(self.__dict__.pop('_frozen_flat'))
+        self._set_frozen_lookup(buf,self._frozen_layout)
+    
+    @property
+    def Qobj(self):
+        """
+        Query object already loaded with the DB
+        
+            DB.Qobj <==> DB.Q <==> Qobj(DB)
+        """
+        return Qobj(self)
+    Q = Qobj
+    
+    def _convert2dict(self,obj):
+        """
+        Convert objects to a regular dictionary for the sake of indexing
+        
+        Also return Qobjs untouched since they may be used in queries too
+        
+        If it not an Qobj or dict, it will try to get it's __dict__ and if
+        that doesn't work, will just return it
+        """
+        if isinstance(obj,Qobj):
+            return obj
+        
+        if isinstance(obj,dict): # Also accounts for OrderedDicts or ...
+            return obj           # ... anything that inherits dict
+        
+        if self.indexObjects and hasattr(obj,'__dict__'):
+            return obj.__dict__
+            
+        return obj
+        
+    
+    def _ixs(self,*args,**kwords):
+        """
+        Get the inde(x/ies) of matching information in ascending order. The
+        `_after` and `_limit` keywords return only those after an index and
+        at most _limit of them
+        """
+        after = kwords.pop('_after',None)
+        limit = kwords.pop('_limit',None)
+        if limit is not None and limit < 0:
+            raise ValueError('_limit must be non-negative')
+        start = 0 if after is None else after + 1
+        
+        ixs = self._matches(*args,**kwords) if not start else \
+              self._matches_from(start,args,kwords)
+        if not isinstance(ixs,(set,frozenset,_Complement)): 
+            # From the index and already in order. Slice (copy) just the page
+            i = bisect_left(ixs,start) if start else 0
+            return list(ixs[i:] if limit is None else ixs[i:i + limit])
+        
+        if isinstance(ixs,_Complement):
+            if limit is not None: # Most match so walk from after
+                page = []
+                for ix in range(start,len(self._list)):
+                    if len(page) >= limit:
+                        break
+                    if ix in ixs:
+                        page.append(ix)
+                return page
+            ixs = ixs.universe - ixs.ixs
+        if after is not None:
+            ixs = [ix for ix in ixs if ix >= start]
+        if limit is not None: # Without sorting all of them
+            return heapq.nsmallest(limit,ixs)
+        # Sets of ints iterate nearly in order so this is close to linear
+        return sorted(ixs)
+    
+    def _matches(self,*args,**kwords):
+        """
+        Get the matching indices as a set (or _Complement) without listing
+        them. A query of a single value is the (ascending) list from the
+        index itself and must not be modified
+        """
+        return self._matches_from(0,args,kwords)
+    
+    def _matches_from(self,start,args,kwords):
+        """
+        _matches() but indices below start may be left out so that a page 
+        (see _ixs) doesn't evaluate the matches before it
+        """
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return []
+        
+        Q = self._build_query(*args,**kwords)
+        ixs = Q._posting()
+        if ixs is not None:
+            return ixs
+        if start and Q._node is not None:
+            Q = Q.copy() # Not cached since it is only part of the matches
+            Q._start = start
+            return Q._evaluate()[1]
         ixs = Q._ixs
         # Ensure one match
         if ixs is None:
             ixs = []
-        return list(ixs)
+        return ixs
+    
+    def _build_query(self,*args,**kwords):
+        """
+        Combine the arguments of a query into a single Qobj
+        """
+        # Make the entire kwords be lists with default of []. Edge case of
+        # multiple items
+        for key,val in kwords.items():
+            if not isinstance(val,list):
+                kwords[key] = [val]
+        kwords = defaultdict(list,kwords)
         
+        Q = Qobj(self) # Empty object
+        for arg in args:
+            arg = self._convert2dict(arg) # handle other object types
+            if isinstance(arg,Qobj):
+                Q = Q & arg # Will add these conditions. If Q is empty, will just be arg
+                continue
+            if isinstance(arg,dict):
+                for key,val in arg.items(): # Add it rather than update in case it is already specified
+                    kwords[key].append(val)
+            else:
+                raise ValueError('unrecognized input of type {:s}'.format(str(type(arg))))
+        
+        # Construct a query for kwords
+        for key,value in kwords.items():
+            if isinstance(value,list) and len(value) == 0:
+                value = [self._empty]
+            for val in _makelist(value):
+                Qtmp = Qobj(self)
+                Qtmp._attr = key
+                Q = Q & (Qtmp == val)
+        return Q
     
     def _index(self,ix):
         """
@@ -521,6 +1680,637 @@ class ldtable(object):
         
         return [ix]
     
+    def _get_lookup(self,attrib,query=False):
+        """
+        Return the lookup for attrib. If lazy, build it first if needed and 
+        evict any that haven't been used recently. Set query=True where a 
+        query reads it so it is counted as a use (see index_stats())
+        """
+        if not self.lazy:
+            return self._lookup[attrib]
+        return self._lazy_lookup(attrib,query)
+    
+    def _peek_lookup(self,attrib):
+        """
+        Return the lookup for attrib or None if it isn't built. Never builds
+        or counts a use (e.g. for estimates)
+        """
+        return getattr(self,'_lookup',{}).get(attrib)
+    
+    @_indexing
+    def _lazy_lookup(self,attrib,query=False):
+        now = time.time()
+        use = self._use(attrib)
+        if query:
+            self._last_used[attrib] = now
+            use['queries'] += 1
+            use['hits'] += 1
+            use['last_used'] = now
+        else:
+            self._last_used.setdefault(attrib,now) # So it may be evicted
+        
+        if self.lazy_evict is not None:
+            for attr,last in list(self._last_used.items()):
+                if now - last > self.lazy_evict:
+                    self._evict(attr)
+                    self._last_used.pop(attr,None)
+        
+        # Use the returned lookup since another thread may evict it
+        lookup = self._lookup.get(attrib)
+        if lookup is None:
+            if _is_len_key(attrib):
+                self._lazy_lookup(attrib[1])
+            lookup = self._build_lookup(attrib)
+            use['builds'] += 1
+            use['hits'] = int(query)
+            if self.index_budget is not None:
+                self._enforce_budget(attrib)
+        elif self.index_budget is not None:
+            use['priority'] = self._inflation + float(use['hits'])/max(use['bytes'],1)
+        return lookup
+    
+    def _use(self,attrib):
+        use = self._index_use.get(attrib)
+        if use is None:
+            use = self._index_use[attrib] = {'queries':0,'hits':0,'builds':0,'evictions':0,
+                                             'bytes':0,'last_used':None,'priority':0.0}
+        return use
+    
+    def _evict(self,attrib):
+        """
+        Drop the (lazy) index of attrib (and its len index). It is rebuilt
+        when next queried
+        """
+        for key in (attrib,_len_key(attrib)):
+            if self._lookup.pop(key,None) is not None:
+                self._use(key)['evictions'] += 1
+        self._stats.pop(attrib,None) # No longer kept up to date
+    
+    def _index_bytes(self,attrib):
+        """
+        Approximate size of the index of attrib. The values are not included
+        since they are (usually) the same objects as in the items
+        """
+        lookup = getattr(self,'_lookup',{}).get(attrib)
+        if lookup is None:
+            return 0
+        return sys.getsizeof(lookup) + sum(sys.getsizeof(ixs) for ixs in lookup.values())
+    
+    def _enforce_budget(self,keep):
+        """
+        Evict indexes until they are under index_budget starting with the 
+        least valuable. This is GreedyDual-Size-Frequency: the priority of 
+        an index is its uses per byte plus the priority of the last evicted
+        index at the time (so ones not used recently fall behind). keep (just
+        built) is only evicted (alone) if it doesn't fit by itself.
+        """
+        sizes = {}
+        for key in list(self._lookup):
+            sizes[key] = self._use(key)['bytes'] = self._index_bytes(key)
+        total = sum(sizes.values())
+        use = self._use(keep)
+        use['priority'] = self._inflation + float(use['hits'])/max(sizes.get(keep,0),1)
+        if total <= self.index_budget:
+            return
+        if sizes.get(keep,0) > self.index_budget: # Too big. Used once and dropped
+            self._evict(keep)
+            return
+        
+        protected = set([keep,keep[1]]) if _is_len_key(keep) else set([keep])
+        order = sorted((key for key in sizes if key not in protected),
+                       key=lambda key: self._use(key)['priority'])
+        for key in order:
+            if total <= self.index_budget:
+                break
+            if key not in self._lookup: # Already evicted with its attribute
+                continue
+            self._inflation = max(self._inflation,self._use(key)['priority'])
+            total -= sizes[key] + sizes.get(_len_key(key),0)*(_len_key(key) in self._lookup)
+            self._evict(key)
+    
+    def _build_lookup(self,attrib):
+        """
+        Build the lookup for a single attribute from the stored items. Does
+        not change the modify time since the data hasn't changed
+        """
+        lookup = defaultdict(list)
+        for ix,item in enumerate(self._list):
+            if item is None: continue
+            item = self._convert2dict(item)
+            if _is_len_key(attrib):
+                lookup[len(_makelist(item[attrib[1]]))].append(ix)
+                continue
+            valueL = _uniquelist(_makelist(item[attrib]))
+            for val in valueL:
+                if attrib in self.partial and not self._indexable(attrib,val):
+                    continue
+                lookup[val].append(ix)
+            if len(valueL) == 0:
+                lookup[self._empty].append(ix)
+        self._lookup[attrib] = lookup
+        if self._cow is not None:
+            self._cow[attrib] = True
+        return lookup
+    
+    def _find_ix(self,item):
+        """
+        Return the index of item (which may also be an index)
+        """
+        if isinstance(item,int):
+            if not self._index(item):
+                raise ValueError('Index {} is not in the DB'.format(item))
+            return item
+        
+        # Look where it should be in the index before checking everything
+        row = self._convert2dict(item)
+        candidates = ()
+        if self.primary_key is not None:
+            candidates = [self._pk.get(row.get(self.primary_key))]
+        elif hasattr(self,'_lookup'):
+            for attrib in self.attributes:
+                if attrib not in self._lookup:
+                    continue
+                valueL = _makelist(row.get(attrib)) or [self._empty]
+                if self._indexable(attrib,valueL[0]):
+                    candidates = self._lookup[attrib].get(valueL[0],())
+                    break
+        for ix in candidates:
+            if ix is not None and self._list[ix] is item:
+                return ix
+        for ix,it in enumerate(self._list):
+            if it is item:
+                return ix
+        raise ValueError('Item is not in the DB')
+    
+    def _reindex_dirty(self,attributes):
+        """
+        Update the index of attributes for the items given to mark_dirty()
+        """
+        removed = defaultdict(lambda:defaultdict(list))
+        added = defaultdict(lambda:defaultdict(list))
+        search = defaultdict(list) # {attrib:[ix,...]} with unknown old values
+        for ix,recorded in self._dirty.items():
+            if self._list[ix] is None:
+                continue
+            row = self._convert2dict(self._list[ix])
+            for attrib in attributes:
+                if attrib not in recorded or not self._is_indexed(attrib):
+                    continue # Added or (if lazy) dropped since. Nothing to do
+                old,new = recorded[attrib],row[attrib]
+                if old == new and type(old) == type(new):
+                    if not self._in_index(attrib,new,ix):
+                        search[attrib].append(ix) # Marked after changing
+                    continue
+                self._group_values(removed,attrib,old,ix)
+                self._group_values(added,attrib,new,ix)
+        
+        for attrib,ixs in search.items():
+            ixs = set(ixs)
+            if attrib == self.primary_key:
+                found = [(attrib,key,ix) for key,ix in self._pk.items() if ix in ixs]
+            else:
+                keys = [key for key in (attrib,_len_key(attrib)) if key in self._lookup]
+                found = [(key,val,ix) for key in keys 
+                                      for val,ixs_at in self._lookup[key].items()
+                                      for ix in ixs.intersection(ixs_at)]
+            for key,val,ix in found:
+                removed[key][val].append(ix)
+            for ix in ixs:
+                self._group_values(added,attrib,self._convert2dict(self._list[ix])[attrib],ix)
+        
+        self._apply_index_changes(removed,added)
+        self._clear_dirty(attributes)
+    
+    def _in_index(self,attrib,value,ix):
+        """
+        Whether ix is in the index for every (indexed) val of value
+        """
+        if attrib == self.primary_key:
+            return self._pk.get(value) == ix
+        lookup = self._lookup[attrib]
+        valueL = _makelist(value) or [self._empty]
+        return all(ix in lookup.get(val,()) for val in valueL
+                   if self._indexable(attrib,val))
+    
+    def _clear_dirty(self,attributes):
+        for ix,recorded in list(self._dirty.items()):
+            for attrib in attributes:
+                recorded.pop(attrib,None)
+            if not recorded:
+                del self._dirty[ix]
+    
+    def _is_indexed(self,attrib):
+        """
+        Whether attrib currently has an index (lazy attributes may not)
+        """
+        return attrib in self._lookup or attrib == self.primary_key
+    
+    def _check_key(self,key,ixs=()):
+        """
+        Raise a ValueError if key can't be the primary key of a new item (or 
+        of the items at ixs)
+        """
+        if isinstance(key,list):
+            raise ValueError('Primary key values cannot be lists')
+        ix = self._pk.get(key)
+        if ix is not None and ix not in ixs:
+            raise ValueError('Duplicate primary key {!r}'.format(key))
+    
+    def _build_pk(self):
+        """
+        Build the primary key map from the stored items
+        """
+        pk = {}
+        for ix,item in enumerate(self._list):
+            if item is None: continue
+            key = self._convert2dict(item)[self.primary_key]
+            if isinstance(key,list) or key in pk:
+                raise ValueError('Duplicate or list primary key {!r}'.format(key))
+            pk[key] = ix
+        self._pk = pk
+        if self._cow is not None:
+            self._cow[self.primary_key] = True
+        self._time = time.time()
+    
+    def _indexable(self,attrib,val):
+        """
+        Whether val of attrib is indexed based on the partial rules. Empty
+        lists are always indexed
+        """
+        rule = self.partial.get(attrib)
+        if rule is None or val is self._empty:
+            return True
+        if hasattr(rule,'__call__'):
+            return bool(rule(val))
+        return val not in rule
+    
+    def _partial_ixs(self,attrib,val):
+        """
+        Return the set of ixs for a value that is not indexed because of a
+        partial rule.
+        
+        If only one value is excluded, then anything that is not indexed must 
+        be that value and it is just the complement. Otherwise, they have to
+        be checked
+        """
+        lookup = self._get_lookup(attrib)
+        indexed = set()
+        for ixs_at in lookup.values():
+            indexed.update(ixs_at)
+        
+        rule = self.partial[attrib]
+        if not hasattr(rule,'__call__') and len(rule) == 1:
+            ixs = self._ix - indexed
+            check = indexed # Lists may have both
+        else:
+            ixs = set()
+            check = self._ix
+        
+        for ix in check:
+            item = self._convert2dict(self._list[ix])
+            if val in _makelist(item[attrib]):
+                ixs.add(ix)
+        return ixs
+    
+    def _own(self,attrib,valueL=None):
+        """
+        Copy-on-write: Make sure that the lookup for attrib and the lists for 
+        each value are not shared with a snapshot before they are modified
+        """
+        if not self._sharing(): # They have all been closed. See _release_cow()
+            return
+        owned = self._cow.get(attrib)
+        if owned is True:
+            return
+        if attrib == self.primary_key:
+            self._pk = dict(self._pk)
+            self._cow[attrib] = True
+            return
+        lookup = self._lookup[attrib]
+        if owned is None:
+            lookup = self._lookup[attrib] = defaultdict(list,lookup)
+            owned = self._cow[attrib] = set()
+        if valueL is None: # Just the lookup
+            return
+        if len(valueL) == 0:
+            valueL = [self._empty]
+        for val in valueL:
+            if val not in owned:
+                lookup[val] = list(lookup.get(val,()))
+                owned.add(val)
+    
+    def _group_values(self,group,attrib,value,ix):
+        """
+        Add ix to group[attrib][val] for each indexed val of value
+        """
+        if attrib == self.primary_key:
+            if isinstance(value,list):
+                raise ValueError('Primary key values cannot be lists')
+            group[attrib][value].append(ix)
+            return
+        valueL = _makelist(value)
+        if _len_key(attrib) in self._lookup:
+            group[_len_key(attrib)][len(valueL)].append(ix)
+        if attrib not in self._lookup:
+            return
+        for val in _uniquelist(valueL) or [self._empty]:
+            if attrib in self.partial and not self._indexable(attrib,val):
+                continue
+            group[attrib][val].append(ix)
+    
+    def _apply_index_changes(self,removed,added):
+        """
+        Apply grouped index changes where removed and added are 
+        {attrib:{val:[ix,...]}}. Each affected list is rewritten once (or,
+        for a few removals, copied and removed from directly) and every new 
+        list is built and checked before any is changed
+        """
+        new_lists = []
+        pk = self.primary_key
+        if pk in removed or pk in added:
+            pk_removed,pk_added = removed.get(pk,{}),added.get(pk,{})
+            for key,ixs in pk_removed.items():
+                if len(ixs) > 1 or self._pk.get(key) != ixs[0]:
+                    raise ValueError('Item not found in internal lookup. May need to first call reindex()')
+            for key,ixs in pk_added.items():
+                if len(ixs) > 1 or (key in self._pk and key not in pk_removed):
+                    raise ValueError('Duplicate primary key {!r}'.format(key))
+        
+        for attrib in set(removed) | set(added):
+            if attrib == pk:
+                continue
+            lookup = self._lookup[attrib]
+            rm_attrib = removed.get(attrib,{})
+            add_attrib = added.get(attrib,{})
+            for val in set(rm_attrib) | set(add_attrib):
+                old = lookup.get(val,[])
+                ixs = old
+                rm = rm_attrib.get(val)
+                if rm and len(rm) <= 8:
+                    ixs = list(old)
+                    try:
+                        for ix in rm:
+                            ixs.remove(ix)
+                    except ValueError:
+                        raise ValueError('Item not found in internal lookup. May need to first call reindex()')
+                elif rm:
+                    rmset = set(rm)
+                    ixs = [ix for ix in old if ix not in rmset]
+                    if len(ixs) + len(rm) != len(old):
+                        raise ValueError('Item not found in internal lookup. May need to first call reindex()')
+                add = add_attrib.get(val)
+                if add:
+                    ixs = sorted(ixs + add)
+                elif not rm:
+                    continue
+                new_lists.append((attrib,val,ixs,val not in lookup,len(old)))
+        
+        for attrib,val,ixs,new_key,nold in new_lists:
+            if self._cow is not None:
+                self._own(attrib)
+                owned = self._cow.get(attrib)
+                if owned is not None and owned is not True:
+                    owned.add(val) # The new list is not shared
+            self._lookup[attrib][val] = ixs
+            if new_key:
+                self._sorted_change(attrib,added=[val])
+            self._stats_change(attrib,val,nold,len(ixs))
+        
+        if pk in removed or pk in added:
+            if self._cow is not None:
+                self._own(pk)
+            for key in pk_removed:
+                del self._pk[key]
+            for key,ixs in pk_added.items():
+                self._pk[key] = ixs[0]
+            self._sorted_change(pk,added=[key for key in pk_added if key not in pk_removed],
+                                   removed=[key for key in pk_removed if key not in pk_added])
+            for key in set(pk_removed).symmetric_difference(pk_added):
+                self._stats_change(pk,key,int(key in pk_removed),int(key in pk_added))
+        
+        self._time = time.time()
+    
+    def _value_count(self,attrib,val):
+        """Number of items with val from the index or None if not built"""
+        if attrib == self.primary_key:
+            return int(val in self._pk)
+        lookup = self._peek_lookup(attrib)
+        if lookup is None:
+            return None
+        return len(lookup.get(val,()))
+    
+    def _analyze(self,attrib,bins,mcv):
+        """
+        Compute the statistics of attrib from the index. See analyze()
+        """
+        if attrib == self.primary_key:
+            counts = dict.fromkeys(self._pk,1)
+        else:
+            counts = {val:len(ixs) for val,ixs in self._get_lookup(attrib).items() if len(ixs)}
+        st = {'bins':bins,'mcv_size':mcv,'values':sum(counts.values()),
+              'distinct':len(counts),'nulls':0}
+        for null in (None,self._empty):
+            st['nulls'] += counts.pop(null,0)
+        
+        common = sorted(counts,key=counts.get,reverse=True)[:mcv]
+        st['mcv'] = dict.fromkeys(common)
+        st['mcv_min'] = counts[common[-1]] if len(common) >= mcv and common else 0
+        
+        # Equal count (equi-depth) histogram
+        try:
+            keys = sorted(counts)
+        except TypeError: # Not orderable
+            keys = None
+        st['bounds'] = st['depths'] = None
+        if keys:
+            target = float(sum(counts.values()))/bins
+            bounds,depths = [keys[0]],[]
+            total = done = 0
+            for key in keys:
+                total += counts[key]
+                if total - done >= target and len(depths) < bins - 1:
+                    bounds.append(key)
+                    depths.append(total - done)
+                    done = total
+            if total > done or not depths:
+                bounds.append(keys[-1])
+                depths.append(total - done)
+            st['bounds'],st['depths'] = bounds,depths
+        return st
+    
+    def _stats_change(self,attrib,val,old,new):
+        """
+        Update the statistics (if analyzed) for the count of items with val 
+        going from old to new
+        """
+        st = self._stats.get(attrib)
+        if st is None or old == new:
+            return
+        delta = new - old
+        if old == 0:
+            st['distinct'] += 1
+        elif new == 0:
+            st['distinct'] -= 1
+        st['values'] += delta
+        if val is None or val is self._empty:
+            st['nulls'] += delta
+            return
+        
+        bounds = st['bounds']
+        if bounds is not None:
+            try:
+                if val < bounds[0]:
+                    bounds[0] = val
+                elif val > bounds[-1]:
+                    bounds[-1] = val
+                i = min(max(bisect_left(bounds,val) - 1,0),len(st['depths']) - 1)
+            except TypeError: # No longer orderable
+                st['bounds'] = st['depths'] = None
+            else:
+                st['depths'][i] = max(st['depths'][i] + delta,0)
+        
+        mcv = st['mcv']
+        if delta > 0 and val not in mcv and new > st['mcv_min']:
+            mcv[val] = None
+            if len(mcv) > st['mcv_size']:
+                counts = [(self._value_count(attrib,v) or 0,v) for v in mcv]
+                del mcv[min(counts,key=lambda c:c[0])[1]]
+            if len(mcv) >= st['mcv_size'] and mcv:
+                st['mcv_min'] = min(self._value_count(attrib,v) or 0 for v in mcv)
+        elif delta < 0 and val in mcv:
+            st['mcv_min'] = min(st['mcv_min'],new)
+    
+    def _range_fraction(self,op,attrib,value):
+        """
+        Estimated fraction of items with a value `op` value from the 
+        histogram or None if there isn't one
+        """
+        st = self._stats.get(attrib)
+        if st is None or st['bounds'] is None or not st['values']:
+            return None
+        bounds,depths = st['bounds'],st['depths']
+        total = sum(depths)
+        if total == 0:
+            return 0.0
+        below = 0.0 # Number of values below value
+        for i,depth in enumerate(depths):
+            lo,hi = bounds[i],bounds[i+1]
+            try:
+                if value > hi:
+                    below += depth
+                    continue
+                if value < lo:
+                    break
+                try: # Linear within the bin
+                    below += depth*float(value - lo)/float(hi - lo) 
+                except (TypeError,ZeroDivisionError):
+                    below += depth*0.5
+                break
+            except TypeError: # Cannot compare
+                return None
+        frac = below/total
+        if op in ('>','>='):
+            frac = 1.0 - frac
+        return frac*(1.0 - float(st['nulls'])/st['values'])
+    
+    def _has_range(self,attrib):
+        """
+        Whether range queries on attrib may use sorted values
+        """
+        if _is_len_key(attrib):
+            return attrib[1] in self.len_attributes
+        return attrib in self.sorted_attributes and attrib not in self.partial
+    
+    @_indexing
+    def _sorted_keys(self,attrib):
+        """
+        Return the sorted (distinct) values of attrib or None if it doesn't
+        keep them (or they can't be sorted). They are built when first needed
+        and then kept up to date by _sorted_change()
+        """
+        if not self._has_range(attrib):
+            return None
+        source = self._pk if attrib == self.primary_key else self._get_lookup(attrib)
+        nkeys = len(source) - (self._empty in source)
+        cached = self._sorted.get(attrib)
+        if cached is not None and cached[0] is source and len(cached[1]) == nkeys:
+            return cached[1]
+        try:
+            keys = sorted(key for key in source if key is not self._empty)
+        except TypeError: # Mixed types
+            self._sorted.pop(attrib,None)
+            return None
+        self._sorted[attrib] = (source,keys)
+        return keys
+    
+    def _sorted_change(self,attrib,added=(),removed=()):
+        """
+        Update the sorted values (if built) for new or removed values
+        """
+        cached = self._sorted.get(attrib)
+        if cached is None:
+            return
+        keys = cached[1]
+        try:
+            for key in removed:
+                i = bisect_left(keys,key)
+                if i < len(keys) and keys[i] == key:
+                    del keys[i]
+            for key in added:
+                if key is not self._empty:
+                    insort(keys,key)
+        except TypeError:
+            self._sorted.pop(attrib,None)
+    
+    def _range(self,op,attrib,value):
+        """
+        Return the indices of items with any value `op` value using the 
+        sorted values or None if attrib doesn't have them
+        """
+        keys = self._sorted_keys(attrib)
+        if keys is None:
+            return None
+        try:
+            if op == '<':
+                keys = keys[:bisect_left(keys,value)]
+            elif op == '<=':
+                keys = keys[:bisect_right(keys,value)]
+            elif op == '>':
+                keys = keys[bisect_right(keys,value):]
+            else:
+                keys = keys[bisect_left(keys,value):]
+        except TypeError:
+            return None
+        if attrib == self.primary_key:
+            return set(self._pk[key] for key in keys)
+        lookup = self._get_lookup(attrib,query=True)
+        return set().union(*[lookup[key] for key in keys])
+    
+    def _sharing(self):
+        """
+        Whether the index may be shared (see _own())
+        """
+        return bool(self._snapshots)
+    
+    def _release_cow(self):
+        """
+        Stop copying-on-write once every snapshot (or clone) is gone. Only 
+        called at the start of a write (see _writing)
+        """
+        if self._cow is not None and not self._sharing():
+            self._cow = None
+    
+    def _preserve_row(self,ix,copy_row=True):
+        """
+        Give any snapshot the current version of item ix before it is 
+        changed (copy_row=True) or removed (copy_row=False)
+        """
+        if not self._snapshots:
+            return
+        item = self._list[ix]
+        for snap in list(self._snapshots):
+            snap._list.preserve(ix,item,copy_row)
+    
     def _append(self,attrib,value,ix):
         """
         Add to the lookup and update the modify time
@@ -530,28 +2320,92 @@ class ldtable(object):
             print('BAD! Should guard against this in public methods!')
             raise ValueError('Cannot reindex an excluded attribute')
         
+        if attrib == self.primary_key:
+            self._check_key(value,ixs=[ix])
+            if self._cow is not None:
+                self._own(attrib)
+            self._pk[value] = ix
+            self._sorted_change(attrib,added=[value])
+            self._stats_change(attrib,value,0,1)
+            self._time = time.time()
+            return
+        
+        if self.lazy and attrib not in self._lookup: # Not yet built
+            self._time = time.time()
+            return
+        
         valueL = _makelist(value)
-        for val in valueL:
-            self._lookup[attrib][val].append(ix)
-        if len(valueL) == 0:
-            self._lookup[attrib][self._empty].append(ix) # empty list
+        if _len_key(attrib) in self._lookup:
+            self._append(_len_key(attrib),len(valueL),ix)
+        valueL = _uniquelist(valueL)
+        if self._cow is not None:
+            self._own(attrib,valueL)
+        lookup = self._lookup[attrib]
+        new_keys = []
+        counts = [] if attrib in self._stats else None
+        for val in valueL or [self._empty]: # empty list
+            if attrib in self.partial and not self._indexable(attrib,val):
+                continue
+            ixs = lookup.get(val)
+            if ixs is None:
+                new_keys.append(val)
+                ixs = lookup[val] = []
+            if counts is not None:
+                counts.append((val,len(ixs)))
+            if ixs and ixs[-1] > ix: # Updated (not new) items. Keep in order
+                insort(ixs,ix)
+            else:
+                ixs.append(ix)
+        if new_keys:
+            self._sorted_change(attrib,added=new_keys)
+        if counts:
+            for val,n in counts:
+                self._stats_change(attrib,val,n,n + 1)
         self._time = time.time()
     
     def _remove(self,attrib,value,ix):
         """
         Remove from the lookup and update the modify time
         """
+        if attrib == self.primary_key:
+            if self._pk.get(value) != ix:
+                raise ValueError('Item not found in internal lookup. May need to first call reindex()')
+            if self._cow is not None:
+                self._own(attrib)
+            del self._pk[value]
+            self._sorted_change(attrib,removed=[value])
+            self._stats_change(attrib,value,1,0)
+            self._time = time.time()
+            return
+        
+        if self.lazy and attrib not in self._lookup: # Not yet built
+            self._time = time.time()
+            return
+        
         valueL = _makelist(value)
-        for val in valueL:
+        if _len_key(attrib) in self._lookup:
+            self._remove(_len_key(attrib),len(valueL),ix)
+        valueL = _uniquelist(valueL)
+        if self._cow is not None:
+            self._own(attrib,valueL)
+        lookup = self._lookup[attrib]
+        counts = []
+        for val in valueL or [self._empty]: # empty list
+            if attrib in self.partial and not self._indexable(attrib,val):
+                continue
+            ixs = lookup[val]
             try:
-                self._lookup[attrib][val].remove(ix)
+                ixs.remove(ix)
             except ValueError:
                 raise ValueError('Item not found in internal lookup. May need to first call reindex()')
-        if len(valueL) == 0:
-            self._lookup[attrib][self._empty].remove(ix) # empty list
+            counts.append((val,len(ixs)))
+        if attrib in self._stats:
+            for val,n in counts:
+                self._stats_change(attrib,val,n + 1,n)
     
         self._time = time.time()
     
+    @_reading
     def __contains__(self,check_diff):
         check_diff = self._convert2dict(check_diff)
         if not ( isinstance(check_diff,dict) or isinstance(check_diff,Qobj)):
@@ -561,6 +2415,7 @@ class ldtable(object):
     def __len__(self):
         return self.N
 
+    @_reading
     def __getitem__(self,item):
         item = self._convert2dict(item)
         if isinstance(item,dict) or isinstance(item,Qobj):
@@ -575,9 +2430,13 @@ class ldtable(object):
     __call__ = query
     
     def __iter__(self):
-        return self
-
+        return self.items() # Independent iterator
+    
     def __next__(self):
+        """
+        Deprecated: Uses a single cursor shared by all callers. Use 
+        iter(DB) or DB.items()
+        """
         while self._i < len(self._list):
             self._i += 1 # Increment it but then search back
             if self._list[self._i-1] is not None:
@@ -586,11 +2445,538 @@ class ldtable(object):
     next = __next__ # For compatability
     
     
+class _Snapshot(ldtable):
+    """
+    Read-only view of an ldtable. See ldtable.snapshot()
+    """
+    def __init__(self,DB):
+        self.__dict__.update(DB.__dict__)
+        self.__dict__.pop('_ix',None) # Computed when needed
+        self._snap_ix = None
+        
+        if hasattr(DB,'_lookup'):
+            self._lookup = dict(DB._lookup) # Share each attribute's lookup
+        self.attributes = list(DB.attributes)
+        self._last_used = dict(DB._last_used)
+        self._index_use = {}
+        self._list = _SnapshotList(DB._list,len(DB._list))
+        self._lock = None # Never changes. No need to lock
+        self._index_lock = threading.RLock() if DB._lock is not None else None
+        self._shm = None
+        self._snapshots = weakref.WeakSet()
+        self._cow = None
+        self._dirty = {}
+        self._sorted = {} # The DB's are updated in place
+        self._stats = copy.deepcopy(DB._stats) # So are these
+        
+        self._DB = DB
+        DB._cow = {} # Everything is now shared
+        DB._snapshots.add(self)
+    
+    @property
+    def _ix(self):
+        if self._snap_ix is None:
+            self._snap_ix = set(ix for ix,item in enumerate(self._list) if item is not None)
+        return self._snap_ix
+    
+    def close(self):
+        """
+        Release the snapshot. It should not be used after this
+        """
+        DB = self._DB
+        if DB is None:
+            return
+        if DB._lock is None:
+            DB._snapshots.discard(self)
+        else:
+            with DB._lock.writing(): # Not while it is changing
+                DB._snapshots.discard(self)
+        self._DB = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*exc):
+        self.close()
+    
+    def _check_frozen(self):
+        raise ValueError('Snapshots are read-only')
+
+class _Clone(ldtable):
+    """
+    Copy-on-write copy of an ldtable. See ldtable.clone()
+    """
+    def __init__(self,DB):
+        self.__dict__.update(DB.__dict__)
+        for key in ('_ix','_snap_ix','_DB'): # (the last two if DB is a snapshot)
+            self.__dict__.pop(key,None)
+        self._parent = DB # Until nothing is shared. See compact()
+        self._clone_ix = None # Made when needed. See _ix
+        
+        if hasattr(DB,'_lookup'):
+            self._lookup = dict(DB._lookup) # Share each attribute's lookup
+        self._list = _CloneList(DB._list,len(DB._list))
+        self._pk = DB._pk
+        self.attributes = list(DB.attributes)
+        self.exclude_attributes = list(DB.exclude_attributes)
+        self.partial = dict(DB.partial)
+        self.sorted_attributes = set(DB.sorted_attributes)
+        self.len_attributes = set(DB.len_attributes)
+        self._last_used = dict(DB._last_used)
+        self._index_use = {attrib:dict(use) for attrib,use in DB._index_use.items()}
+        self._stats = copy.deepcopy(DB._stats)
+        self._dirty = {ix:dict(recorded) for ix,recorded in DB._dirty.items()}
+        self.storage = None # Changes are kept in memory
+        self._lock = _RWLock() if DB._lock is not None else None
+        self._index_lock = threading.RLock() if DB._lock is not None else None
+        self._shm = None
+        self._snapshots = weakref.WeakSet()
+        self._cow = {} # Everything starts shared
+        self._sorted = {} # The DB's are updated in place
+        
+        DB._cow = {}
+        DB._snapshots.add(self) # So it copies for this too
+    
+    @property
+    def _ix(self):
+        """
+        The DB's ixs when cloned. The DB gives any it changes (or removes) 
+        after to the list so they are the DB's current ixs below n with the 
+        list's changes
+        """
+        if self._clone_ix is None:
+            parent = self._parent
+            if parent._lock is None:
+                self._clone_ix = self._parent_ix()
+            else:
+                with parent._lock.reading(): # So it doesn't change meanwhile
+                    self._clone_ix = self._parent_ix()
+        return self._clone_ix
+    
+    def _parent_ix(self):
+        L = self._list
+        ixs = set(self._parent._ix)
+        ixs.difference_update(range(L.n,len(L.base)))
+        for ix,item in list(L.overlay.items()):
+            if item is None:
+                ixs.discard(ix)
+            else:
+                ixs.add(ix)
+        ixs.update(ix for ix,item in enumerate(L.extra,L.n) if item is not None)
+        return ixs
+    
+    @_ix.setter
+    def _ix(self,ixs):
+        self._clone_ix = ixs
+    
+    def _sharing(self):
+        return isinstance(self._list,_CloneList) or bool(self._snapshots)
+    
+    def _preserve_row(self,ix,copy_row=True):
+        """
+        Also copy item ix (the first time) so the change isn't seen by the 
+        DB it was cloned from
+        """
+        ldtable._preserve_row(self,ix,copy_row) # Its own snapshots
+        L = self._list
+        if not isinstance(L,_CloneList) or not ix < L.n or ix in L.owned:
+            return
+        item = L[ix]
+        if copy_row and item is not None:
+            item = copy.copy(item)
+            if isinstance(item,TrackedObject): # Track the copy here instead
+                object.__setattr__(item,'_ldtable_tracking',[])
+                _track(item,self,ix)
+        L[ix] = item
+    
+    @_writing
+    def compact(self):
+        """
+        Copy any shared items then compact. See ldtable.compact()
+        """
+        if isinstance(self._list,_CloneList) and len(self._list) != self.N:
+            for ix in self._ix:
+                self._preserve_row(ix)
+        ldtable.compact(self)
+        parent = self._parent
+        if parent is not None and not isinstance(self._list,_CloneList):
+            if parent._lock is None: # Nothing is shared now
+                parent._snapshots.discard(self)
+            else:
+                with parent._lock.writing():
+                    parent._snapshots.discard(self)
+            self._parent = None
+
+class _SnapshotList(object):
+    """
+    The first n items of the DB's list. Items that the DB changes or removes
+    after the snapshot are stored here first
+    """
+    def __init__(self,base,n):
+        self.base = base
+        self.n = n
+        self.overlay = {}
+    
+    def preserve(self,ix,item,copy_row=True):
+        if ix < self.n and ix not in self.overlay:
+            self.overlay[ix] = copy.copy(item) if copy_row else item
+    
+    def __len__(self):
+        return self.n
+    
+    def __getitem__(self,ix):
+        if ix < 0:
+            ix += self.n
+        if not 0 <= ix < self.n:
+            raise IndexError('list index out of range')
+        item = self.base[ix] # Read before checking overlay in case it changes
+        return self.overlay.get(ix,item)
+    
+    def __iter__(self):
+        base,overlay = self.base,self.overlay
+        for ix in range(self.n):
+            item = base[ix]
+            if ix in overlay:
+                item = overlay[ix]
+            yield item
+
+class _CloneList(_SnapshotList):
+    """
+    The list of a clone: The first n items of the DB's list (see 
+    _SnapshotList) with the clone's own changes and added items
+    """
+    def __init__(self,base,n):
+        _SnapshotList.__init__(self,base,n)
+        self.owned = set() # ixs in overlay set by the clone
+        self.extra = [] # Items added to the clone
+    
+    def __len__(self):
+        return self.n + len(self.extra)
+    
+    def __getitem__(self,ix):
+        if ix < 0:
+            ix += len(self)
+        if ix >= self.n:
+            return self.extra[ix - self.n]
+        return _SnapshotList.__getitem__(self,ix)
+    
+    def __setitem__(self,ix,item):
+        if ix >= self.n:
+            self.extra[ix - self.n] = item
+        else:
+            self.overlay[ix] = item
+            self.owned.add(ix)
+    
+    def append(self,item):
+        self.extra.append(item)
+    
+    def __iter__(self):
+        for item in _SnapshotList.__iter__(self):
+            yield item
+        for item in self.extra:
+            yield item
+
+class _StoredList(object):
+    """
+    Stand-in for the DB's list that stores the (pickled) items in a sqlite 
+    file rather than in memory. Recently used items are kept (pickled) in a 
+    small LRU cache. Removed items (None) are not stored.
+    
+    Every read returns a new copy of the item so changing a returned item 
+    does not change the stored one unless it is set again (`L[ix] = item`)
+    """
+    chunksize = 1000 # Items read at a time when iterating
+    commit_every = 10000 # Writes between commits
+    
+    def __init__(self,path,cache_size=1024,_new=True,_n=0):
+        if sqlite3 is None:
+            raise ValueError('storage requires the sqlite3 module')
+        self.path = path
+        self.cache_size = cache_size
+        self._conn = sqlite3.connect(path,check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        if _new:
+            self._conn.execute('DROP TABLE IF EXISTS items')
+            self._conn.execute('CREATE TABLE items (ix INTEGER PRIMARY KEY, item BLOB)')
+            self._conn.commit()
+        self._n = _n
+        self._cache = OrderedDict()
+        self._writes = 0
+        self._mutex = threading.Lock() # Readers share the connection and cache
+    
+    def __len__(self):
+        return self._n
+    
+    def append(self,item):
+        self[self._n] = item
+    
+    def __getitem__(self,ix):
+        if ix < 0:
+            ix += self._n
+        if not 0 <= ix < self._n:
+            raise IndexError('list index out of range')
+        with self._mutex:
+            try:
+                data = self._cache.pop(ix)
+            except KeyError:
+                row = self._conn.execute('SELECT item FROM items WHERE ix=?',(ix,)).fetchone()
+                if row is None:
+                    return None # Removed
+                data = bytes(row[0])
+            self._cache[ix] = data # Most recently used is last
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return pickle.loads(data)
+    
+    def __setitem__(self,ix,item):
+        with self._mutex:
+            if item is None:
+                self._cache.pop(ix,None)
+                self._conn.execute('DELETE FROM items WHERE ix=?',(ix,))
+            else:
+                data = pickle.dumps(item,pickle.HIGHEST_PROTOCOL)
+                self._conn.execute('INSERT OR REPLACE INTO items VALUES (?,?)',
+                                   (ix,sqlite3.Binary(data)))
+                if ix in self._cache:
+                    self._cache[ix] = data
+            self._n = max(self._n,ix+1)
+            self._writes += 1
+            if self._writes >= self.commit_every:
+                self.flush()
+    
+    def __iter__(self):
+        """
+        Yield every item (None for removed ones) in order. Does not use (or
+        fill) the cache
+        """
+        ix = 0
+        while ix < self._n:
+            with self._mutex:
+                rows = self._conn.execute('SELECT ix,item FROM items WHERE ix>=? '
+                                          'ORDER BY ix LIMIT ?',(ix,self.chunksize)).fetchall()
+                cached = [self._cache.get(rix) for rix,_ in rows]
+            for (rix,data),cached_data in zip(rows,cached):
+                for _ in range(ix,rix):
+                    yield None
+                yield pickle.loads(cached_data if cached_data is not None else bytes(data))
+                ix = rix + 1
+            if len(rows) < self.chunksize:
+                break
+        for _ in range(ix,self._n):
+            yield None
+    
+    def renumber(self,newix):
+        """
+        Change the index of the stored items to newix[ix]. New indices must 
+        keep the order and be no larger than the old ones (see compact())
+        """
+        with self._mutex:
+            for ix in sorted(newix):
+                if newix[ix] != ix:
+                    self._conn.execute('UPDATE items SET ix=? WHERE ix=?',(newix[ix],ix))
+            self._cache = OrderedDict((newix[ix],item) for ix,item in self._cache.items()
+                                      if ix in newix)
+            self._n = len(newix)
+            self.flush()
+    
+    def flush(self):
+        self._conn.commit()
+        self._writes = 0
+    
+    def close(self):
+        self.flush()
+        self._conn.close()
+    
+    def __getstate__(self):
+        self.flush() # So it is in the file when reopened
+        return {'path':self.path,'cache_size':self.cache_size,'n':self._n}
+    
+    def __setstate__(self,state):
+        self.__init__(state['path'],state['cache_size'],_new=False,_n=state['n'])
+
+class _RWLock(object):
+    """
+    Reader-writer lock. Many readers may hold it at once; a writer holds it
+    alone. Waiting writers block new readers so they are not starved.
+    
+    It is reentrant per thread: a reader may read again and a writer may
+    read or write again (e.g. add() calling add_attribute()). A reader may
+    not upgrade to a writer.
+    
+    The internal condition is only held to update the counts so readers do
+    not serialize on it while working.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+    
+    def acquire_read(self):
+        if self._writer is threading.current_thread():
+            self._write_depth += 1
+            return
+        depth = getattr(self._local,'depth',0)
+        if depth == 0:
+            with self._cond:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+    
+    def release_read(self):
+        if self._writer is threading.current_thread():
+            self._write_depth -= 1
+            return
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+    
+    def acquire_write(self):
+        me = threading.current_thread()
+        if self._writer is me:
+            self._write_depth += 1
+            return
+        if getattr(self._local,'depth',0):
+            raise RuntimeError('Cannot write while holding a read lock')
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+    
+    def release_write(self):
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+    
+    def reading(self):
+        return _LockContext(self.acquire_read,self.release_read)
+    
+    def writing(self):
+        return _LockContext(self.acquire_write,self.release_write)
+
+class _LockContext(object):
+    def __init__(self,acquire,release):
+        self.acquire = acquire
+        self.release = release
+    def __enter__(self):
+        self.acquire()
+    def __exit__(self,*exc):
+        self.release()
+
+def _is_change_map(obj):
+    """
+    Whether obj is a {index:updated_dict} mapping for update_many()
+    """
+    return isinstance(obj,dict) and len(obj) > 0 and \
+        all(isinstance(k,int) and not isinstance(k,bool) for k in obj) and \
+        all(isinstance(v,dict) or hasattr(v,'__dict__') for v in obj.values())
+
+class _open(object):
+    """
+    Open path (or use an open file) as text. Only closes what it opened
+    """
+    def __init__(self,path,mode,newline=None):
+        self.path = path
+        self.mode = mode
+        self.newline = newline
+        self.F = None
+    
+    def __enter__(self):
+        if hasattr(self.path,'read') or hasattr(self.path,'write'):
+            return self.path
+        if sys.version_info[0] < 3: # The csv module needs bytes
+            self.F = open(self.path,self.mode + 'b')
+        else:
+            self.F = io.open(self.path,self.mode,encoding='utf8',newline=self.newline)
+        return self.F
+    
+    def __exit__(self,*exc):
+        if self.F is not None:
+            self.F.close()
+
+def _text(s):
+    if sys.version_info[0] < 3 and isinstance(s,unicode):
+        return s.encode('utf8')
+    return s
+
+def _add_chunks(DB,items,chunksize):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            DB.add(chunk)
+            chunk = []
+    if chunk:
+        DB.add(chunk)
+
+def _typed_rows(reader,types):
+    for row in reader:
+        for key,func in types.items():
+            if key in row:
+                row[key] = func(row[key])
+        yield row
+
+def _column(rows,attr):
+    """
+    Return attr of every row as an array.array if they are all ints or all 
+    floats. Otherwise a list
+    """
+    first = rows[0].get(attr) if rows else None
+    typecode = {int:_INT_TYPECODE,float:str('d')}.get(type(first))
+    if typecode is not None:
+        try:
+            col = array(typecode,(row.get(attr) for row in rows))
+        except (TypeError,OverflowError,ValueError):
+            pass
+        else:
+            if not any(type(row.get(attr)) is bool for row in rows):
+                return col
+    return [row.get(attr) for row in rows]
+
+def _flat_view(flat):
+    """
+    A view of the array flat that slices without copying. Python 2 arrays 
+    have no memoryview so its slices are (still compact) copies
+    """
+    try:
+        return memoryview(flat)
+    except TypeError: # Python 2
+        return flat
+
+def _len_key(attrib):
+    """Key in _lookup of the index of the number of values of attrib"""
+    return ('len',attrib)
+
+def _is_len_key(attrib):
+    return isinstance(attrib,tuple) and len(attrib) == 2 and attrib[0] == 'len'
+
 def _makelist(input):
     if isinstance(input,list):
         return input
     return [input]
 
+def _uniquelist(valueL):
+    """
+    valueL without repeated values (in order) so an item is in each
+    value's list of the index only once
+    """
+    if len(valueL) < 2:
+        return valueL
+    seen = set()
+    return [val for val in valueL if not (val in seen or seen.add(val))]
+
 class _emptyList(object):
     def __init__(self):
         pass
@@ -599,32 +2985,174 @@ class _emptyList(object):
     def __eq__(self,other):
         return isinstance(other,list) and len(other)==0
         
+class _SharedBuffer(object):
+    """
+    Owns a shared memory block of int64 row indices for a frozen DB. The
+    views into it (stored in the DB's lookup) must all be released before the
+    block can be closed so this holds the lookup and clears it first.
+    """
+    def __init__(self,size,name=None):
+        self.size = size
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,size=max(8*size,1))
+        else:
+            try: # Python 3.13+. Do not let this process unlink it on exit
+                self.shm = shared_memory.SharedMemory(name=name,track=False)
+            except TypeError:
+                self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.view = self.shm.buf.cast('B').cast('q')[:size]
+        self.lookup = None
+    
+    def close(self,unlink=False):
+        if self.shm is None:
+            return
+        if self.lookup is not None:
+            self.lookup.clear()
+        self.lookup = None
+        self.view.release()
+        self.view = None
+        try:
+            self.shm.close()
+        except BufferError: # Someone still holds a view. Leave it to the OS
+            pass
+        if unlink and self.owner:
+            self.shm.unlink()
+        self.shm = None
+    
+    def __del__(self):
+        self.close()
+
+class TrackedObject(object):
+    """
+    Mixin for objects in an `indexObjects=True` DB. Setting an attribute 
+    updates the index of every DB the object is in (with the same cost as
+    update()) so that reindex() is not needed.
+    
+    Usage
+    -----
+    
+    >>> class Track(TrackedObject):
+    ...     def __init__(self,title,status):
+    ...         self.title = title
+    ...         self.status = status
+    >>> DB = ldtable([Track('a','new'),Track('b','new')],indexObjects=True)
+    >>> DB.query_one(title='a').status = 'done'
+    >>> DB.count(status='done')
+    1
+    
+    Note: Changes made directly to the object's __dict__ (or deleting an 
+          attribute) are not tracked. Copies and pickled objects are not
+          tracked until they are added to a DB.
+    """
+    __slots__ = ('_ldtable_tracking',) # Not in __dict__ so it isn't indexed
+    
+    def __setattr__(self,name,value):
+        tracking = getattr(self,'_ldtable_tracking',None)
+        if tracking:
+            DBs = [(DBref(),ix) for DBref,ix in tracking]
+            DBs = [(DB,ix) for DB,ix in DBs if DB is not None]
+            for DB,ix in DBs: # Check all before changing any
+                DB._tracked_check(ix,name,value)
+            for DB,ix in DBs:
+                DB._tracked_set(ix,name,value)
+        object.__setattr__(self,name,value)
+    
+    def __getstate__(self):
+        return self.__dict__ # Do not copy or pickle the tracking
+
+def _track(obj,DB,ix):
+    tracking = getattr(obj,'_ldtable_tracking',None)
+    if tracking is None:
+        tracking = []
+        object.__setattr__(obj,'_ldtable_tracking',tracking)
+    tracking.append((weakref.ref(DB),ix))
+
+def _untrack(obj,DB,ix):
+    tracking = getattr(obj,'_ldtable_tracking',[])
+    tracking[:] = [(DBref,ix0) for DBref,ix0 in tracking 
+                   if DBref() is not None and not (DBref() is DB and ix0 == ix)]
+
 class Qobj(object):
     """
     Query objects. This works by returning an updated *copy* of the object
-    whenever it is acted upon
+    whenever it is acted upon. The copies build up an expression that is
+    evaluated when the matches are first needed (e.g. in a query)
     
     Calling
         * Q.attribute sets attribute and returns a copy
-        * Q.attribute == val (or any other comparison) set the index of elements
-        * Q1 & Q1 or other boolean perform set operations
+        * Q.attribute == val (or any other comparison) adds the condition
+        * Q1 & Q1 or other boolean combine the conditions
         
     Useful Methods:
         _filter : (or just `filter` if not an attribute): Apply a filter
                   to the DB
+        _isin   : (or `isin` or `any_of` if not attributes): Match any of
+                  the values. e.g. DB.Q.role.isin(['guitar','bass'])
+        _contains_all, _contains_any : (or without the `_`) For lists, 
+                  match items with all (or any) of the values
+        _len    : (or `len`) Compare the number of values rather than the
+                  values. e.g. DB.Q.tags.len() >= 2
+    
+    Lists:
+        Comparisons are element-wise. Q.tags == 'a' matches if any value 
+        is 'a' and Q.tags > 'a' if any value is greater than 'a'.
+    
+    Evaluation:
+        Conditions that need to check every item (<, <=, >, >= unless the 
+        attribute is in `sorted_attributes`, and filters) that are combined
+        with & are compiled into a single function and checked in one pass 
+        over the items. If they are combined with 
+        indexed (==) conditions, only the items matching those are checked.
+        This carries through | and ~ so, for example, in
+        
+            (Q.role == 'guitar') & ~((Q.born < 1941) | Q.filter(func))
+        
+        only guitar players are checked and func is only called for those
+        born in or after 1941.
     """
-    def __init__(self,DB,ixs=None,attr=None):
+    def __init__(self,DB,ixs=None,attr=None,node=None):
         self._DB = DB
-        self._ixs = ixs
         self._attr = attr
+        self._node = node # Expression tree. See _eval()
+        self._fixed = None # Time of the oldest (non-empty) ixs in the node
+        if ixs is not None:
+            self._node = ('ixs',set(ixs))
+            if self._node[1]:
+                self._fixed = DB._time
+        self._cache = None # (DB._time,ixs)
+        self._start = 0 # Indices below it may be left out. See ldtable._ixs()
         
         self._time = time.time()
         
     
     def _valid(self):
+        """
+        Raise an error if the DB changed since this was made. If threadsafe,
+        other threads may change it at any time so this is only checked
+        when evaluated (with the lock) and only for known indices (the
+        conditions themselves are never out of date)
+        """
+        if self._DB._lock is not None:
+            return
         if self._time < self._DB._time:
             raise ValueError('This query object is out of date from the DB. Create a new one')
     
+    @property
+    def _ixs(self):
+        """
+        The set of matching indices (None if there are no conditions). It is
+        evaluated when first needed and again if the DB changes
+        """
+        if self._node is None:
+            return None
+        cache = self._cache # Another thread may set it
+        if cache is None or cache[0] != self._DB._time:
+            cache = self._cache = self._evaluate()
+        return cache[1]
+    
+    @_reading
     def _filter(self,filter_func):
         """
         
@@ -634,146 +3162,951 @@ class Qobj(object):
         Apply a filter to the data that returns True if it matches and False
         otherwise
         
-        Note that filters are O(N)
+        Note that filters are O(N) unless combined (&) with == conditions
         """
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if filter_func(item):
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new(('filter',filter_func))
          
             
+    @_reading
+    def _len(self):
+        """
+        If 'len' is NOT an attribute of the DB, this can be called with 
+        'len' instead of '_len'
+        
+        Compare the number of values of the attribute (1 if not a list) 
+        rather than the values. Uses the index if the attribute is in 
+        `len_attributes` and otherwise checks every item
+        
+        Usage
+        -----
+        >>> DB.Q.tags.len() >= 2
+        """
+        self._valid()
+        if self._DB.N > 0: # Like ==, anything matches nothing if empty
+            self._check_attr()
+        new = self.copy()
+        new._attr = _len_key(self._attr)
+        return new
+    
+    def _check_attr(self):
+        attr = self._attr[1] if _is_len_key(self._attr) else self._attr
+        if attr != '_index' and attr not in self._DB.attributes:
+            raise KeyError("'{}' is not an attribute".format(attr))
+    
+    def _len_scan(self):
+        """Whether this is the length of a non-indexed attribute"""
+        return _is_len_key(self._attr) and self._attr[1] not in self._DB.len_attributes
+    
     # Comparisons
+    @_reading
     def __eq__(self,value):
         self._valid()
         
         if self._DB.N == 0:
-            self._ixs = set()
-            return self.copy()
-        
-        first_set = True
-        for val in _makelist(value): # Account for list inputs
-            if self._attr == '_index':
-                if first_set:
-                    ixs = set(self._DB._index(val))
-                    first_set = False
-                else:
-                    ixs = ixs.intersection(self._DB._index(val))
-                continue
-            if self._attr not in self._DB.attributes:
-                raise KeyError("'{:s}' is not an attribute".format(self._attr))
-                
-            ixs_at = self._DB._lookup[self._attr][val]
-            if first_set:
-                ixs = set(ixs_at)
-                first_set = False
-            else:
-                ixs = ixs.intersection(ixs_at)
+            return self._new(('ixs',set()))
+        self._check_attr()
+        if self._len_scan():
+            return self._new(('scan','==',self._attr,value))
+        return self._new(('eq',self._attr,value))
+    
+    @_reading
+    def _isin(self,values):
+        """
+        If 'isin' or 'any_of' are NOT attributes of the DB, this can be
+        called with them instead of '_isin'
         
-        self._ixs = ixs
-        return self.copy()
+        Match items with *any* of the values (or, for lists, that contain 
+        any of them). Compare to `Q.attrib == [val1,val2]` which matches 
+        items that contain all of them.
+        
+        The index lists for all values are combined at once so this is much 
+        faster than `(Q.attrib == val1) | (Q.attrib == val2) | ...` for many
+        values.
+        """
+        self._valid()
+        
+        if self._DB.N == 0:
+            return self._new(('ixs',set()))
+        self._check_attr()
+        if self._len_scan():
+            return self._new(('scan','in',self._attr,set(values)))
+        return self._new(('isin',self._attr,list(values)))
+    
+    def _contains_any(self,values):
+        """
+        If 'contains_any' is NOT an attribute of the DB, this can be called 
+        with 'contains_any' instead of '_contains_any'
+        
+        Match items that contain any of the values. The same as _isin
+        """
+        return self._isin(values)
+    
+    def _contains_all(self,values):
+        """
+        If 'contains_all' is NOT an attribute of the DB, this can be called 
+        with 'contains_all' instead of '_contains_all'
+        
+        Match items that contain all of the values. The same as
+        `Q.attrib == list(values)` except that no values matches everything.
+        The index lists are intersected from the shortest.
+        """
+        values = list(values)
+        if not values:
+            self._valid()
+            return self._new(('not',('ixs',set())))
+        return self == values
      
+    @_reading
     def __ne__(self,value):
-        self._ixs = self._DB._ix - (self == value)._ixs
-        return self.copy()
+        return self._new(('not',(self == value)._node))
     
+    @_reading
     def __lt__(self,value):
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            for ival in _makelist(item[self._attr]):
-                if ival < value:
-                    ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new(('scan','<',self._attr,value))
 
+    @_reading
     def __le__(self,value):
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] <= value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new(('scan','<=',self._attr,value))
         
+    @_reading
     def __gt__(self,value):
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] > value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new(('scan','>',self._attr,value))
     
+    @_reading
     def __ge__(self,value):
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] >= value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new(('scan','>=',self._attr,value))
     
     # Logic
     def __and__(self,Q2):
-        if self._ixs == None:  # An empty object and another will just return other
+        if self._node is None:  # An empty object and another will just return other
             return Q2
-        self._ixs.intersection_update(Q2._ixs)
-        return self.copy()
+        return self._new(('and',self._node,Q2._node),Q2)
     def __or__(self,Q2):
-        self._ixs.update(Q2._ixs)
-        return self.copy()
+        return self._new(('or',self._node,Q2._node),Q2)
     def __invert__(self):
-        self._ixs = self._DB._ix - self._ixs
-        return self.copy()
+        return self._new(('not',self._node))
     
     def __getattr__(self,attr):
-        if attr == 'filter' and 'filter' not in self._DB.attributes:
-            return self._filter
+        if attr in _QOBJ_METHODS and attr not in self._DB.attributes:
+            return getattr(self,_QOBJ_METHODS[attr])
         self._attr = attr
         return self.copy()
     
     def copy(self):
-        new = Qobj(self._DB,ixs=self._ixs,attr=self._attr)
+        new = Qobj(self._DB,attr=self._attr,node=self._node)
         # Reset the time
         new._time = self._time
+        new._fixed = self._fixed
+        return new
+    
+    def _new(self,node,Q2=None):
+        new = self.copy()
+        new._node = node
+        if Q2 is not None and Q2._fixed is not None:
+            new._fixed = min(Q2._fixed,new._fixed or Q2._fixed)
         return new
     
+    # Evaluation
+    @_reading
+    def _evaluate(self):
+        """
+        Return (DB._time,ixs) with the (read) lock held
+        """
+        if self._fixed is not None and self._fixed < self._DB._time:
+            raise ValueError('This query object is out of date from the DB. Create a new one')
+        return (self._DB._time,self._eval(self._node))
+    
+    def _eval(self,node,within=None):
+        """
+        Return the set of indices matching node. Nodes are:
+        
+            ('ixs',ixs)                 Already known
+            ('eq',attr,value)           From the index
+            ('isin',attr,values)        From the index
+            ('scan',op,attr,value)      <, <=, >, >= 
+            ('filter',func)
+            ('and',node,node), ('or',node,node), ('not',node)
+        
+        If within is given, only those indices are considered (and the 
+        result is a subset of it) so that scans only check them.
+        
+        Negations return a _Complement (and within may be one) so that a set 
+        of nearly every index is never built unless it is listed.
+        
+        Must not modify the sets of the nodes
+        """
+        if node is None: # Incomplete query
+            return set()
+        kind = node[0]
+        if kind == 'ixs':
+            if within is None:
+                return self._bounded(node[1])
+            return within & node[1]
+        if kind == 'eq':
+            ixs = self._eq(node[1],node[2])
+            return ixs if within is None else within & ixs
+        if kind == 'isin':
+            ixs = self._isin_ixs(node[1],node[2])
+            return ixs if within is None else within & ixs
+        if kind == 'scan' and within is None:
+            ixs = self._DB._range(*node[1:])
+            if ixs is None: # Values (or value) can't be sorted. Check each
+                return self._scan(_compile_scans([node]))
+            return self._bounded(ixs)
+        if kind == 'not':
+            if within is None:
+                return _Complement.of(self._DB._ix,self._eval(node[1]))
+            return within - self._eval(node[1],within)
+        if kind == 'or':
+            ixs = set()
+            for node in _flatten(node,'or'):
+                if within is not None: # Only check what isn't already matched
+                    ixs |= self._eval(node,within - ixs)
+                elif isinstance(ixs,_Complement):
+                    ixs |= self._eval(node,ixs.ixs)
+                else:
+                    ixs |= self._eval(node)
+            return ixs
+        return self._eval_and(_flatten(node,'and'),within)
+    
+    def _eval_and(self,nodes,within=None):
+        """
+        Evaluate the conditions that only need the index first (with the
+        negations combined and removed at once), then check 
+        the scans on only those matches (in one pass), and then anything 
+        else that needs a scan on what is left
+        """
+        index,ranges,scans,rest = [],[],[],[]
+        for node in nodes:
+            if node is not None and node[0] == 'scan' and self._DB._has_range(node[2]):
+                ranges.append(node)
+            elif node is not None and node[0] in ('scan','filter'):
+                scans.append(node)
+            elif _has_scan(node,self._DB):
+                rest.append(node)
+            else:
+                index.append(node)
+        
+        negated = [node for node in index if node is not None and node[0] == 'not']
+        index = [node for node in index if node is None or node[0] != 'not']
+        
+        # Most selective first so the rest only check what it matched
+        if len(index) > 1:
+            index.sort(key=self._estimate)
+        ixs = within
+        for node in index:
+            ixs = self._eval(node,ixs)
+            if not ixs:
+                return set()
+        if negated:
+            removed = set()
+            for node in negated:
+                removed |= self._eval(node[1],ixs)
+            if ixs is None:
+                ixs = _Complement.of(self._DB._ix,removed)
+            else:
+                ixs = ixs - removed
+            if not ixs:
+                return set()
+        # Use the sorted values for ranges (most selective first) unless they
+        # are expected to match more than what is already matched
+        ranges.sort(key=self._estimate)
+        while ranges:
+            if ixs is not None and self._estimate(ranges[0])*self._DB.N >= len(ixs):
+                break
+            node = ranges.pop(0)
+            found = self._DB._range(*node[1:])
+            if found is None: # Values (or value) can't be sorted. Check each
+                scans.append(node)
+                continue
+            ixs = self._bounded(found) if ixs is None else ixs & found
+            if not ixs:
+                return set()
+        scans = ranges + scans
+        if scans:
+            ixs = self._scan(_compile_scans(scans),ixs)
+        for node in rest:
+            if ixs is not None and not ixs:
+                return set()
+            ixs = self._eval(node,ixs)
+        return ixs
+    
+    def _estimate(self,node):
+        """
+        Estimated fraction of items matching node. See ldtable.selectivity()
+        """
+        DB = self._DB
+        N = float(DB.N)
+        if node is None or N == 0:
+            return 0.0
+        kind = node[0]
+        if kind == 'ixs':
+            return min(len(node[1])/N,1.0)
+        if kind in ('eq','isin'):
+            attr = node[1]
+            values = (_makelist(node[2]) or [DB._empty]) if kind == 'eq' else node[2]
+            if attr == '_index':
+                counts = [1 for _ in values]
+            elif attr in DB.partial and not all(DB._indexable(attr,val) for val in values):
+                counts = [_DEFAULT_SCAN_SEL*N]
+            else:
+                counts = [DB._value_count(attr,val) for val in values]
+                if None in counts: # Not built (lazy). Don't build it to guess
+                    counts = [_DEFAULT_SCAN_SEL*N]
+            if kind == 'isin':
+                return min(sum(counts)/N,1.0)
+            return min(counts)/N if counts else 0.0
+        if kind == 'scan':
+            frac = DB._range_fraction(node[1],node[2],node[3])
+            return frac if frac is not None else _DEFAULT_RANGE_SEL
+        if kind == 'filter':
+            return _DEFAULT_SCAN_SEL
+        if kind == 'not':
+            return 1.0 - self._estimate(node[1])
+        
+        # Independent
+        fracs = [self._estimate(node) for node in _flatten(node,kind)]
+        frac = 1.0
+        if kind == 'and':
+            for f in fracs:
+                frac *= f
+            return frac
+        for f in fracs: # or
+            frac *= 1.0 - f
+        return 1.0 - frac
+    
+    def _scan(self,match,candidates=None):
+        """
+        Return the indices of the items (or just the candidates) that match
+        """
+        items = self._DB._list
+        convert = self._DB._convert2dict
+        ixs = set()
+        if candidates is None:
+            for ix in range(self._start,len(items)): # loop all (from start)
+                item = items[ix]
+                if item is None:
+                    continue
+                if match(convert(item)):
+                    ixs.add(ix)
+        else:
+            for ix in candidates:
+                item = items[ix]
+                if item is None:
+                    continue
+                if match(convert(item)):
+                    ixs.add(ix)
+        return ixs
+    
+    def _bounded(self,ixs):
+        """
+        ixs without those below _start. Lists from the index are in order so
+        only the rest is copied
+        """
+        start = self._start
+        if not start:
+            return ixs
+        if isinstance(ixs,(list,tuple,array)):
+            return ixs[bisect_left(ixs,start):]
+        return set(ix for ix in ixs if ix >= start)
+    
+    def _posting(self):
+        """
+        Return the index list (not a copy) if this is just == a single 
+        indexed value. Otherwise None
+        """
+        node = self._node
+        if node is None or node[0] != 'eq' or isinstance(node[2],list):
+            return None
+        DB = self._DB
+        attr,val = node[1],node[2]
+        if (attr == '_index' or attr == DB.primary_key 
+                or (attr in DB.partial and not DB._indexable(attr,val))):
+            return None
+        return DB._get_lookup(attr,query=True).get(val,[])
+    
+    def _eq(self,attr,value):
+        DB = self._DB
+        valueL = _makelist(value) # Account for list inputs
+        if len(valueL) == 0:
+            valueL = [DB._empty]
+        
+        lists = []
+        lookup = None
+        for val in valueL:
+            if attr == '_index':
+                ixs_at = DB._index(val)
+            elif attr == DB.primary_key:
+                ix = DB._pk.get(val)
+                ixs_at = () if ix is None else (ix,)
+            elif attr in DB.partial and not DB._indexable(attr,val):
+                ixs_at = DB._partial_ixs(attr,val)
+            else:
+                if lookup is None: # Once so it is one use
+                    lookup = DB._get_lookup(attr,query=True)
+                ixs_at = lookup.get(val,())
+            ixs_at = self._bounded(ixs_at)
+            if not ixs_at:
+                return set()
+            lists.append(ixs_at)
+        
+        # Intersect from the shortest so each step is as small as possible
+        lists.sort(key=len)
+        ixs = set(lists[0])
+        for ixs_at in lists[1:]:
+            ixs.intersection_update(ixs_at)
+            if not ixs:
+                break
+        return ixs
+
+    def _isin_ixs(self,attr,values):
+        DB = self._DB
+        if attr == '_index':
+            return set(ix for val in values for ix in DB._index(val))
+        if attr == DB.primary_key:
+            return set(DB._pk[val] for val in values if val in DB._pk)
+        
+        lookup = DB._get_lookup(attr,query=True)
+        ixs = set()
+        lists = []
+        for val in values:
+            if attr in DB.partial and not DB._indexable(attr,val):
+                ixs.update(self._bounded(DB._partial_ixs(attr,val)))
+            else:
+                lists.append(self._bounded(lookup.get(val,())))
+        return ixs.union(*lists)
+
+class _Complement(object):
+    """
+    All of the indices in universe except those in ixs (which must be a 
+    subset of it). Set operations with sets and other complements only work
+    on ixs and the full set is only built when iterated. len() is
+    len(universe) - len(ixs)
+    """
+    def __init__(self,universe,ixs):
+        self.universe = universe
+        self.ixs = ixs
+    
+    @classmethod
+    def of(cls,universe,ixs):
+        """Return universe - ixs where ixs may also be a _Complement"""
+        if isinstance(ixs,_Complement):
+            return ixs.ixs
+        return cls(universe,ixs)
+    
+    def __len__(self):
+        return len(self.universe) - len(self.ixs)
+    
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+    
+    def __iter__(self):
+        ixs = self.ixs
+        return (ix for ix in self.universe if ix not in ixs)
+    
+    def __contains__(self,ix):
+        return ix in self.universe and ix not in self.ixs
+    
+    def __and__(self,other):
+        if isinstance(other,_Complement):
+            return _Complement(self.universe,self.ixs | other.ixs)
+        return set(other).difference(self.ixs)
+    __rand__ = __and__
+    
+    def __or__(self,other):
+        if isinstance(other,_Complement):
+            return _Complement(self.universe,self.ixs & other.ixs)
+        return _Complement(self.universe,self.ixs.difference(other))
+    __ror__ = __or__
+    
+    def __sub__(self,other):
+        if isinstance(other,_Complement):
+            return other.ixs - self.ixs
+        return _Complement(self.universe,self.ixs.union(other))
+    
+    def __rsub__(self,other): # other - self for a subset of universe
+        return set(other).intersection(self.ixs)
+
+# Qobj methods that may also be called without the underscore if it is not
+# an attribute
+_QOBJ_METHODS = {'filter':'_filter',
+                 'isin':'_isin',
+                 'any_of':'_isin',
+                 'contains_any':'_contains_any',
+                 'contains_all':'_contains_all',
+                 'len':'_len'}
+
+def _flatten(node,kind):
+    """
+    Flatten nested 'and' (or 'or') nodes into a list. Not recursive since 
+    long chains (e.g. many |) are very deep
+    """
+    nodes = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is not None and node[0] == kind:
+            stack.append(node[2])
+            stack.append(node[1])
+        else:
+            nodes.append(node)
+    return nodes
+
+def _has_scan(node,DB=None):
+    """
+    Whether evaluating node requires checking items. Range conditions on
+    attributes of DB with sorted values do not
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        if node[0] == 'filter':
+            return True
+        if node[0] == 'scan' and not (DB is not None and DB._has_range(node[2])):
+            return True
+        if node[0] in ('and','or','not'):
+            stack.extend(node[1:])
+    return False
+
+# Assumed fraction of items matched by a range (without statistics) or a
+# filter. See ldtable.selectivity()
+_DEFAULT_RANGE_SEL = 1.0/3
+_DEFAULT_SCAN_SEL = 0.5
+
+_SCAN_CODE = {} # Compiled scan functions by the signature of the conditions
+
+def _compile_scans(nodes):
+    """
+    Return a single function of an item that checks all of the scan and
+    filter nodes. The code is generated (and cached) for the sequence of 
+    operators and the attributes, values, and filters are bound to it
+    """
+    key = tuple((node[1],_is_len_key(node[2])) if node[0] == 'scan' else 'filter' 
+                for node in nodes)
+    code = _SCAN_CODE.get(key)
+    if code is None:
+        lines = ['def _match(item):']
+        for i,op in enumerate(key):
+            if op == 'filter':
+                lines.append('    if not f{0}(item): return False'.format(i))
+                continue
+            op,is_len = op
+            if is_len:
+                lines.append('    x = len(_makelist(item[a{0}]))'.format(i))
+                lines.append('    if not x {1} v{0}: return False'.format(i,op))
+            else: # Lists match if any value does. See _any()
+                lines.append('    x = item[a{0}]'.format(i))
+                lines.append('    if not (_any(x,o{0},v{0}) if isinstance(x,list) '
+                             'else x {1} v{0}): return False'.format(i,op))
+        lines.append('    return True')
+        code = compile('\n'.join(lines) + '\n','<ldtable scan>','exec')
+        if len(_SCAN_CODE) > 256:
+            _SCAN_CODE.clear()
+        _SCAN_CODE[key] = code
+    
+    namespace = {'_any':_any,'_makelist':_makelist}
+    for i,node in enumerate(nodes):
+        if node[0] == 'filter':
+            namespace['f{}'.format(i)] = node[1]
+        else:
+            namespace['o{}'.format(i)] = _OPERATORS[node[1]]
+            namespace['a{}'.format(i)] = node[2][1] if _is_len_key(node[2]) else node[2]
+            namespace['v{}'.format(i)] = node[3]
+    exec(code,namespace)
+    return namespace['_match']
+
+_OPERATORS = {'<':operator.lt,'<=':operator.le,'>':operator.gt,'>=':operator.ge,
+              '==':operator.eq,'in':operator.contains}
+
+def _any(values,op,check):
+    """Whether op(value,check) for any of the values"""
+    for value in values:
+        if op(value,check):
+            return True
+    return False
+
+class ShardedTable(object):
+    def __init__(self,items=None,shards=4,key=None,processes=True,**kwargs):
+        """
+        ShardedTable:
+        Partition items across `shards` ldtable objects, each (by default)
+        in its own worker process so that O(N) queries (`<`, `<=`, `>`, `>=`,
+        and filters) run in parallel. Queries are sent to every shard and 
+        the results are merged.
+        
+        Inputs:
+        --------
+        items [ *empty* ] (list)
+            List of dictionaries
+        
+        shards [4] (int)
+            Number of shards
+        
+        key [None] (str, callable, None)
+            Attribute name (or function of the item) whose hash is used to
+            pick the shard. If None, items are distributed round-robin
+        
+        processes [True]
+            If True, each shard lives in a worker process. Otherwise, they
+            are all in this process (no parallelism but no pickling either)
+        
+        **kwargs
+            Passed to each ldtable (e.g. attributes, default_attribute). 
+            With `storage`, each shard uses the path with '.<shard number>'
+            appended
+        
+        Queries:
+        --------
+        The query API is the same as ldtable, including `DB.Q` expressions:
+        
+        >>> DB.query( (DB.Q.role == 'guitar') & (DB.Q.born < 1941) )
+        
+        Notes:
+        ------
+            * With processes=True, items, queries, and filter functions are
+              pickled to the workers. Lambdas cannot be pickled so use
+              module-level functions. Returned items are copies.
+            * `_index` queries and integer lookups refer to the index within
+              a shard and are not supported
+            * Call close() (or use as a context manager) to stop the workers
+        """
+        if items is None:
+            items = list()
+        
+        self.nshards = shards
+        self.key = key
+        self.processes = processes
+        self._rr = 0 # round-robin counter
+        
+        if processes:
+            self._conns = []
+            self._procs = []
+            for i in range(shards):
+                parent,child = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=_shard_worker,
+                                               args=(child,_shard_kwargs(kwargs,i)))
+                proc.daemon = True
+                proc.start()
+                child.close()
+                self._conns.append(parent)
+                self._procs.append(proc)
+        else:
+            self._shards = [ldtable(**_shard_kwargs(kwargs,i)) for i in range(shards)]
+        
+        self.add(items)
+    
+    def add(self,item):
+        """
+        Add an item or items to the DB
+        """
+        if not isinstance(item,(list,tuple,types.GeneratorType)):
+            item = [item]
+        
+        groups = [[] for _ in range(self.nshards)]
+        for it in item:
+            groups[self._shard_of(it)].append(it)
+        
+        calls = [('add',(group,),{}) if group else None for group in groups]
+        self._fanout(calls)
+    
+    def query(self,*A,**K):
+        """
+        Query all shards. See ldtable.query()
+        """
+        for rows in self._fanout_all('query',A,K):
+            for row in rows:
+                yield row
+    __call__ = query
+    
+    def query_one(self,*A,**K):
+        """
+        Return a single item from a query. Returns None if nothing matches
+        """
+        for row in self._fanout_all('query_one',A,K):
+            if row is not None:
+                return row
+        return None
+    
+    def count(self,*A,**K):
+        """
+        Return the number of matched rows. See ldtable.count()
+        """
+        return sum(self._fanout_all('count',A,K))
+    
+    def isin(self,*A,**K):
+        """
+        Check if there is at least one item that matches the given query
+        """
+        return any(self._fanout_all('isin',A,K))
+    
+    def update(self,*args,**queryKWs):
+        """
+        Update matching items on all shards. See ldtable.update()
+        """
+        if len(args) not in [1,2]:
+            raise ValueError('Incorrect number of inputs. See documentation')
+        if sum(self._fanout_all('update',args,queryKWs)) == 0:
+            raise ValueError('Query did not match any results')
+    
+    def remove(self,*A,**K):
+        """
+        Remove matching items from all shards. See ldtable.remove()
+        """
+        if sum(self._fanout_all('remove',A,K)) == 0:
+            raise ValueError('No matching items')
+    
+    def reindex(self,*args,**kwargs):
+        """
+        Reindex all shards. See ldtable.reindex()
+        """
+        self._fanout_all('reindex',args,kwargs)
+    
+    def add_attribute(self,attribute,*default):
+        """
+        Add an attribute to all shards. See ldtable.add_attribute()
+        """
+        self._fanout_all('add_attribute',(attribute,) + default,{})
+    
+    def items(self):
+        """
+        Return all items, shard by shard
+        """
+        for rows in self._fanout_all('items',(),{}):
+            for row in rows:
+                yield row
+    __iter__ = items
     
+    def __len__(self):
+        return sum(self._fanout_all('__len__',(),{}))
     
+    def __contains__(self,check):
+        return self.isin(check)
     
+    @property
+    def Qobj(self):
+        """
+        Deferred query object. It records the expression and it is evaluated
+        on each shard
+        """
+        return _ShardQ()
+    Q = Qobj
     
+    def close(self):
+        """
+        Stop the worker processes (if any)
+        """
+        if not self.processes:
+            return
+        for conn,proc in zip(self._conns,self._procs):
+            try:
+                conn.send(None)
+                conn.close()
+            except (IOError,OSError):
+                pass
+            proc.join()
+        self._conns = []
+        self._procs = []
     
+    def __enter__(self):
+        return self
     
+    def __exit__(self,*exc):
+        self.close()
     
+    def _shard_of(self,item):
+        if self.key is None:
+            shard = self._rr
+            self._rr = (shard + 1) % self.nshards
+            return shard
+        if hasattr(self.key,'__call__'):
+            val = self.key(item)
+        elif isinstance(item,dict):
+            val = item[self.key]
+        else:
+            val = getattr(item,self.key)
+        if isinstance(val,list):
+            val = tuple(val)
+        return hash(val) % self.nshards
     
+    def _fanout_all(self,method,A,K):
+        return self._fanout([(method,A,K)] * self.nshards)
     
+    def _fanout(self,calls):
+        """
+        Make calls (method,A,K) (or None to skip) to each shard. For
+        processes, they are all sent before any are received so the shards
+        work in parallel.
+        """
+        if not self.processes:
+            return [_shard_call(DB,*call) for DB,call in zip(self._shards,calls)
+                    if call is not None]
+        
+        if not self._conns:
+            raise ValueError('ShardedTable is closed')
+        
+        sent = []
+        for conn,call in zip(self._conns,calls):
+            if call is None:
+                continue
+            conn.send(call)
+            sent.append(conn)
+        
+        results = []
+        error = None
+        for conn in sent: # Must receive all to keep in sync
+            status,res = conn.recv()
+            if status == 'error':
+                error = res
+            results.append(res)
+        if error is not None:
+            raise error
+        return results
+
+def _shard_kwargs(kwargs,i):
+    """
+    ldtable kwargs for shard i. Each needs its own storage file
+    """
+    if kwargs.get('storage') is None:
+        return kwargs
+    kwargs = dict(kwargs)
+    kwargs['storage'] = '{}.{}'.format(kwargs['storage'],i)
+    return kwargs
+
+def _shard_worker(conn,kwargs):
+    """
+    Worker process loop for a ShardedTable shard
+    """
+    DB = ldtable(**kwargs)
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            break
+        if call is None:
+            break
+        try:
+            res = ('ok',_shard_call(DB,*call))
+        except Exception as E:
+            res = ('error',E)
+        conn.send(res)
+    conn.close()
+
+def _shard_call(DB,method,A,K):
+    """
+    Call method on one shard. Deferred queries (_ShardQ) are first built
+    against the shard. update() and remove() return the number of items
+    affected rather than raise when the shard has no matches
+    """
+    if method == 'update':
+        updated_dict = A[0]
+        A = tuple(_build_shardq(DB,a) for a in A[1:])
+        n = DB.count(*A,**K)
+        if n:
+            DB.update(updated_dict,*A,**K)
+        return n
     
+    A = tuple(_build_shardq(DB,a) for a in A)
+    if method == 'remove':
+        n = DB.count(*A,**K)
+        if n:
+            DB.remove(*A,**K)
+        return n
     
+    res = getattr(DB,method)(*A,**K)
+    if isinstance(res,types.GeneratorType):
+        res = list(res)
+    return res
+
+class _ShardQ(object):
+    """
+    Deferred query object for ShardedTable. Records the attribute path and
+    operations (a tree of tuples) so that it can be pickled to each shard and
+    replayed against that shard's Qobj by _build_shardq
     
+    Nodes:
+        ('cmp', path, op, value)    e.g. Q.a == 1
+        ('call', path, name, args)  e.g. Q.filter(func)
+        ('and', node, node), ('or', node, node), ('not', node)
     
+    The path is attribute names and (name,args) for calls so that calls may
+    be followed by a comparison. e.g. Q.a.len() >= 2 is 
+    ('cmp', ('a',('len',())), '__ge__', 2)
+    """
+    __hash__ = None
     
+    def __init__(self,node=None,path=()):
+        self._node = node
+        self._path = path
     
+    def __getattr__(self,attr):
+        if attr.startswith('__'): # Do not intercept special lookups (e.g. pickle)
+            raise AttributeError(attr)
+        return _ShardQ(path=self._path + (attr,))
     
+    def __call__(self,*args):
+        if not self._path:
+            raise TypeError('Query object is not callable')
+        return _ShardQ(('call',self._path[:-1],self._path[-1],args),
+                       path=self._path[:-1] + ((self._path[-1],args),))
     
+    def _cmp(self,op,value):
+        return _ShardQ(('cmp',self._path,op,value))
     
+    def __eq__(self,value): return self._cmp('__eq__',value)
+    def __ne__(self,value): return self._cmp('__ne__',value)
+    def __lt__(self,value): return self._cmp('__lt__',value)
+    def __le__(self,value): return self._cmp('__le__',value)
+    def __gt__(self,value): return self._cmp('__gt__',value)
+    def __ge__(self,value): return self._cmp('__ge__',value)
     
+    def __and__(self,Q2):
+        if self._node is None:
+            return Q2
+        return _ShardQ(('and',self._node,Q2._node))
+    def __or__(self,Q2):
+        return _ShardQ(('or',self._node,Q2._node))
+    def __invert__(self):
+        return _ShardQ(('not',self._node))
     
+    def __getstate__(self):
+        return (self._node,self._path)
+    def __setstate__(self,state):
+        self._node,self._path = state
+
+def _build_shardq(DB,obj):
+    """
+    Replay a _ShardQ against DB. Anything else is returned as is
+    """
+    if not isinstance(obj,_ShardQ):
+        return obj
+    if obj._node is None: # Incomplete query. Matches nothing like Qobj
+        return Qobj(DB,ixs=set())
+    return _replay_node(DB,obj._node)
+
+def _replay_node(DB,node):
+    kind = node[0]
+    if kind == 'and':
+        return _replay_node(DB,node[1]) & _replay_node(DB,node[2])
+    if kind == 'or':
+        return _replay_node(DB,node[1]) | _replay_node(DB,node[2])
+    if kind == 'not':
+        return ~_replay_node(DB,node[1])
     
+    _,path,name,args = node
+    Q = DB.Q
+    for attr in path:
+        if isinstance(attr,tuple): # A call
+            Q = getattr(Q,attr[0])(*attr[1])
+        else:
+            Q = getattr(Q,attr)
+    if kind == 'cmp':
+        return getattr(Q,name)(args)
+    return getattr(Q,name)(*args)
@@ -3,9 +3,39 @@ import pytest
 
 import ldtable
 _emptyList = ldtable._emptyList
+ShardedTable = ldtable.ShardedTable
+TrackedObject = ldtable.TrackedObject
+_Complement = ldtable._Complement
+Qobj = ldtable.Qobj
 ldtable=ldtable.ldtable
 
+from array import array
+import copy
+import gc
+import io
+import json
+import multiprocessing
+import pickle
 import sys
+import threading
+import time
+
+PY2 = sys.version_info[0] < 3 # Where any two values can be ordered
+
+def indexed(DB):
+    """The attributes that have an index now (see index_stats())"""
+    return set(attrib for attrib,use in DB.index_stats()['attributes'].items() 
+               if use['indexed'])
+
+def assert_same_matches(DB1,DB2):
+    """Every value of every attribute matches the same items in both"""
+    for attrib in DB1.attributes:
+        vals = set()
+        for item in list(DB1.items()) + list(DB2.items()):
+            value = item.get(attrib)
+            vals.update(value if isinstance(value,list) else [value])
+        for val in list(vals) + [[]]:
+            assert list(DB1.query(**{attrib:val})) == list(DB2.query(**{attrib:val}))
 
 def test_list_val():
     items = [
@@ -756,6 +786,1497 @@ def test_default_attribs_not_callable():
 
 
 
+def test_lazy():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':'guitar'},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':'bass'},
+        {'first':'George','last':'Harrison','born':1943,'role':'guitar'},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer','extra':'test'}
+    ]
+    
+    DB = ldtable(items,lazy=True)
+    assert indexed(DB) == set() # Nothing built yet
+    assert DB.query_one(extra=None) == items[0] # default is still set
+    assert indexed(DB) == set(['extra'])
+    
+    assert DB.count(first='George') == 2
+    assert indexed(DB) == set(['extra','first'])
+    
+    # Changes to unbuilt attributes are picked up when built
+    DB.update({'role':'bass'},first='John')
+    DB.remove(last='Starr')
+    DB.add({'first':'Pete','last':'Best','born':1941,'role':['drums','bass']})
+    assert 'role' not in indexed(DB)
+    assert DB.count(role='bass') == 3
+    assert DB.count(role='drums') == 1
+    
+    # And changes to built ones are maintained
+    DB.update({'role':'drums'},first='John')
+    assert DB.count(role='drums') == 2
+    
+    # Reindex just drops them to be rebuilt
+    DB.query_one(first='Pete')['born'] = 1942
+    DB.reindex('born')
+    assert 'born' not in indexed(DB)
+    assert DB.count(born=1942) == 2
+    
+    # Eviction
+    DB.lazy_evict = 0.05
+    DB.count(first='Paul')
+    time.sleep(0.1)
+    DB.count(last='Best')
+    assert indexed(DB) == set(['last'])
+    assert DB.count(first='Paul') == 1 # rebuilt
+
+def test_partial():
+    def get_items():
+        items = [{'i':i,'error_code':None} for i in range(10)]
+        items[3]['error_code'] = 404
+        items[7]['error_code'] = 500
+        items[8]['error_code'] = [404,None]
+        return items
+    items = get_items()
+    
+    for lazy in [False,True]:
+        DB = ldtable(get_items(),partial={'error_code':[None]},lazy=lazy)
+        assert DB.count(error_code=404) == 2
+        DB.query_one(error_code=404) # build it if lazy
+        assert None not in DB._lookup['error_code'] # never indexed
+        
+        # Falls back to the complement
+        assert DB.count(error_code=None) == 8
+        assert DB.count(DB.Q.error_code != None) == 2
+        
+        DB.update({'error_code':None},i=3)
+        DB.update({'error_code':500},i=0)
+        assert DB.count(error_code=404) == 1
+        assert DB.count(error_code=500) == 2
+        assert DB.count(error_code=None) == 8
+        
+        DB.remove(i=1)
+        DB.remove(i=7)
+        assert DB.count(error_code=None) == 7
+        assert None not in DB._lookup['error_code']
+    
+    # Predicate and multiple values must be checked
+    rule = lambda val: val is not None and val >= 500
+    DB = ldtable(items,partial={'error_code':rule})
+    assert set(DB._lookup['error_code']) == set([500])
+    assert DB.count(error_code=404) == 2
+    assert DB.count(error_code=None) == 8
+    assert DB.count(error_code=500) == 1
+    
+    DB = ldtable(items,partial={'error_code':[None,404]})
+    assert set(DB._lookup['error_code']) == set([500])
+    assert DB.count(error_code=404) == 2
+    assert DB.count(error_code=None) == 8
+    assert DB.count(error_code=[404,None]) == 1
+
+def _born_before_1941(item):
+    return item['born'] < 1941
+
+def test_sharded():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','strings']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','strings']},
+        {'first':'George','last':'Harrison','born':1943,'role':['guitar','strings']},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}
+    ]
+    
+    for processes,key in [(False,None),(False,'last'),(True,None),(True,'first')]:
+        with ShardedTable(copy.deepcopy(items),shards=3,key=key,processes=processes) as DB:
+            assert len(DB) == 5
+            Q = DB.Q
+            assert DB.count(first='George') == 2
+            assert DB.count(Q.born < 1941) == 3
+            assert DB.count( (Q.role == 'guitar') & (Q.born < 1941) ) == 1
+            assert DB.count( (Q.first == 'George') | ~(Q.born <= 1940) ) == 3
+            assert DB.count( Q.first != 'George' ) == 3
+            assert DB.count(Q._filter(_born_before_1941)) == 3
+            assert DB.count(Q.filter(_born_before_1941),first='John') == 1
+            assert DB.query_one(Q.last == 'Starr')['first'] == 'Ringo'
+            assert DB.query_one(last='Best') is None
+            assert {'first':'Paul'} in DB
+            assert sorted(r['last'] for r in DB.query(role='strings')) == \
+                    ['Harrison','Lennon','McCartney']
+            assert list(DB(Q.first)) == [] # incomplete
+            assert DB.count(Q.role.len() >= 2) == 3 # Call then compare
+            assert DB.count( (Q.role.len() == 1) & (Q.born < 1941) ) == 2
+            assert DB.count(Q.role.contains_any(['bass','drums'])) == 2
+            
+            DB.add({'first':'Pete','last':'Best','born':1941,'role':'drums'})
+            assert DB.count(role='drums') == 2
+            DB.update({'role':'bass'},Q.last == 'Best')
+            assert DB.count(role='bass') == 2
+            DB.remove(Q.born > 1941)
+            assert len(DB) == 4
+            assert len(list(DB.items())) == 4
+            
+            DB.add_attribute('band','beatles')
+            assert DB.count(band='beatles') == 4
+            
+            with pytest.raises(ValueError):
+                DB.remove(first='Peter')
+            with pytest.raises(ValueError):
+                DB.update({'born':0},first='Peter')
+            with pytest.raises(KeyError):
+                DB.count(notanattribute=1)
+
+def _frozen_worker_count(DB):
+    return DB.count(role='guitar'),DB.count(DB.Q.born < 1941)
+
+def test_freeze():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','strings']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','strings']},
+        {'first':'George','last':'Harrison','born':1943,'role':['guitar','strings']},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}
+    ]
+    DB = ldtable(copy.deepcopy(items),lazy=True)
+    DB.update({'role':'guitar'},first='Ringo') # out of order
+    DB.remove(last='Martin')
+    DB.freeze()
+    DB.freeze() # No-op
+    
+    assert DB.count(role='guitar') == 3
+    assert [item['first'] for item in DB.query(role='guitar')] == ['John','George','Ringo']
+    assert DB.count(role='producer') == 0
+    assert DB.count( (DB.Q.role=='strings') & (DB.Q.first != 'Paul') ) == 2
+    assert DB.count(DB.Q.born < 1941) == 2
+    assert DB[0]['first'] == 'John'
+    
+    with pytest.raises(ValueError):
+        DB.add({'first':'Pete'})
+    with pytest.raises(ValueError):
+        DB.update({'born':1},first='John')
+    with pytest.raises(ValueError):
+        DB.remove(first='John')
+    with pytest.raises(ValueError):
+        DB.reindex()
+    with pytest.raises(ValueError):
+        DB.add_attribute('band','beatles')
+    
+    DB2 = pickle.loads(pickle.dumps(DB))
+    assert DB2.count(role='guitar') == 3
+    
+    DB = ldtable(copy.deepcopy(items))
+    DB.freeze(gc_freeze=True)
+    if hasattr(gc,'unfreeze'):
+        assert gc.get_freeze_count() > 0
+        gc.unfreeze()
+    
+    if sys.version_info < (3,8):
+        return
+    
+    DB = ldtable(copy.deepcopy(items))
+    DB.freeze(shared=True)
+    assert DB.count(role='guitar') == 2
+    
+    DB2 = pickle.loads(pickle.dumps(DB)) # Attaches
+    assert DB2._shm.name == DB._shm.name
+    assert DB2.count(role='guitar') == 2
+    DB2.unlink() # Only closes it
+    
+    ctx = multiprocessing.get_context('spawn')
+    pool = ctx.Pool(1)
+    try:
+        assert pool.apply(_frozen_worker_count,(DB,)) == (2,3)
+    finally:
+        pool.close()
+        pool.join()
+    DB.unlink()
+
+def test_threadsafe():
+    DB = ldtable([{'i':i,'mod':i % 10,'t':0} for i in range(100)],threadsafe=True)
+    
+    # Lock semantics. Two readers at once but the writer must wait
+    lock = DB._lock
+    lock.acquire_read()
+    lock.acquire_read() # reentrant
+    other = []
+    th = threading.Thread(target=lambda: other.append(DB.count(mod=1)))
+    th.start(); th.join(5)
+    assert other == [10] # Did not block
+    
+    th = threading.Thread(target=lambda: DB.add({'i':-1,'mod':-1,'t':0}))
+    th.start(); th.join(0.1)
+    assert th.is_alive() # blocked by the read lock
+    lock.release_read()
+    lock.release_read()
+    th.join(5)
+    assert not th.is_alive()
+    assert DB.count(mod=-1) == 1
+    
+    with pytest.raises(RuntimeError):
+        with lock.reading():
+            lock.acquire_write()
+    
+    # Hammer it
+    errors = []
+    def writer(w):
+        try:
+            for i in range(200):
+                DB.add({'i':1000*w + i,'mod':i % 10,'t':w})
+                if i % 20 == 0:
+                    DB.update({'t':-w},DB.Q.i == 1000*w + i)
+                if i % 50 == 0:
+                    DB.remove(i=1000*w + i)
+        except Exception as E:
+            errors.append(E)
+    def reader():
+        try:
+            for _ in range(200):
+                n = DB.count(mod=3)
+                rows = list(DB.query( (DB.Q.mod == 3) & (DB.Q.i >= 0) ))
+                assert all(row['mod'] == 3 for row in rows)
+                assert n >= 10
+                list(DB)
+        except Exception as E:
+            errors.append(E)
+    threads = [threading.Thread(target=writer,args=(w,)) for w in range(1,5)]
+    threads += [threading.Thread(target=reader) for _ in range(4)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    assert errors == []
+    
+    assert len(DB) == 101 + 4*(200 - 4)
+    for mod in range(10):
+        assert DB.count(mod=mod) == len([r for r in DB.items() if r['mod'] == mod])
+    assert DB.count(DB.Q.t < 0) == 4*8 # i=0,100 were also removed
+    
+    # Iterators are independent
+    it1,it2 = iter(DB),iter(DB)
+    next(it1)
+    assert next(it2) is next(iter(DB))
+    
+    DB2 = pickle.loads(pickle.dumps(DB))
+    assert DB2._lock is not None and DB2._lock is not DB._lock
+    assert len(DB2) == len(DB)
+    
+    # Other threads may change it any time so conditions don't go out of date.
+    # Known indices are checked when evaluated
+    Q = DB.Q
+    DB.add({'i':-5,'mod':3,'t':0})
+    assert DB.count(Q.mod == 3) == DB.count(mod=3)
+    Q = Qobj(DB,ixs=[0,1]) | (DB.Q.i == -5)
+    assert DB.count(Q) == 3
+    DB.add({'i':-6,'mod':3,'t':0})
+    with pytest.raises(ValueError):
+        DB.count(Q)
+    assert DB.count(Qobj(DB,ixs=[]) | (DB.Q.i == -6)) == 1
+    
+    # Lazy indexes are built and dropped by one reader at a time
+    items = [{'a':i % 7,'b':i % 11,'c':i % 13,'d':i} for i in range(2000)]
+    DB = ldtable(items,lazy=True,threadsafe=True,index_budget=40000)
+    def lazy_reader(r):
+        try:
+            for k in range(100):
+                attrib = 'abcd'[(r + k) % 4]
+                assert DB.count(**{attrib:3}) == len([it for it in items if it[attrib] == 3])
+                assert DB.count( (DB.Q.a == 1) & (DB.Q.b == 2) ) == 26
+        except Exception as E:
+            errors.append(E)
+    threads = [threading.Thread(target=lazy_reader,args=(r,)) for r in range(6)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    assert errors == []
+    assert DB.index_stats()['bytes'] <= 40000
+    
+    # Snapshots and clones are opened and closed while others write
+    DB = ldtable([{'i':i,'mod':i % 10} for i in range(100)],threadsafe=True)
+    def snap_writer(w):
+        try:
+            for i in range(200):
+                DB.add({'i':1000*w + i,'mod':i % 10})
+                DB.update({'mod':-1},DB.Q.i == 1000*w + i)
+                if i % 2:
+                    DB.remove(i=1000*w + i)
+        except Exception as E:
+            errors.append(E)
+    def snapper():
+        try:
+            for _ in range(100):
+                with DB.snapshot() as snap:
+                    n = snap.count(mod=-1)
+                    assert len(snap) == len(list(snap))
+                    assert snap.count(mod=-1) == n
+                clone = DB.clone()
+                assert clone.count(mod=-1) == len(list(clone.query(mod=-1)))
+                del clone
+        except Exception as E:
+            errors.append(E)
+    threads = [threading.Thread(target=snap_writer,args=(w,)) for w in range(1,4)]
+    threads += [threading.Thread(target=snapper) for _ in range(3)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    assert errors == []
+    assert len(DB) == 100 + 3*100
+    assert DB.count(mod=-1) == 3*100
+    assert len(list(DB.query(mod=-1))) == 3*100
+
+def test_snapshot():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','strings']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','strings']},
+        {'first':'George','last':'Harrison','born':1943,'role':['guitar','strings']},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}
+    ]
+    for lazy in [False,True]:
+        DB = ldtable(copy.deepcopy(items),lazy=lazy)
+        DB.count(first='John') # builds 'first' if lazy
+        
+        with DB.snapshot() as snap:
+            Q = snap.Q
+            lookup = dict(DB._lookup)
+            
+            DB.add({'first':'Pete','last':'Best','born':1941,'role':'drums'})
+            DB.update({'role':'bass','born':1900},first='John')
+            DB.remove(last='Martin')
+            DB.reindex('born')
+            
+            # The DB sees the changes
+            assert len(DB) == 5
+            assert DB.count(role='bass') == 2
+            assert DB.count(role='drums') == 2
+            assert DB.count(first='George') == 1
+            assert DB.query_one(first='John')['born'] == 1900
+            
+            # The snapshot does not
+            assert len(snap) == 5
+            assert snap.count(role='bass') == 1
+            assert snap.count(role='drums') == 1
+            assert snap.count(first='George') == 2
+            assert snap.count(first='Pete') == 0
+            assert snap.query_one(first='John')['born'] == 1940
+            assert snap.query_one(first='John')['role'] == ['guitar','strings']
+            assert snap.count(Q.born < 1941) == 3 # Qobj made before the changes
+            assert snap.count(snap.Q.first != 'George') == 3
+            assert snap.count(~(snap.Q.role == 'strings')) == 2
+            assert snap[4]['last'] == 'Martin'
+            assert len(list(snap.items())) == 5
+            assert snap.isin(last='Martin')
+            
+            # Only what changed was copied
+            assert DB._lookup['first'] is not lookup['first']
+            if not lazy:
+                assert DB._lookup['last']['Lennon'] is lookup['last']['Lennon'] # untouched
+                assert DB._lookup['first']['Paul'] is lookup['first']['Paul']
+                assert DB._lookup['role']['bass'] is not lookup['role']['bass']
+            
+            with pytest.raises(ValueError):
+                snap.add({'first':'Stuart'})
+            with pytest.raises(ValueError):
+                snap.update({'born':1},first='John')
+            with pytest.raises(ValueError):
+                snap.remove(first='John')
+            
+            # Snapshot of a snapshot
+            with snap.snapshot() as snap2:
+                assert snap2.count(first='George') == 2
+        
+        # Closed so no more copies
+        DB.update({'role':'guitar'},first='Pete')
+        assert DB.count(role='guitar') == 2 and DB.count(role='drums') == 1
+    
+    # Readers do not block the writer
+    DB = ldtable([{'i':i,'mod':i % 10} for i in range(1000)],threadsafe=True)
+    snap = DB.snapshot()
+    DB._lock.acquire_write() # Something is writing
+    try:
+        out = []
+        th = threading.Thread(target=lambda: out.append(snap.count(snap.Q.mod == 3)))
+        th.start(); th.join(5)
+        assert out == [100]
+    finally:
+        DB._lock.release_write()
+    snap.close()
+
+def test_update_many():
+    def get_items():
+        return [{'i':i,'mod':i % 5,'status':'new','tags':['a','b'] if i % 2 else []}
+                for i in range(50)]
+    DB1 = ldtable(get_items())
+    DB2 = ldtable(get_items())
+    
+    for DB in [DB1,DB2]: # Make the lists out of order first
+        DB.update({'status':'open'},DB.Q.i >= 25)
+        DB.update({'status':'new'},i=30)
+    
+    DB1.update({'status':'done','tags':'c'},DB1.Q.mod == 2)
+    assert DB2.update_many({'status':'done','tags':'c'},DB2.Q.mod == 2) == 10
+    DB1.update({'tags':[]},mod=3)
+    assert DB2.update_many({'tags':[]},mod=3) == 10
+    DB1.update({'extra':1},mod=1) # Not an attribute
+    DB2.update_many({'extra':1},{'mod':1})
+    
+    assert_same_matches(DB1,DB2)
+    for DB in [DB1,DB2]:
+        assert DB.count(status='done') == 10
+        assert DB.count(status='open') == 24 - 5
+        assert DB.count(tags=[]) == 25 - 5 + 5
+        assert DB.count(tags='c') == 10
+        assert DB.query_one(i=1)['extra'] == 1
+    res = [item['i'] for item in DB2.query(status='open')]
+    assert res == sorted(res)
+    
+    # Mapping of changes
+    with DB2.snapshot() as snap:
+        assert DB2.update_many({0:{'status':'x'},1:{'status':'y','tags':['a']}}) == 2
+        assert DB2.query_one(status='x')['i'] == 0
+        assert DB2.query_one(status='y')['i'] == 1
+        assert DB2.count(tags='a') == 25 - 5 - 5 # odds but not mod 2 or 3
+        assert snap.query_one(i=0)['status'] == 'new'
+        assert snap.count(status='x') == 0
+    
+    # After the snapshot is closed (or a clone is gone)
+    assert DB2.update_many({'status':'after'},DB2.Q.i < 10) == 10
+    assert DB2.count(status='after') == 10 and DB2.count(status='x') == 0
+    clone = DB2.clone()
+    del clone
+    gc.collect()
+    assert DB2.update_many({2:{'status':'gone'}}) == 1
+    assert DB2.query_one(status='gone')['i'] == 2 and DB2.count(status='after') == 9
+    
+    with pytest.raises(ValueError):
+        DB2.update_many({'status':'z'},i=1000)
+    with pytest.raises(ValueError):
+        DB2.update_many({1000:{'status':'z'}})
+    with pytest.raises(ValueError):
+        DB2.update_many({'status':'z'},{'i':1},{'i':2})
+    
+    # Stale index
+    DB2.query_one(i=4)['status'] = 'changed'
+    with pytest.raises(ValueError):
+        DB2.update_many({'status':'z'},i=4)
+
+
+def test_remove_many():
+    items = [{'i':i,'grp':i % 10,'tags':['a','b'][:i % 3]} for i in range(1000)]
+    DB = ldtable(items)
+    
+    DB.remove(DB.Q.grp < 5)
+    assert len(DB) == 500
+    assert DB.count(grp=1) == 0
+    assert DB.count(grp=6) == 100
+    assert DB.count(tags=[]) == len([1 for item in items if item['grp'] >= 5 and item['i'] % 3 == 0])
+    for grp in range(10):
+        assert [item['grp'] for item in DB.query(grp=grp)] == [grp]*(100 if grp >= 5 else 0)
+    for tag in ['a','b']:
+        assert all(tag in item['tags'] for item in DB.query(tags=tag))
+    
+    # Few items
+    DB.remove(i=995)
+    assert len(DB) == 499
+    assert DB.count(grp=5) == 99
+    
+    # A stale index raises before anything is removed
+    DB.query_one(i=996)['grp'] = 7
+    with pytest.raises(ValueError):
+        DB.remove(DB.Q.grp >= 6)
+    assert len(DB) == 499
+    assert DB.count(grp=7) == 100
+    DB.reindex()
+    
+    # Snapshots still see removed items
+    with DB.snapshot() as snap:
+        DB.remove(grp=9)
+        assert DB.count(grp=9) == 0
+        assert snap.count(grp=9) == 100
+        assert len(snap) == 499
+        with pytest.raises(ValueError):
+            DB.compact()
+    
+    # Compact
+    DB.compact()
+    assert len(DB) == 399
+    assert [DB[ix] for ix in range(399)] == list(DB.items())
+    assert DB.count(grp=5) == 99
+    assert DB.query_one(i=996)['grp'] == 7
+    assert DB.count(grp=7) == 101
+    assert DB[0]['i'] == 5
+    assert sorted(item['i'] for item in DB.query(grp=6)) == list(range(6,996,10))
+    DB.add({'i':2000,'grp':6})
+    assert DB.count(grp=6) == 100
+    DB.compact() # Nothing to do
+    
+    # Lazy and partial
+    DB = ldtable(items,lazy=True,partial={'tags':['a']})
+    DB.count(grp=1) # Build just grp
+    DB.remove(DB.Q.i < 500)
+    assert DB.count(grp=1) == 50
+    assert DB.count(tags='a') == len([1 for item in items if item['i'] >= 500 and item['i'] % 3])
+    assert DB.count(tags='b') == len([1 for item in items if item['i'] >= 500 and item['i'] % 3 == 2])
+    
+    # After a snapshot is closed (or a clone is gone) it stops copying
+    DB = ldtable(items)
+    with DB.snapshot() as snap:
+        pass
+    DB.remove(grp=1)
+    assert DB.count(grp=1) == 0 and len(DB) == 900
+    assert DB.count(tags='b') == len([1 for item in items if item['grp'] != 1 and item['i'] % 3 == 2])
+    clone = DB.clone()
+    del clone
+    gc.collect()
+    DB.remove(DB.Q.i >= 500)
+    assert len(DB) == 450 and DB.count(grp=2) == 50
+    assert sorted(item['i'] for item in DB.query(grp=2)) == list(range(2,500,10))
+
+
+def test_primary_key():
+    items = [{'id':i,'grp':i % 10,'name':'n{}'.format(i)} for i in range(100)]
+    DB = ldtable(copy.deepcopy(items),primary_key='id')
+    assert 'id' not in indexed(DB)
+    
+    assert DB.get(5)['name'] == 'n5'
+    assert DB.get(500) is None
+    assert DB.get(500,'default') == 'default'
+    assert DB.query_one(id=5)['name'] == 'n5'
+    assert DB.count(DB.Q.id == 7) == 1
+    assert DB.count(DB.Q.id != 7) == 99
+    assert DB.count((DB.Q.id < 50) & (DB.Q.grp == 1)) == 5
+    
+    # Duplicates and missing keys are rejected before anything changes
+    with pytest.raises(ValueError):
+        DB.add({'id':5,'grp':1})
+    with pytest.raises(KeyError):
+        DB.add({'grp':1})
+    with pytest.raises(ValueError):
+        DB.add({'id':[1000,1001],'grp':1})
+    with pytest.raises(ValueError):
+        ldtable([{'id':1},{'id':1}],primary_key='id')
+    assert len(DB) == 100
+    assert DB.count(grp=1) == 10
+    
+    # Upsert
+    DB.upsert({'id':5,'name':'five'})
+    assert DB.get(5)['name'] == 'five'
+    assert DB.get(5)['grp'] == 5
+    assert DB.count(name='n5') == 0
+    DB.upsert({'id':1000,'grp':3,'name':'new'})
+    assert len(DB) == 101
+    assert DB.count(grp=3) == 11
+    with pytest.raises(ValueError):
+        DB.upsert(DB.get(1000))
+    
+    # Changing keys
+    DB.update({'id':2000},id=1000)
+    assert DB.get(1000) is None
+    assert DB.get(2000)['name'] == 'new'
+    with pytest.raises(ValueError):
+        DB.update({'id':1},id=2)
+    with pytest.raises(ValueError):
+        DB.update({'id':3000},grp=1)
+    assert DB.get(2)['id'] == 2
+    
+    DB.update_many({1:{'id':2},2:{'id':1}}) # Swap
+    assert DB.get(1)['name'] == 'n2'
+    assert DB.get(2)['name'] == 'n1'
+    with pytest.raises(ValueError):
+        DB.update_many({3:{'id':4}})
+    with pytest.raises(ValueError):
+        DB.update_many({3:{'id':4000},4:{'id':4000}})
+    assert DB.get(3)['id'] == 3
+    assert DB.get(4000) is None
+    
+    # Delete
+    DB.delete(2000)
+    assert DB.get(2000) is None
+    assert len(DB) == 100
+    with pytest.raises(KeyError):
+        DB.delete(2000)
+    DB.remove(grp=9)
+    assert DB.get(9) is None
+    assert DB.get(8)['name'] == 'n8'
+    
+    # Snapshots, compact, and reindex
+    with DB.snapshot() as snap:
+        DB.delete(8)
+        DB.upsert({'id':8,'name':'eight'})
+        assert snap.get(8)['name'] == 'n8'
+        assert DB.get(8)['name'] == 'eight'
+    DB.compact()
+    assert [DB[ix] for ix in range(90)] == list(DB.items())
+    assert all(DB.get(item['id']) is item for item in DB.items())
+    DB.get(8)['id'] = 'eight'
+    DB.reindex('id')
+    assert DB.get('eight')['name'] == 'eight'
+    
+    # Lazy and frozen
+    DB = ldtable(copy.deepcopy(items),primary_key='id',lazy=True,attributes=['grp'])
+    assert DB.attributes == ['grp','id']
+    DB.reindex()
+    assert DB.get(5)['name'] == 'n5'
+    DB.freeze()
+    assert DB.get(5)['name'] == 'n5'
+    assert DB.count(grp=5) == 10
+    assert pickle.loads(pickle.dumps(DB)).get(7)['name'] == 'n7'
+    
+    with pytest.raises(ValueError):
+        ldtable().get(1)
+    with pytest.raises(ValueError):
+        ldtable(primary_key='id',exclude_attributes=['id'])
+
+
+class _Tracked(TrackedObject):
+    def __init__(self,**KW):
+        for key,val in KW.items():
+            setattr(self,key,val)
+
+def test_tracked_objects():
+    objs = [_Tracked(i=i,grp=i % 3,tags=['a']) for i in range(30)]
+    DB = ldtable(objs,indexObjects=True)
+    assert '_ldtable_tracking' not in vars(objs[0])
+    
+    objs[0].grp = 10
+    assert DB.query_one(grp=10) is objs[0]
+    assert DB.count(grp=0) == 9
+    objs[1].tags = ['a','b']
+    assert DB.count(tags='b') == 1
+    assert DB.count(tags='a') == 30
+    
+    # New attributes are added to the index like add() would
+    objs[2].new = 'x'
+    assert DB.query_one(new='x') is objs[2]
+    assert DB.count(new=None) == 29
+    
+    # Queries made before the change are out of date
+    Q = DB.Q.grp
+    objs[4].grp = 1
+    with pytest.raises(ValueError):
+        Q == 1
+    
+    # Snapshots keep the old values
+    with DB.snapshot() as snap:
+        objs[3].grp = 20
+        assert snap.query_one(i=3).grp == 0
+        assert snap.count(grp=20) == 0
+        assert DB.query_one(grp=20) is objs[3]
+        
+    # In more than one DB
+    DB2 = ldtable(objs[:10],indexObjects=True,primary_key='i')
+    objs[5].grp = 30
+    assert DB.query_one(grp=30) is DB2.query_one(grp=30) is objs[5]
+    with pytest.raises(ValueError):
+        objs[5].i = 6 # Duplicate primary key
+    assert objs[5].i == 5
+    assert DB.count(i=5) == 1
+    
+    # Removed objects are no longer tracked
+    DB.remove(i=5)
+    objs[5].grp = 40
+    assert DB.count(grp=40) == 0
+    assert DB2.get(5) is objs[5]
+    assert DB2.count(grp=40) == 1
+    
+    DB.compact()
+    objs[29].grp = 50
+    assert DB.query_one(grp=50) is objs[29]
+    
+    # Copies are not tracked
+    cp = copy.copy(objs[6])
+    cp.grp = 60
+    assert DB.count(grp=60) == 0
+    assert pickle.loads(pickle.dumps(objs[6])).grp == objs[6].grp
+    
+    # Unpickled DBs track their own copies
+    DB3 = pickle.loads(pickle.dumps(DB))
+    DB3.query_one(i=7).grp = 70
+    assert DB3.count(grp=70) == 1
+    assert DB.count(grp=70) == 0
+    
+    DB.freeze()
+    with pytest.raises(ValueError):
+        objs[8].grp = 80
+
+
+def test_reindex_dirty():
+    items = [{'i':i,'grp':i % 10,'tags':['a','b'][:i % 3]} for i in range(100)]
+    DB = ldtable(copy.deepcopy(items))
+    
+    # Marked before changing
+    item = DB.query_one(i=1)
+    DB.mark_dirty(item,2)
+    item['grp'] = 20
+    item['tags'].remove('a')
+    DB[2]['tags'] = []
+    DB.reindex(dirty_only=True)
+    assert DB.query_one(grp=20) is item
+    assert DB.count(grp=1) == 9
+    assert DB.count(tags='a') == len([1 for it in items if it['i'] % 3]) - 2
+    assert DB.count(tags=[]) == len([1 for it in items if it['i'] % 3 == 0]) + 2
+    
+    # Marked after changing
+    item = DB.query_one(i=3)
+    item['grp'] = 30
+    DB.mark_dirty(item)
+    DB.reindex(dirty_only=True)
+    assert DB.query_one(grp=30) is item
+    assert DB.count(grp=3) == 9
+    
+    # Only some attributes
+    item = DB.query_one(i=4)
+    DB.mark_dirty(4)
+    item['grp'] = 40
+    item['tags'] = ['c']
+    DB.reindex('tags',dirty_only=True)
+    assert DB.count(tags='c') == 1
+    assert DB.count(grp=40) == 0
+    DB.reindex(dirty_only=True) # grp is still marked
+    assert DB.count(grp=40) == 1
+    item['grp'] = 41 # No longer marked
+    DB.reindex(dirty_only=True)
+    assert DB.count(grp=40) == 1 and DB.count(grp=41) == 0
+    DB.reindex('grp')
+    assert DB.count(grp=41) == 1
+    
+    # Unchanged, removed and compacted items
+    DB.mark_dirty(5,6,7)
+    DB[6]['grp'] = 60
+    DB.remove(i=7)
+    DB.remove(i=0)
+    DB.compact()
+    DB.reindex(dirty_only=True)
+    assert DB.query_one(grp=60)['i'] == 6
+    assert DB.query_one(i=5)['grp'] == 5
+    
+    # Everything matches a full reindex
+    assert_same_matches(DB,ldtable(list(DB.items())))
+    
+    # Primary keys, partial, and lazy
+    DB = ldtable(copy.deepcopy(items),primary_key='i',partial={'grp':[0]},lazy=True)
+    DB.count(grp=1)
+    DB.mark_dirty(DB.get(1),DB.get(10))
+    DB.get(1)['i'] = 1000
+    DB.get(1)['grp'] = 0
+    DB.get(10)['grp'] = 1
+    DB.get(10)['tags'] = ['z']
+    DB.reindex(dirty_only=True)
+    assert DB.get(1) is None
+    assert DB.get(1000)['grp'] == 0
+    assert DB.count(grp=0) == 10
+    assert DB.count(grp=1) == 10
+    assert DB.count(tags='z') == 1
+    
+    # After a snapshot is closed (or a clone is gone)
+    with DB.snapshot() as snap:
+        pass
+    n2 = DB.count(grp=2)
+    DB.mark_dirty(DB.get(1000))
+    DB.get(1000)['grp'] = 2
+    DB.reindex(dirty_only=True)
+    assert DB.count(grp=2) == n2 + 1 and DB.count(grp=0) == 9
+    clone = DB.clone()
+    del clone
+    gc.collect()
+    DB.mark_dirty(DB.get(1000))
+    DB.get(1000)['tags'] = ['y']
+    DB.reindex(dirty_only=True)
+    assert DB.count(tags='y') == 1 and DB.query_one(tags='y')['i'] == 1000
+    
+    with pytest.raises(ValueError):
+        DB.mark_dirty({'i':5})
+    with pytest.raises(ValueError):
+        DB.mark_dirty(1000)
+    with pytest.raises(TypeError):
+        DB.reindex(dirty=True)
+
+
+def test_jsonl_csv(tmpdir):
+    items = [{'i':i,'name':'n\u00e9{}'.format(i),'tags':['a','b'][:i % 3]} for i in range(25)]
+    DB = ldtable(copy.deepcopy(items),primary_key='i')
+    
+    path = str(tmpdir.join('DB.jsonl'))
+    assert DB.to_jsonl(path) == 25
+    DB2 = ldtable.from_jsonl(path,chunksize=10,primary_key='i')
+    assert list(DB2.items()) == items
+    assert DB2.count(tags='a') == DB.count(tags='a')
+    assert DB2.get(3)['name'] == 'n\u00e93'
+    
+    assert DB.to_jsonl(path,DB.Q.i < 5) == 5
+    assert len(ldtable.from_jsonl(path)) == 5
+    
+    path = str(tmpdir.join('DB.csv'))
+    assert DB.to_csv(path,tags='b') == 8
+    DB3 = ldtable.from_csv(path,types={'i':int,'tags':json.loads},chunksize=3)
+    assert list(DB3.items()) == [item for item in items if 'b' in item['tags']]
+    assert ldtable.from_csv(path).query_one(i='2')['tags'] == '["a", "b"]'
+    
+    # Open files
+    F = io.StringIO()
+    DB.to_jsonl(F,i=1)
+    F.seek(0)
+    assert list(ldtable.from_jsonl(F).items()) == [items[1]]
+    
+    with pytest.raises(ValueError):
+        ldtable.from_jsonl(io.StringIO(u'{"i":1}\n{"i":1}\n'),primary_key='i')
+
+
+def test_to_columns():
+    items = [{'i':i,'x':i/2.0,'name':'n{}'.format(i),'tags':['a','b'][:i % 3]} for i in range(10)]
+    items[3]['mixed'] = 3
+    DB = ldtable(items)
+    
+    cols = DB.to_columns()
+    assert list(cols) == DB.attributes
+    assert isinstance(cols['i'],array) and cols['i'].typecode in ('q','l') # 'l' on Python 2
+    assert list(cols['i']) == list(range(10))
+    assert isinstance(cols['x'],array) and cols['x'].typecode == 'd'
+    assert cols['name'] == [item['name'] for item in items]
+    assert cols['tags'][4] == ['a']
+    assert cols['mixed'] == [None,None,None,3] + [None]*6
+    
+    cols = DB.to_columns(DB.Q.i >= 7,attrs=['name','i'])
+    assert list(cols) == ['name','i']
+    assert list(cols['i']) == [7,8,9]
+    DB.remove(i=8)
+    assert list(DB.to_columns({'tags':'b'},attrs=['i'])['i']) == [2,5]
+    assert DB.to_columns(attrs=['nope'])['nope'] == [None]*9
+    
+    with pytest.raises(ValueError):
+        DB.to_columns(format='excel')
+    
+    try:
+        import numpy as np
+    except ImportError:
+        with pytest.raises(ImportError):
+            DB.to_columns(format='numpy')
+        return
+    cols = DB.to_columns(format='numpy')
+    assert cols['i'].dtype == np.int64
+    assert cols['name'].dtype == object
+    try:
+        import pandas as pd
+    except ImportError:
+        return
+    DF = DB.to_columns(DB.Q.i < 5,format='pandas')
+    assert list(DF.i) == [0,1,2,3,4]
+
+
+def test_compiled_scans():
+    items = [{'i':i,'grp':i % 10,'x':i % 7,'tags':['a','b'][:i % 3]} for i in range(200)]
+    DB = ldtable(items)
+    calls = []
+    def filt(item):
+        calls.append(item['i'])
+        return item['i'] % 2 == 0
+    
+    Q = DB.Q
+    query = (Q.i > 10) & (Q.x <= 3) & Q.filter(filt) & (Q.tags < 'b')
+    expected = [item['i'] for item in items 
+                if item['i'] > 10 and item['x'] <= 3 and item['i'] % 2 == 0 and 'a' in item['tags']]
+    assert sorted(item['i'] for item in DB.query(query)) == expected
+    assert calls == [item['i'] for item in items if item['i'] > 10 and item['x'] <= 3] # In one pass
+    
+    # Only the matches of == conditions are checked
+    del calls[:]
+    query = (Q.grp == 4) & Q.filter(filt) & (Q.i >= 100)
+    assert sorted(item['i'] for item in DB.query(query)) == list(range(104,200,10))
+    assert sorted(calls) == list(range(4,200,10))
+    
+    # Mixed with other logic
+    query = ((Q.grp == 1) | (Q.grp == 2)) & ~(Q.i < 100) & (Q.x != 0)
+    assert DB.count(query) == len([1 for item in items if item['grp'] in (1,2) and item['i'] >= 100 and item['x'] != 0])
+    assert DB.count(~(Q.i < 100) | (Q.grp == 0)) == 100 + 10
+    assert DB.count(Q.tags == []) == DB.count(tags=[])
+    
+    # Evaluated when needed (and again if the DB changes)
+    del calls[:]
+    query = (Q.grp == 4) & Q.filter(filt)
+    assert calls == []
+    assert DB.count(query) == 20 and len(calls) == 20
+    DB.add({'i':1000,'grp':4,'x':0,'tags':[]})
+    assert DB.count(query) == 21
+    
+    with pytest.raises(KeyError):
+        DB.Q.notanattribute == 1
+    with pytest.raises(KeyError):
+        DB.count(DB.Q.notanattribute > 1)
+
+
+def test_pushdown():
+    items = [{'i':i,'grp':i % 10,'x':i % 7} for i in range(500)]
+    DB = ldtable(items)
+    checked = []
+    def filt(item):
+        checked.append(item['i'])
+        return item['x'] == 0
+    
+    Q = DB.Q
+    grp3 = [item['i'] for item in items if item['grp'] == 3]
+    
+    query = (Q.grp == 3) & ((Q.i < 100) | Q.filter(filt))
+    assert sorted(item['i'] for item in DB.query(query)) == \
+        [i for i in grp3 if i < 100 or i % 7 == 0]
+    assert sorted(checked) == [i for i in grp3 if i >= 100] # Not already matched
+    
+    del checked[:]
+    query = ~Q.filter(filt) & (Q.grp == 3) & (Q.x != 1)
+    assert DB.count(query) == len([i for i in grp3 if i % 7 not in (0,1)])
+    assert sorted(checked) == [i for i in grp3 if i % 7 != 1]
+    
+    # Indexed-only sub-expressions narrow the scan too
+    del checked[:]
+    query = Q.filter(filt) & ((Q.grp == 3) | (Q.grp == 4)) & ~(Q.i < 250)
+    assert DB.count(query) == len([1 for item in items if item['grp'] in (3,4) 
+                                   and item['i'] >= 250 and item['x'] == 0])
+    assert len(checked) == 100
+    
+    # Nested ands with nothing indexed
+    query = (Q.i > 5) & ((Q.x == 2) & (Q.i < 50) | (Q.i > 490))
+    assert sorted(item['i'] for item in DB.query(query)) == \
+        [i for i in range(6,500) if (i % 7 == 2 and i < 50) or i > 490]
+    assert DB.count((Q.grp == 3) & (Q.grp == 4) & Q.filter(filt)) == 0
+
+
+def test_isin():
+    items = [{'i':i,'grp':i % 10,'tags':['a','b','c'][:i % 4],'code':None if i % 5 else i}
+             for i in range(200)]
+    DB = ldtable(items,partial={'code':[None]})
+    Q = DB.Q
+    
+    assert DB.count(Q.grp.isin([1,2])) == 40
+    assert DB.count(Q.grp.any_of([1,2,100])) == 40
+    assert DB.count(Q.grp._isin(set([1]))) == 20
+    assert DB.count(Q.grp.isin([])) == 0
+    assert DB.count(Q.tags.isin(['b','c'])) == len([1 for item in items if item['i'] % 4 >= 2])
+    assert DB.count(Q.tags == ['b','c']) == len([1 for item in items if item['i'] % 4 == 3])
+    assert DB.count(Q.code.isin([None,5])) == 161
+    assert DB.count(Q._index.isin([0,1,500])) == 2
+    
+    ids = list(range(0,200,3))
+    assert sorted(item['i'] for item in DB.query(Q.i.isin(ids))) == ids
+    assert DB.count(Q.i.isin(ids) & (Q.grp == 3)) == len([i for i in ids if i % 10 == 3])
+    assert DB.count(~Q.i.isin(ids)) == 200 - len(ids)
+    
+    DB = ldtable(items,primary_key='i')
+    assert DB.count(DB.Q.i.isin(ids + [1000])) == len(ids)
+    
+    # An attribute called isin
+    DB = ldtable([{'isin':1,'a':1},{'isin':2,'a':2}])
+    assert DB.count(DB.Q.isin == 1) == 1
+    assert DB.count(DB.Q.a._isin([1,2])) == 2
+    assert DB.count(DB.Q.a.any_of([1,2])) == 2
+    
+    with pytest.raises(KeyError):
+        DB.Q.b._isin([1])
+
+def test_contains():
+    tags = ['a','b','c','d']
+    items = [{'i':i,'grp':i % 10,'tags':tags[:i % 5],'v':[i,-i] if i % 2 else i}
+             for i in range(200)]
+    def brute(func):
+        return len([1 for item in items if func(item)])
+    
+    for kwargs in [{},{'sorted_attributes':['i','tags','v'],'len_attributes':['tags']},
+                   {'lazy':True,'sorted_attributes':['i','tags'],'len_attributes':['tags','v']}]:
+        DB = ldtable(copy.deepcopy(items),**kwargs) # Updated below
+        Q = DB.Q
+        
+        assert DB.count(Q.tags.contains_all(['c','a'])) == brute(lambda it: len(it['tags']) >= 3)
+        assert DB.count(Q.tags.contains_all(['c','x'])) == 0
+        assert DB.count(Q.tags.contains_all([])) == 200
+        assert DB.count(Q.tags.contains_any(['d','x'])) == brute(lambda it: 'd' in it['tags'])
+        
+        # Element-wise ranges for every operator
+        assert DB.count(Q.tags > 'b') == brute(lambda it: any(t > 'b' for t in it['tags']))
+        assert DB.count(Q.tags >= 'b') == brute(lambda it: any(t >= 'b' for t in it['tags']))
+        assert DB.count(Q.tags <= 'a') == brute(lambda it: 'a' in it['tags'])
+        assert DB.count(Q.v < -100) == brute(lambda it: isinstance(it['v'],list) and it['v'][1] < -100)
+        assert DB.count(Q.v >= 150) == brute(lambda it: max(it['v'] if isinstance(it['v'],list) else [it['v']]) >= 150)
+        assert DB.count(Q.i < 50) == 50
+        assert DB.count((Q.i >= 20) & (Q.i < 50) & (Q.grp == 3)) == 3
+        assert DB.count(~(Q.i > 100) & (Q.tags.len() == 0)) == 21
+        
+        # len
+        assert DB.count(Q.tags.len() >= 2) == brute(lambda it: len(it['tags']) >= 2)
+        assert DB.count(Q.tags.len() == 0) == 40
+        assert DB.count(Q.v.len() == 1) == 100
+        assert DB.count(Q.tags.len().isin([1,4])) == 80
+        assert DB.count(Q.tags.len() != 1) == 160
+        
+        # Kept up to date
+        DB.add({'i':-5,'grp':0,'tags':['z'],'v':[1000]})
+        DB.update({'tags':['a','b','c','d','e']},i=1)
+        DB.update_many({'i':500},i=2)
+        DB.remove(i=3)
+        assert DB.count(DB.Q.tags > 'd') == 2
+        assert DB.count(DB.Q.i < 0) == 1
+        assert DB.count(DB.Q.i > 199) == 1
+        assert DB.count(DB.Q.v > 999) == 1
+        assert DB.count(DB.Q.tags.len() == 5) == 1
+        assert DB.count(DB.Q.tags.len() == 3) == brute(lambda it: len(it['tags']) == 3) - 1
+        assert DB.count(DB.Q.tags.len() >= 4) == 41
+        
+        DB.reindex()
+        assert DB.count(DB.Q.tags.len() >= 4) == 41
+        assert DB.count(DB.Q.i > 199) == 1
+    
+    # Primary key and snapshots
+    DB = ldtable(items,primary_key='i',sorted_attributes=['i'])
+    snap = DB.snapshot()
+    DB.delete(0)
+    DB.upsert({'i':-1,'grp':0,'tags':[],'v':0})
+    assert DB.count(DB.Q.i < 10) == 10
+    assert DB.count(DB.Q.i <= 0) == 1
+    assert snap.count(snap.Q.i < 10) == 10
+    assert snap.count(snap.Q.i < 0) == 0
+    
+    # Mixed types fall back to checking the items (or raising as before).
+    # Python 2 orders them all (None first, then numbers, then by type name)
+    DB = ldtable([{'a':1},{'a':'x'}],sorted_attributes=['a'])
+    assert DB.count(DB.Q.a == 1) == 1
+    if PY2:
+        assert DB.count(DB.Q.a < 5) == 1
+    else:
+        with pytest.raises(TypeError):
+            DB.count(DB.Q.a < 5)
+    
+    DB2 = ldtable([{'a':1,'b':0},{'a':None,'b':1},{'a':3,'b':0}],sorted_attributes=['a'])
+    if PY2:
+        assert DB2.count(DB2.Q.a < 5) == 3
+    else:
+        with pytest.raises(TypeError):
+            DB2.count(DB2.Q.a < 5)
+    assert DB2.count((DB2.Q.a != None) & (DB2.Q.a < 2)) == 1
+    assert DB2.count((DB2.Q.b == 0) & (DB2.Q.a >= 1) & (DB2.Q.a <= 3)) == 2
+    DB2.update({'a':2},b=1)
+    assert DB2.count(DB2.Q.a < 5) == 3
+    if PY2:
+        assert DB2.count(DB2.Q.a < 'x') == 3
+    else:
+        with pytest.raises(TypeError):
+            DB2.count(DB2.Q.a < 'x') # Not comparable
+    
+    with pytest.raises(KeyError):
+        DB.Q.b.len()
+
+def test_complement():
+    items = [{'i':i,'grp':i % 10,'tags':['a','b'][:i % 3]} for i in range(1000)]
+    DB = ldtable(items)
+    Q = DB.Q
+    
+    # Negations are not listed until needed
+    assert isinstance((Q.grp != 3)._ixs,_Complement)
+    assert len((Q.grp != 3)._ixs.ixs) == 100
+    assert DB.count(Q.grp != 3) == 900
+    assert DB.count(~(Q.grp == 3)) == 900
+    assert DB.count(~~(Q.grp == 3)) == 100
+    assert [item['i'] for item in DB.query(Q.grp != 3)] == [i for i in range(1000) if i % 10 != 3]
+    
+    # Combined
+    assert DB.count((Q.grp != 3) & (Q.grp != 4)) == 800
+    assert DB.count((Q.grp != 3) & (Q.tags == 'b')) == len([i for i in range(1000) if i % 10 != 3 and i % 3 == 2])
+    assert DB.count((Q.grp != 3) | (Q.grp == 3)) == 1000
+    assert DB.count((Q.grp != 3) | (Q.grp != 4)) == 1000
+    assert DB.count((Q.grp != 3) | (Q.i < 5)) == 901
+    assert DB.count(~((Q.grp != 3) | (Q.grp != 4))) == 0
+    assert DB.count(~((Q.grp != 3) & (Q.grp != 4))) == 200
+    assert DB.count((Q.grp != 3) & (Q.i < 100)) == 90
+    assert DB.count((Q.i < 100) & ~(Q.grp.isin([1,2]) | (Q.i > 50))) == 41
+    assert DB.isin(Q.grp != 3)
+    assert not DB.isin((Q.grp != 3) & (Q.grp == 3))
+    
+    # Long chains
+    Qc = Q.i != 0
+    for i in range(1,500):
+        Qc = Qc & (Q.i != i)
+    assert DB.count(Qc) == 500
+    
+    DB.remove(grp=1)
+    assert DB.count(DB.Q.grp != 3) == 800
+
+def test_ordered_results():
+    items = [{'i':i,'grp':i % 7,'tags':['a','b'][:i % 3]} for i in range(3000)]
+    DB = ldtable(items)
+    DB.remove(DB.Q.i < 100)
+    
+    # Updated items are put back in order
+    DB.update({'grp':100},DB.Q.i.isin([2500,150,1700]))
+    DB.update_many({'grp':100},i=900)
+    assert [item['i'] for item in DB.query(grp=100)] == [150,900,1700,2500]
+    for val in list(range(7)) + [100]:
+        res = [item['i'] for item in DB.query(grp=val)]
+        assert res == sorted(res)
+    
+    Q = DB.Q
+    for q in [Q.grp == 3,(Q.grp == 3) & (Q.tags == 'b'),Q.grp != 3,
+              Q.grp.isin([1,2,100]),(Q.i > 2000) | (Q.grp == 1),~(Q.grp == 1),
+              {'grp':100},Q.tags.contains_all(['a','b'])]:
+        res = [item['i'] for item in DB.query(q)]
+        assert len(res) > 0
+        assert res == sorted(res)
+    assert [item['i'] for item in DB.query(grp=100)] == [150,900,1700,2500]
+    assert DB.count(grp=3) == len([1 for i in range(100,3000) if i % 7 == 3]) - 1 # 150
+    
+    # Still in order when indexed later
+    DB = ldtable(items,lazy=True)
+    DB.update({'grp':100},i=20)
+    assert [item['i'] for item in DB.query(DB.Q.grp.isin([100,0]))][:4] == [0,7,14,20]
+    
+    # A value repeated within an item's list is in the index once
+    DB = ldtable([{'n':[3,3]},{'n':3},{'n':[4,3,4]}])
+    assert DB.count(n=3) == 3 and DB.count(n=4) == 1
+    assert list(DB.query(n=3)) == [{'n':[3,3]},{'n':3},{'n':[4,3,4]}]
+    DB.update({'n':[4,4]},n=3,_index=1)
+    assert DB.count(n=3) == 2 and DB.count(n=4) == 2
+    assert [item['n'] for item in DB.query(n=4)] == [[4,4],[4,3,4]]
+    DB.update_many({0:{'n':[5,5,3]}})
+    assert DB.count(n=3) == 2 and DB.count(n=5) == 1
+    DB.mark_dirty(0)
+    DB[0]['n'] = [4,4,4]
+    DB.reindex(dirty_only=True)
+    assert DB.count(n=4) == 3 and DB.count(n=5) == 0 and DB.count(n=3) == 1
+    DB.remove(n=4)
+    assert len(DB) == 0 and DB.count(n=4) == 0 and DB.count(n=3) == 0
+    DB = ldtable([{'n':[3,3]},{'n':3}],lazy=True)
+    assert DB.count(n=3) == 2 and len(list(DB.query(n=3))) == 2
+
+def test_query_page():
+    items = [{'i':i,'grp':i % 3} for i in range(1000)]
+    DB = ldtable(items)
+    Q = DB.Q
+    
+    for q in [Q.grp == 1,(Q.grp == 1) & (Q.i > 10),Q.grp != 0,Q.grp.isin([1,2]),{'grp':1}]:
+        expected = [item['i'] for item in DB.query(q)]
+        res,cursor = [],None
+        while True:
+            page,cursor = DB.query_page(q,_after=cursor,_limit=30)
+            assert len(page) <= 30
+            res.extend(item['i'] for item in page)
+            if cursor is None:
+                break
+        assert res == expected
+    
+    assert [item['i'] for item in DB.query(grp=2,_after=500,_limit=3)] == [503,506,509]
+    assert [item['i'] for item in DB.query(Q.grp != 2,_after=500,_limit=3)] == [501,502,504]
+    assert len(list(DB.query(grp=2,_after=500))) == 166
+    assert len(DB.query_page(grp=2)[0]) == 100
+    assert DB.query_page(grp=2,_after=998) == ([],None)
+    
+    # Cursors stay valid with adds and removes
+    page,cursor = DB.query_page(grp=1,_limit=10)
+    assert cursor == 28
+    DB.remove(i=31)
+    DB.add({'i':1000,'grp':1})
+    DB.add({'i':1001,'grp':1})
+    page,cursor = DB.query_page(DB.Q.grp == 1,_after=cursor,_limit=10)
+    assert [item['i'] for item in page] == [34,37,40,43,46,49,52,55,58,61]
+    items = []
+    while cursor is not None:
+        page,cursor = DB.query_page(grp=1,_after=cursor,_limit=100)
+        items.extend(page)
+    assert [item['i'] for item in items[-2:]] == [1000,1001]
+    
+    # Frozen and empty
+    DB.freeze()
+    assert [item['i'] for item in DB.query(grp=2,_after=500,_limit=3)] == [503,506,509]
+    assert ldtable().query_page(a=1) == ([],None)
+    
+    with pytest.raises(ValueError):
+        DB.query_page(grp=1,_limit=-1)
+    
+    # No cursor when exactly _limit are left
+    DB = ldtable([{'i':i,'grp':i % 3} for i in range(1000)])
+    Q = DB.Q
+    for q in [{'grp':1},(Q.grp == 1) & (Q.i < 700),Q.grp != 0]:
+        n = DB.count(q)
+        page,cursor = DB.query_page(q,_limit=n)
+        assert len(page) == n and cursor is None
+        page,cursor = DB.query_page(q,_limit=n - 1)
+        assert len(page) == n - 1 and cursor == page[-1]['i']
+        page,cursor = DB.query_page(q,_after=cursor,_limit=1)
+        assert len(page) == 1 and cursor is None
+    assert DB.query_page(grp=1,_limit=0) == ([],None)
+    
+    # count() of a page
+    assert DB.count(grp=1,_limit=10) == 10
+    assert DB.count(grp=1,_after=990) == 3
+    assert DB.count(Q.grp != 1,_after=990,_limit=4) == 4
+    assert DB.count(DB.Q.grp.isin([0,1]),_after=995) == 3
+    
+    # Compound queries only check the items after the cursor
+    checked = []
+    def func(item):
+        checked.append(item['i'])
+        return item['i'] % 2 == 0
+    for q,grps in [(Q.filter(func),[0,1,2]),((Q.grp == 1) & Q.filter(func),[1]),
+                   (Q.grp.isin([1,2]) & Q.filter(func) & (Q.i > 10),[1,2])]:
+        del checked[:]
+        page,cursor = DB.query_page(q,_after=900,_limit=5)
+        assert [item['i'] for item in page] == [i for i in range(901,1000) 
+                                                if i % 2 == 0 and i % 3 in grps][:5]
+        assert checked and min(checked) > 900
+
+def test_analyze():
+    items = [{'i':i,'grp':i % 4 if i % 10 else 0,'x':None if i % 5 == 0 else float(i),
+              'tags':['a','b'][:i % 3],'obj':[1,'a'][i % 2]} for i in range(1000)]
+    DB = ldtable(items,primary_key='i')
+    
+    stats = DB.analyze(bins=4,mcv=2)
+    assert set(stats) == set(['i','grp','x','tags','obj'])
+    assert stats['grp']['distinct'] == 4
+    assert stats['grp']['mcv'][0] == (0,300)
+    assert len(stats['grp']['mcv']) == 2
+    assert abs(stats['x']['null_frac'] - 0.2) < 1e-9
+    assert stats['x']['histogram'][0] == 1.0 and stats['x']['histogram'][-1] == 999.0
+    assert sum(stats['x']['bin_counts']) == 800
+    assert max(stats['x']['bin_counts']) - min(stats['x']['bin_counts']) <= 1
+    if not PY2:
+        assert stats['obj']['histogram'] is None # Not orderable
+    assert stats['tags']['values'] == 1000 + 333 # Each value of a list
+    assert stats['i']['distinct'] == 1000
+    
+    # Estimates
+    assert DB.selectivity(grp=0) == 0.3
+    assert DB.selectivity(DB.Q.grp.isin([1,2])) == 0.45
+    assert abs(DB.selectivity(DB.Q.x < 500) - 0.4) < 0.02
+    assert abs(DB.selectivity(DB.Q.x >= 900) - 0.08) < 0.02
+    if not PY2:
+        assert DB.selectivity(DB.Q.obj < 5) == 1.0/3 # Default
+    assert DB.selectivity(~(DB.Q.grp == 0)) == 1 - 0.3
+    assert abs(DB.selectivity((DB.Q.grp == 0) & (DB.Q.x < 500)) - 0.3*0.4) < 0.01
+    assert DB.selectivity(i=5) == 0.001
+    assert DB.selectivity(i=5000) == 0
+    
+    # Kept up to date
+    DB.add({'i':1000,'grp':7,'x':5000.0,'tags':[],'obj':1})
+    DB.update({'grp':7},DB.Q.i < 10)
+    DB.update_many({'x':None},DB.Q.i.isin([1,2]))
+    DB.remove(DB.Q.i >= 900)
+    stats = DB.stats()
+    assert stats['grp']['distinct'] == 5
+    assert stats['grp']['mcv'][0][0] == 0
+    assert dict(stats['grp']['mcv'])[0] == DB.count(grp=0)
+    assert stats['x']['values'] == 900
+    assert stats['x']['null_frac'] == float(DB.count(x=None))/900
+    assert sum(stats['x']['bin_counts']) == 900 - DB.count(x=None)
+    assert stats['i']['distinct'] == 900
+    assert abs(DB.selectivity(DB.Q.x < 500) - len([1 for item in DB.items() if item['x'] is not None and item['x'] < 500])/900.0) < 0.05
+    assert DB.stats('tags')['tags']['values'] == sum(max(len(item['tags']),1) for item in DB.items())
+    
+    DB2 = ldtable([{'grp':i % 4,'x':i} for i in range(100)])
+    DB2.analyze('grp',mcv=10)
+    for _ in range(5):
+        DB2.add({'grp':9,'x':None})
+    assert DB2.stats('grp')['grp']['mcv'][-1] == (9,5)
+    DB2.reindex()
+    assert DB2.stats('grp')['grp']['distinct'] == 5
+    
+    with pytest.raises(KeyError):
+        DB2.stats('x')
+    with pytest.raises(KeyError):
+        DB2.analyze('nope')
+    with pytest.raises(TypeError):
+        DB2.analyze(bin=3)
+    
+    # Snapshots keep the statistics from when they were made
+    with DB2.snapshot() as snap:
+        DB2.add({'grp':0,'x':-1})
+        assert snap.stats('grp')['grp']['values'] == 105
+        assert DB2.stats('grp')['grp']['values'] == 106
+        snap._evict('grp') # e.g. lazy eviction in the snapshot
+        assert DB2.stats('grp')['grp']['values'] == 106
+    
+    # Query results are unchanged by the ordering
+    Q = DB.Q
+    q = (Q.grp == 1) & (Q.tags == 'b') & (Q.x != None) & (Q.x > 300) & (Q.x < 600)
+    assert DB.count(q) == len([1 for item in DB.items() if item['grp'] == 1 and 'b' in item['tags']
+                              and item['x'] is not None and 300 < item['x'] < 600])
+
+def test_index_budget():
+    items = [{'a':i % 100,'b':i % 1000,'c':i,'d':i % 3} for i in range(20000)]
+    DB = ldtable(items,lazy=True)
+    for attrib in 'abcd':
+        DB.count(**{attrib:1})
+    sizes = dict((attrib,stats['bytes']) for attrib,stats in DB.index_stats()['attributes'].items())
+    assert sizes['c'] > sizes['a'] + sizes['b'] + sizes['d']
+    
+    budget = sizes['a'] + sizes['d'] + (sizes['b'] // 2)
+    DB = ldtable(items,lazy=True,index_budget=budget)
+    for _ in range(5):
+        assert DB.count(a=1) == 200
+    assert DB.count(b=1) == 20
+    assert DB.count(d=1) == 6667 # Over budget. b is the least used
+    stats = DB.index_stats()
+    assert stats['budget'] == budget
+    assert stats['bytes'] <= budget
+    assert stats['evictions'] == 1
+    assert [attrib for attrib,s in stats['attributes'].items() if s['indexed']] == ['a','d']
+    assert stats['attributes']['a']['queries'] == 5
+    assert stats['attributes']['b']['evictions'] == 1
+    
+    # Too big by itself. Used once without evicting the others
+    assert DB.count(c=7) == 1
+    assert DB.count((DB.Q.c == 7) | (DB.Q.a == 2)) == 201
+    stats = DB.index_stats()
+    assert not stats['attributes']['c']['indexed']
+    assert stats['attributes']['c']['builds'] == 2
+    assert stats['attributes']['a']['indexed'] and stats['attributes']['d']['indexed']
+    
+    # Rebuilt when needed and still correct after changes
+    DB.add({'a':1,'b':1,'c':-1,'d':1})
+    DB.update({'b':2},c=5)
+    assert DB.count(b=1) == 21
+    assert DB.count(b=2) == 21
+    assert DB.index_stats()['bytes'] <= budget
+    assert DB.count(a=1) == 201
+    
+    # Only reading the index for a query counts. Not estimates or statistics
+    DB = ldtable(items,lazy=True)
+    DB.count((DB.Q.a == 1) & (DB.Q.b == 2))
+    DB.count(DB.Q.a.isin(range(10)))
+    DB.count(DB.Q.a == [1,2]) # One condition
+    DB.analyze('a','b')
+    DB.stats()
+    DB.selectivity(DB.Q.a.isin(range(10)))
+    DB.selectivity(DB.Q.c == 1)
+    stats = DB.index_stats()['attributes']
+    assert stats['a']['queries'] == 3 and stats['b']['queries'] == 1
+    assert 'c' not in stats or not stats['c']['indexed']
+    
+    # Not lazy. Nothing is counted but sizes are reported
+    DB = ldtable(items)
+    DB.count(a=1)
+    stats = DB.index_stats()
+    assert stats['evictions'] == 0 and stats['attributes']['a']['queries'] == 0
+    assert stats['attributes']['a']['indexed'] and stats['bytes'] > sum(sizes.values()) - 1000
+
+
+def test_storage(tmpdir):
+    path = str(tmpdir.join('DB.sqlite'))
+    items = [{'a':i % 10,'b':i,'tags':['t{}'.format(i % 3)]} for i in range(3000)]
+    DB = ldtable(copy.deepcopy(items),storage=path,storage_cache=50)
+    DB0 = ldtable(copy.deepcopy(items))
+    
+    assert len(DB._list._cache) == 0
+    assert DB.query_one(b=17) == items[17]
+    assert list(DB.query(a=3)) == list(DB0.query(a=3))
+    assert DB.count(DB.Q.b < 100) == 100
+    assert len(DB._list._cache) <= 50
+    
+    # Changes through the DB are stored. Direct ones are not
+    DB.update({'a':-1},b=5)
+    DB.update_many({'a':-2},DB.Q.b >= 2990)
+    item = DB.query_one(b=6)
+    item['a'] = 'direct'
+    assert DB.query_one(b=6)['a'] == 6 # Even while cached
+    DB.update({'a':-6},b=6) # Index changes are from the stored item
+    assert DB.count(a=-6) == 1 and DB.count(a=6) == 298
+    DB.update({'a':6},b=6)
+    DB._list._cache.clear()
+    assert DB.query_one(b=5)['a'] == -1
+    assert DB.count(a=-2) == 10 and DB.query_one(b=2995)['a'] == -2
+    assert DB.query_one(b=6)['a'] == 6
+    
+    DB.add_attribute('c',0)
+    DB._list._cache.clear()
+    assert all(item['c'] == 0 for item in DB.items())
+    
+    # Remove and compact
+    DB.remove(DB.Q.b < 1000)
+    assert len(DB) == 2000 and DB.query_one(b=10) is None
+    with pytest.raises(ValueError):
+        DB[10]
+    DB.compact()
+    assert DB[1999]['b'] == 2999
+    assert DB[0]['b'] == 1000
+    assert DB.query_one(b=2500) == DB[1500]
+    assert [item['b'] for item in DB.items()] == list(range(1000,3000))
+    
+    # Pickled copies read the same file
+    DB2 = pickle.loads(pickle.dumps(DB))
+    assert DB2.query_one(b=2500) == DB.query_one(b=2500)
+    
+    # New DB in the same file starts over
+    DB3 = ldtable([{'a':1}],storage=path)
+    assert len(DB3) == 1 and list(DB3.items()) == [{'a':1}]
+    
+    with pytest.raises(ValueError):
+        DB3.freeze()
+    with pytest.raises(ValueError):
+        ldtable(storage=path,indexObjects=True)
+
+def test_clone():
+    items = [{'id':i,'a':i % 10,'b':i,'tags':['t{}'.format(i % 3)]} for i in range(1000)]
+    DB = ldtable(copy.deepcopy(items),primary_key='id',sorted_attributes=['b'])
+    DB.analyze('a')
+    ref = ldtable(copy.deepcopy(items),primary_key='id')
+    
+    C = DB.clone()
+    assert C[5] is DB[5] and C._lookup['a'] is DB._lookup['a'] # Shared
+    
+    # What-if changes to the clone
+    C.update({'a':-1},b=5)
+    C.update_many({'a':-2},C.Q.b >= 990)
+    C.remove(C.Q.b < 100)
+    C.add({'id':-1,'a':3,'b':-1,'tags':[]})
+    C.upsert({'id':500,'a':-3})
+    C.add_attribute('c',0)
+    assert C.count(a=-2) == 10 and C.count(a=-3) == 1 and C.query_one(b=5) is None
+    assert len(C) == 901 and C.count(a=3) == 90 and C.count(C.Q.a != 3) == 811
+    assert C.count(C.Q.b < 200) == 101
+    assert C.stats('a')['a']['distinct'] == 12
+    assert C.get(0) is None and C.get(500)['c'] == 0
+    with pytest.raises(ValueError):
+        C[0]
+    
+    # The DB is unchanged
+    assert list(DB.items()) == list(ref.items())
+    assert len(DB) == 1000 and DB.count(a=-2) == 0 and DB.count(DB.Q.b < 200) == 200
+    assert DB.stats('a')['a']['distinct'] == 10
+    assert 'c' not in DB.attributes and DB.count(a=-1) == 0
+    
+    # Changes to the DB are not seen by the clone
+    DB.update({'a':-5},b=107)
+    DB.remove(b=999)
+    DB.add({'id':2000,'a':1,'b':2000,'tags':[]})
+    assert C.query_one(b=107)['a'] == 7 and C.count(b=999) == 1 and C.count(b=2000) == 0
+    assert DB.count(a=-5) == 1 and DB.query_one(b=999) is None
+    
+    # Clones of clones and compact
+    C2 = C.clone()
+    C2.remove(a=3)
+    assert C2.count(a=3) == 0 and C.count(a=3) == 90
+    with pytest.raises(ValueError):
+        C.compact()
+    del C2
+    gc.collect()
+    C.compact()
+    assert len(C) == 901 and C.get(-1) == C[900] and C.count(C.Q.b < 200) == 101
+    C.update({'a':-4},id=999)
+    assert DB.get(999) is None and C.get(999)['a'] == -4
+    
+    DB.compact() # Nothing is shared after C's compact so it may be compacted
+    assert len(C) == 901 and C.count(C.Q.b < 200) == 101
+    DB.update({'a':-7},b=108)
+    assert DB.count(a=-7) == 1 and C.count(a=-7) == 0
+    
+    # Stop copying once it's gone
+    del C
+    gc.collect()
+    DB.update({'a':-6},b=8)
+    assert DB.count(a=-6) == 1 and DB.query_one(b=8)['a'] == -6
+    DB.compact()
+    
+    # Records from mark_dirty() are not shared
+    D = ldtable(copy.deepcopy(items))
+    item = D.query_one(b=3)
+    D.mark_dirty(item)
+    C = D.clone()
+    C.reindex('a')
+    item['a'] = 'changed'
+    D.reindex(dirty_only=True)
+    assert D.count(a='changed') == 1 and C.count(a='changed') == 0
+    
+    D = ldtable(copy.deepcopy(items))
+    D.freeze()
+    with pytest.raises(ValueError):
+        D.clone()
+
 if __name__ == '__main__':
     test_removal()
 